@@ -0,0 +1,151 @@
+"""
+Benchmark of TetonNerfModel inference with and without the occupancy grid, on the CPU.
+
+The model is fitted for a few hundred steps to the density of a synthetic room, so that the grid has empty space
+to skip, then random rays from inside the room are rendered.
+
+    python -m teton_nerf.benchmarks.bench_occupancy_grid --num-rays 4096
+"""
+
+from __future__ import annotations
+
+import time
+from dataclasses import dataclass
+from typing import Dict, Optional, Tuple
+
+import torch
+import tyro
+
+from nerfstudio.cameras.rays import RayBundle
+from nerfstudio.data.scene_box import SceneBox
+from nerfstudio.utils.rich_utils import CONSOLE
+
+from teton_nerf.teton_nerf import TetonNerfModel, TetonNerfModelConfig
+
+
+def room_density(points: torch.Tensor, half_size: float = 0.8, thickness: float = 0.02) -> torch.Tensor:
+    """Density of the walls, floor and ceiling of a box shaped room with a table in it."""
+    distance = points.abs().amax(dim=-1)
+    walls = (distance - half_size).abs() < thickness
+    table = ((points - torch.tensor([0.3, -0.6, 0.2])).abs() < torch.tensor([0.25, 0.05, 0.15])).all(dim=-1)
+    return torch.where(walls | table, 50.0, 0.0)[..., None]
+
+
+def fit_room(model: TetonNerfModel, steps: int, batch_size: int = 8192, seed: int = 0) -> None:
+    """Fits the field and proposal network densities to room_density."""
+    generator = torch.Generator().manual_seed(seed)
+    parameters = list(model.field.parameters()) + list(model.proposal_networks.parameters())
+    optimizer = torch.optim.Adam(parameters, lr=1e-2)
+    density_fns = list(model.density_fns) + [model.field.density_fn]
+    for _ in range(steps):
+        points = torch.rand(batch_size, 3, generator=generator) * 2.4 - 1.2
+        # Half of the points on the walls, which are a tiny part of the volume
+        near_walls = points[: batch_size // 2]
+        axis = torch.randint(3, (len(near_walls),), generator=generator)
+        side = torch.randint(2, (len(near_walls),), generator=generator).float() * 2 - 1
+        offset = (torch.rand(len(near_walls), generator=generator) - 0.5) * 0.1
+        near_walls[torch.arange(len(near_walls)), axis] = side * 0.8 + offset
+        target = room_density(points).log1p()
+        loss = sum(((density_fn(points).log1p() - target) ** 2).mean() for density_fn in density_fns)
+        optimizer.zero_grad()
+        loss.backward()  # type: ignore
+        optimizer.step()
+
+
+def random_rays(num_rays: int, seed: int = 1) -> RayBundle:
+    """Rays from random points inside the room in random directions."""
+    generator = torch.Generator().manual_seed(seed)
+    origins = torch.rand(num_rays, 3, generator=generator) - 0.5
+    directions = torch.nn.functional.normalize(torch.randn(num_rays, 3, generator=generator), dim=-1)
+    return RayBundle(
+        origins=origins,
+        directions=directions,
+        pixel_area=torch.full((num_rays, 1), 1e-6),
+        camera_indices=torch.zeros(num_rays, 1, dtype=torch.long),
+    )
+
+
+@dataclass
+class BenchOccupancyGrid:
+    """Times rendering rays with the full proposal chain and with the occupancy grid skipping empty space."""
+
+    num_rays: int = 4096
+    """Number of rays rendered per setting."""
+    num_rays_per_chunk: int = 1024
+    """Number of rays rendered at once."""
+    fit_steps: int = 300
+    """Optimization steps fitting the model to the synthetic room."""
+    resolution: int = 64
+    """Occupancy grid resolution."""
+    reduced_proposal_samples: Tuple[int, ...] = (64, 48)
+    """Proposal samples per ray of the grid setting with fewer samples."""
+    num_threads: Optional[int] = None
+    """CPU threads used by torch, the torch default if not set."""
+
+    def render(self, model: TetonNerfModel, ray_bundle: RayBundle) -> Tuple[Dict[str, torch.Tensor], float]:
+        outputs = []
+        start = time.perf_counter()
+        with torch.no_grad():
+            for chunk in range(0, len(ray_bundle), self.num_rays_per_chunk):
+                rays = ray_bundle[chunk : chunk + self.num_rays_per_chunk]
+                outputs.append(model(rays))
+        seconds = time.perf_counter() - start
+        return {name: torch.cat([output[name] for output in outputs]) for name in ("rgb", "depth")}, seconds
+
+    def main(self) -> None:
+        if self.num_threads is not None:
+            torch.set_num_threads(self.num_threads)
+        CONSOLE.print(f"torch threads: {torch.get_num_threads()}")
+        config = TetonNerfModelConfig(
+            implementation="torch",
+            use_semantics=False,
+            use_depth=False,
+            use_occupancy_grid=True,
+            occupancy_grid_resolution=self.resolution,
+        )
+        model = config.setup(
+            scene_box=SceneBox(aabb=torch.tensor([[-1.0, -1.0, -1.0], [1.0, 1.0, 1.0]])),
+            num_train_data=1,
+            metadata={"semantics": None},
+        )
+        start = time.perf_counter()
+        fit_room(model, self.fit_steps)
+        CONSOLE.print(f"Fitted the synthetic room in {time.perf_counter() - start:.1f}s")
+        model.eval()
+        ray_bundle = random_rays(self.num_rays)
+
+        grid = model.occupancy_grid
+        assert grid is not None
+        start = time.perf_counter()
+        occupancy = grid.update(model.field.density_fn, config.occupancy_grid_density_threshold)
+        CONSOLE.print(
+            f"Built the {self.resolution}^3 grid in {time.perf_counter() - start:.2f}s, {occupancy:.1%} occupied"
+        )
+
+        model.occupancy_grid = None
+        reference, seconds = self.render(model, ray_bundle)
+        CONSOLE.print(f"{'full proposal chain':>24} | {self.num_rays / seconds:8.0f} rays/s")
+        model.occupancy_grid = grid
+
+        for name, proposal_samples in (("grid", None), ("grid, fewer samples", self.reduced_proposal_samples)):
+            model.occupancy_grid_sampler = (
+                model.make_proposal_sampler(proposal_samples) if proposal_samples else model.proposal_sampler
+            )
+            outputs, grid_seconds = self.render(model, ray_bundle)
+            mse = torch.mean((outputs["rgb"] - reference["rgb"]) ** 2)
+            depth_error = torch.median((outputs["depth"] - reference["depth"]).abs() / reference["depth"])
+            CONSOLE.print(
+                f"{name:>24} | {self.num_rays / grid_seconds:8.0f} rays/s | speedup {seconds / grid_seconds:5.2f}x"
+                f" | rgb PSNR to full {float(-10 * torch.log10(mse)):6.2f} dB"
+                f" | median relative depth difference {float(depth_error):.2%}"
+            )
+
+
+def entrypoint():
+    """Entrypoint for use with pyproject scripts."""
+    tyro.extras.set_accent_color("bright_yellow")
+    tyro.cli(BenchOccupancyGrid).main()
+
+
+if __name__ == "__main__":
+    entrypoint()
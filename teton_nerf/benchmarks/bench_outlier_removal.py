@@ -0,0 +1,88 @@
+"""
+Benchmark of the torch statistical outlier removal against Open3D's remove_statistical_outlier.
+
+    python -m teton_nerf.benchmarks.bench_outlier_removal --num-points 1000000 4000000
+"""
+
+from __future__ import annotations
+
+import time
+from dataclasses import dataclass
+from typing import Optional, Tuple
+
+import numpy as np
+import torch
+import tyro
+
+from nerfstudio.utils.rich_utils import CONSOLE
+
+from teton_nerf.utils.point_cloud_filter import statistical_outlier_mask
+
+
+def synthetic_point_cloud(num_points: int, outlier_fraction: float, seed: int = 0) -> torch.Tensor:
+    """Points on the faces of a room sized box, plus uniform floaters inside and around it."""
+    generator = torch.Generator().manual_seed(seed)
+    num_outliers = int(num_points * outlier_fraction)
+    num_surface = num_points - num_outliers
+    surface = torch.rand(num_surface, 3, generator=generator) * 2 - 1
+    axis = torch.randint(3, (num_surface,), generator=generator)
+    side = torch.randint(2, (num_surface,), generator=generator).float() * 2 - 1
+    surface[torch.arange(num_surface), axis] = side
+    surface += torch.randn(num_surface, 3, generator=generator) * 0.002
+    outliers = torch.rand(num_outliers, 3, generator=generator) * 3 - 1.5
+    return torch.cat([surface, outliers])
+
+
+@dataclass
+class BenchOutlierRemoval:
+    """Times both outlier removal methods on synthetic clouds and reports how often they agree."""
+
+    num_points: Tuple[int, ...] = (250000, 1000000, 4000000)
+    """Cloud sizes to benchmark."""
+    outlier_fraction: float = 0.01
+    """Share of the points that are uniform floaters."""
+    nb_neighbors: int = 20
+    """Number of neighbours, as in generate_point_cloud."""
+    std_ratio: float = 2.0
+    """Outlier threshold. Lower than the export default so that the floaters are actually removed."""
+    num_threads: Optional[int] = None
+    """CPU threads of the torch method, the torch default if not set."""
+    skip_open3d: bool = False
+    """Only time the torch method, e.g. for sizes where Open3D takes too long."""
+
+    def main(self) -> None:
+        CONSOLE.print(f"torch threads: {self.num_threads or torch.get_num_threads()}")
+        for num_points in self.num_points:
+            points = synthetic_point_cloud(num_points, self.outlier_fraction)
+
+            start = time.perf_counter()
+            keep = statistical_outlier_mask(points, self.nb_neighbors, self.std_ratio, num_threads=self.num_threads)
+            torch_time = time.perf_counter() - start
+            line = f"{num_points:>10} points | torch {torch_time:7.2f}s, kept {int(keep.sum())}"
+
+            if not self.skip_open3d:
+                import open3d as o3d
+
+                pcd = o3d.geometry.PointCloud()
+                pcd.points = o3d.utility.Vector3dVector(points.double().numpy())
+                start = time.perf_counter()
+                _, ind = pcd.remove_statistical_outlier(nb_neighbors=self.nb_neighbors, std_ratio=self.std_ratio)
+                open3d_time = time.perf_counter() - start
+                open3d_keep = np.zeros(num_points, dtype=bool)
+                open3d_keep[np.asarray(ind)] = True
+                agreement = float((open3d_keep == keep.numpy()).mean())
+                line += (
+                    f" | open3d {open3d_time:7.2f}s, kept {len(ind)}"
+                    f" | speedup {open3d_time / torch_time:5.1f}x, agreement {agreement:.4%}"
+                )
+            CONSOLE.print(line)
+
+
+def entrypoint():
+    """Entrypoint for use with pyproject scripts."""
+    tyro.extras.set_accent_color("bright_yellow")
+    tyro.cli(BenchOutlierRemoval).main()
+
+
+if __name__ == "__main__":
+    entrypoint()
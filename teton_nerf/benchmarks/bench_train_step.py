@@ -0,0 +1,335 @@
+"""
+Micro-benchmarks of the Teton NeRF training step, on the CPU.
+
+A synthetic room is written to disk as a processed Polycam dataset, with images, LiDAR depth, confidence maps,
+segmentations and the monocular depth caches, so the dataset skips Depth Anything. The teton-nerf pipeline is set
+up on it with the torch implementation of the field, and every part of the training step is timed on its own:
+
+    dataset.get_metadata              per image depth, confidence and semantics loading
+    datamanager.next_train            pixel sampling and ray generation of a batch
+    model.get_outputs                 forward pass of a batch, including the collider
+    model.get_metrics_dict            psnr, distortion and depth losses
+    model.get_loss_dict               rgb, proposal, semantic and depth losses
+    random_train_pose+generate_rays   RegNeRF patch cameras and their rays
+    pipeline.get_train_loss_dict      the whole step without the backward pass
+
+Results are written as JSON, and compared to the JSON of an earlier run to catch regressions:
+
+    python -m teton_nerf.benchmarks.bench_train_step --output baseline.json
+    python -m teton_nerf.benchmarks.bench_train_step --baseline baseline.json --output results.json
+"""
+
+from __future__ import annotations
+
+import copy
+import json
+import math
+import platform
+import tempfile
+import time
+from dataclasses import asdict, dataclass
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional
+
+import numpy as np
+import torch
+import tyro
+from PIL import Image
+
+from nerfstudio.utils.rich_utils import CONSOLE
+
+from teton_nerf.semantic_classes import SEMANTIC_CLASSES
+from teton_nerf.teton_dataparser import TetonDataparserConfig
+from teton_nerf.teton_nerf_config import teton_nerf as teton_nerf_method
+from teton_nerf.teton_nerf_pipeline import TetonNerfPipeline
+from teton_nerf.utils.random_train_pose import random_train_pose
+
+ROOM_MIN = np.array([-2.0, -2.0, 0.0])
+ROOM_MAX = np.array([2.0, 2.0, 2.6])
+
+
+def render_room(camera_to_world: np.ndarray, fx: float, width: int, height: int) -> Dict[str, np.ndarray]:
+    """Ray casts a box shaped room with a rug and a window from a pinhole camera inside it.
+
+    Returns the rgb image, the depth along the optical axis in meters and the semantic class of every pixel.
+    """
+    u, v = np.meshgrid(np.arange(width) + 0.5, np.arange(height) + 0.5)
+    # OpenGL camera convention, looking along -z with y up
+    directions = np.stack([(u - width / 2) / fx, -(v - height / 2) / fx, -np.ones_like(u)], axis=-1)
+    directions = directions @ camera_to_world[:3, :3].T
+    origin = camera_to_world[:3, 3]
+
+    bounds = np.where(directions > 0, ROOM_MAX, ROOM_MIN)
+    with np.errstate(divide="ignore"):
+        distances = np.where(directions != 0, (bounds - origin) / directions, np.inf)
+    axis = np.argmin(distances, axis=-1)
+    depth = np.take_along_axis(distances, axis[..., None], axis=-1)[..., 0]
+    points = origin + directions * depth[..., None]
+
+    classes = np.full((height, width), SEMANTIC_CLASSES.index("wall"), dtype=np.uint8)
+    floor = (axis == 2) & (directions[..., 2] < 0)
+    classes[floor] = SEMANTIC_CLASSES.index("floor")
+    classes[(axis == 2) & (directions[..., 2] > 0)] = SEMANTIC_CLASSES.index("ceiling")
+    classes[floor & (np.abs(points[..., 0]) < 0.8) & (np.abs(points[..., 1]) < 0.6)] = SEMANTIC_CLASSES.index("rug")
+    window = (axis == 0) & (directions[..., 0] > 0)
+    window &= (np.abs(points[..., 1]) < 0.7) & (np.abs(points[..., 2] - 1.5) < 0.5)
+    classes[window] = SEMANTIC_CLASSES.index("window")
+
+    # Texture, so the images have detail to fit
+    checker = (np.floor(points * 4).astype(int).sum(axis=-1) % 2)[..., None]
+    palette = np.random.default_rng(0).uniform(0.2, 0.9, size=(len(SEMANTIC_CLASSES), 3))
+    rgb = palette[classes] * (0.8 + 0.2 * checker) * np.exp(-0.1 * depth)[..., None]
+    return {"rgb": (rgb * 255).astype(np.uint8), "depth": depth.astype(np.float32), "classes": classes}
+
+
+def write_synthetic_scene(path: Path, num_images: int, width: int, height: int, seed: int = 0) -> None:
+    """Writes a processed dataset of the synthetic room in the layout of ns-process-teton, plus the monocular
+    depth caches of every split, which hold the LiDAR depth itself."""
+    rng = np.random.default_rng(seed)
+    for folder in ("images", "depth", "confidence", "segmentations"):
+        (path / folder).mkdir(parents=True, exist_ok=True)
+    fx = 0.8 * width
+    frames = []
+    depths = {}
+    for i in range(num_images):
+        yaw = 2 * math.pi * i / num_images
+        pitch = math.radians(rng.uniform(-20, 20))
+        forward = np.array([math.cos(yaw) * math.cos(pitch), math.sin(yaw) * math.cos(pitch), math.sin(pitch)])
+        right = np.cross(forward, [0.0, 0.0, 1.0])
+        right /= np.linalg.norm(right)
+        up = np.cross(right, forward)
+        camera_to_world = np.eye(4)
+        camera_to_world[:3, :3] = np.stack([right, up, -forward], axis=-1)
+        camera_to_world[:3, 3] = [0.8 * math.cos(yaw + 0.5), 0.8 * math.sin(yaw + 0.5), rng.uniform(1.2, 1.6)]
+
+        view = render_room(camera_to_world, fx, width, height)
+        name = f"frame_{i + 1:05d}"
+        Image.fromarray(view["rgb"]).save(path / "images" / f"{name}.jpg", quality=95)
+        Image.fromarray((view["depth"] * 1000).astype(np.uint16)).save(path / "depth" / f"{name}.png")
+        confidence = np.where(view["depth"] < 3.0, 255, 127).astype(np.uint8)
+        Image.fromarray(confidence).save(path / "confidence" / f"{name}.png")
+        Image.fromarray(view["classes"]).save(path / "segmentations" / f"{name}.png")
+        depths[f"{name}.jpg"] = view["depth"]
+        frames.append(
+            {
+                "file_path": f"images/{name}.jpg",
+                "depth_file_path": f"depth/{name}.png",
+                "confidence_file_path": f"confidence/{name}.png",
+                "transform_matrix": camera_to_world.tolist(),
+            }
+        )
+
+    transforms = {"fl_x": fx, "fl_y": fx, "cx": width / 2, "cy": height / 2, "w": width, "h": height}
+    with open(path / "transforms.json", "w") as f:
+        json.dump({**transforms, "camera_model": "OPENCV", "frames": frames}, f, indent=2)
+    panoptic_classes = {
+        "thing_classes": SEMANTIC_CLASSES,
+        "thing_colors": rng.integers(0, 256, size=(len(SEMANTIC_CLASSES), 3)).tolist(),
+        "stuff_classes": [],
+        "stuff_colors": [],
+    }
+    with open(path / "panoptic_classes.json", "w") as f:
+        json.dump(panoptic_classes, f)
+
+    # The caches are stacked in the order of the dataparser's split, which the dataset indexes by image_idx
+    dataparser = TetonDataparserConfig(data=path).setup()
+    for split in ("train", "val", "test"):
+        outputs = dataparser.get_dataparser_outputs(split=split)
+        cache = np.stack([depths[filename.name] for filename in outputs.image_filenames])
+        np.save(outputs.image_filenames[0].parent / f"{split}_depths.npy", cache)
+
+
+def summarize(times: List[float]) -> Dict[str, float]:
+    milliseconds = np.array(times) * 1000
+    return {
+        "median_ms": float(np.median(milliseconds)),
+        "mean_ms": float(milliseconds.mean()),
+        "min_ms": float(milliseconds.min()),
+        "p90_ms": float(np.percentile(milliseconds, 90)),
+        "iterations": len(times),
+    }
+
+
+@dataclass
+class BenchTrainStep:
+    """Times the parts of the teton-nerf training step on a synthetic scene and compares them to a baseline."""
+
+    num_images: int = 24
+    """Number of images of the synthetic scene."""
+    width: int = 256
+    """Image width."""
+    height: int = 192
+    """Image height."""
+    num_rays_per_batch: int = 4096
+    """Training rays per batch, as in the teton-nerf config."""
+    warmup: int = 3
+    """Untimed calls before every benchmark."""
+    iterations: int = 20
+    """Timed calls per benchmark."""
+    seed: int = 0
+    """Seed of the scene and of torch."""
+    device: str = "cpu"
+    """Device of the pipeline."""
+    num_threads: Optional[int] = None
+    """CPU threads used by torch, the torch default if not set."""
+    scene_dir: Optional[Path] = None
+    """Directory the synthetic scene is written to and kept in, a temporary directory if not set."""
+    output: Optional[Path] = None
+    """JSON file the results are written to."""
+    baseline: Optional[Path] = None
+    """JSON results of an earlier run to compare to."""
+    tolerance: float = 0.15
+    """Relative increase of a median over the baseline that counts as a regression."""
+
+    def sync(self) -> None:
+        if self.device.startswith("cuda"):
+            torch.cuda.synchronize()
+
+    def measure(self, fn: Callable[[Any], Any], setup: Callable[[], Any] = lambda: None) -> Dict[str, float]:
+        """Times fn(setup()) after warming up. setup is not timed, it prepares the inputs of every call."""
+        times = []
+        for i in range(self.warmup + self.iterations):
+            inputs = setup()
+            self.sync()
+            start = time.perf_counter()
+            fn(inputs)
+            self.sync()
+            if i >= self.warmup:
+                times.append(time.perf_counter() - start)
+        return summarize(times)
+
+    def setup_pipeline(self, scene_dir: Path) -> TetonNerfPipeline:
+        config = copy.deepcopy(teton_nerf_method.config.pipeline)
+        config.datamanager.dataparser.data = scene_dir
+        config.datamanager.train_num_rays_per_batch = self.num_rays_per_batch
+        config.model.implementation = "torch"
+        pipeline = config.setup(device=self.device, test_mode="val", world_size=1, local_rank=0)
+        pipeline.train()
+        return pipeline
+
+    def run_benchmarks(self, pipeline: TetonNerfPipeline) -> Dict[str, Dict[str, float]]:
+        datamanager = pipeline.datamanager
+        dataset = datamanager.train_dataset
+        model = pipeline.model
+        config = pipeline.config
+        results = {}
+        steps = iter(range(1 << 30))
+
+        image_indices = iter(range(1 << 30))
+        results["dataset.get_metadata"] = self.measure(
+            dataset.get_metadata, lambda: {"image_idx": next(image_indices) % len(dataset)}
+        )
+        results["datamanager.next_train"] = self.measure(lambda step: datamanager.next_train(step), lambda: next(steps))
+        # Fresh rays for every call, the camera optimizer adjusts the rays of a bundle in place
+        results["model.get_outputs"] = self.measure(
+            lambda ray_bundle: model(ray_bundle), lambda: datamanager.next_train(next(steps))[0]
+        )
+
+        ray_bundle, batch = datamanager.next_train(next(steps))
+        outputs = model(ray_bundle)
+        results["model.get_metrics_dict"] = self.measure(lambda _: model.get_metrics_dict(outputs, batch))
+        metrics_dict = model.get_metrics_dict(outputs, batch)
+        results["model.get_loss_dict"] = self.measure(lambda _: model.get_loss_dict(outputs, batch, metrics_dict))
+
+        def patch_rays(_):
+            cameras, _, _ = random_train_pose(
+                size=config.num_patches,
+                resolution=config.patch_resolution,
+                device=pipeline.device,
+                radius_mean=config.aabb_scalar,
+                radius_std=0.0,
+                central_rotation_range=config.central_rotation_range,
+                vertical_rotation_range=config.vertical_rotation_range,
+                focal_range=config.focal_range,
+                jitter_std=config.jitter_std,
+                center=config.center,
+            )
+            camera_indices = torch.tensor(list(range(config.num_patches))).unsqueeze(-1)
+            return cameras.generate_rays(camera_indices).flatten()
+
+        results["random_train_pose+generate_rays"] = self.measure(patch_rays)
+        results["pipeline.get_train_loss_dict"] = self.measure(pipeline.get_train_loss_dict, lambda: next(steps))
+        return results
+
+    def compare(self, results: Dict[str, Dict[str, float]], baseline: Dict[str, Any]) -> List[str]:
+        """Prints every median next to the baseline's and returns the names of the regressed benchmarks."""
+        if baseline.get("settings") != self.settings():
+            CONSOLE.print("[bold yellow]The baseline was run with other settings, the comparison may be off")
+        regressions = []
+        CONSOLE.print(f"{'benchmark':>32} | {'median':>10} | {'baseline':>10} | change")
+        for name, stats in results.items():
+            reference = baseline["results"].get(name)
+            if reference is None:
+                CONSOLE.print(f"{name:>32} | {stats['median_ms']:8.2f}ms | {'-':>10} |")
+                continue
+            change = stats["median_ms"] / reference["median_ms"] - 1
+            regressed = change > self.tolerance
+            if regressed:
+                regressions.append(name)
+            style = "[bold red]" if regressed else "[green]" if change < -self.tolerance else ""
+            CONSOLE.print(
+                f"{name:>32} | {stats['median_ms']:8.2f}ms | {reference['median_ms']:8.2f}ms | {style}{change:+.1%}"
+            )
+        return regressions
+
+    def settings(self) -> Dict[str, Any]:
+        """Settings that change the timings, stored with the results."""
+        names = ("num_images", "width", "height", "num_rays_per_batch", "warmup", "iterations", "seed", "device")
+        settings = {name: value for name, value in asdict(self).items() if name in names}
+        settings["num_threads"] = torch.get_num_threads()
+        return settings
+
+    def main(self) -> None:
+        if self.num_threads is not None:
+            torch.set_num_threads(self.num_threads)
+        CONSOLE.print(f"torch threads: {torch.get_num_threads()}")
+        torch.manual_seed(self.seed)
+
+        with tempfile.TemporaryDirectory() as temporary_dir:
+            scene_dir = self.scene_dir or Path(temporary_dir) / "scene"
+            start = time.perf_counter()
+            write_synthetic_scene(scene_dir, self.num_images, self.width, self.height, seed=self.seed)
+            CONSOLE.print(f"Wrote the synthetic scene to {scene_dir} in {time.perf_counter() - start:.1f}s")
+            pipeline = self.setup_pipeline(scene_dir)
+            results = self.run_benchmarks(pipeline)
+
+        for name, stats in results.items():
+            CONSOLE.print(
+                f"{name:>32} | median {stats['median_ms']:8.2f}ms | mean {stats['mean_ms']:8.2f}ms"
+                f" | min {stats['min_ms']:8.2f}ms | p90 {stats['p90_ms']:8.2f}ms"
+            )
+
+        report = {
+            "benchmark": "bench_train_step",
+            "created": datetime.now().isoformat(timespec="seconds"),
+            "environment": {
+                "torch": torch.__version__,
+                "platform": platform.platform(),
+                "processor": platform.processor(),
+            },
+            "settings": self.settings(),
+            "results": results,
+        }
+        if self.output is not None:
+            self.output.parent.mkdir(parents=True, exist_ok=True)
+            with open(self.output, "w") as f:
+                json.dump(report, f, indent=2)
+            CONSOLE.print(f"Results written to {self.output}")
+
+        if self.baseline is not None:
+            with open(self.baseline) as f:
+                regressions = self.compare(results, json.load(f))
+            if regressions:
+                CONSOLE.print(f"[bold red]Slower than the baseline by more than {self.tolerance:.0%}: {regressions}")
+                raise SystemExit(1)
+
+
+def entrypoint():
+    """Entrypoint for use with pyproject scripts."""
+    tyro.extras.set_accent_color("bright_yellow")
+    tyro.cli(BenchTrainStep).main()
+
+
+if __name__ == "__main__":
+    entrypoint()
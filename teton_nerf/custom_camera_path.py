@@ -3,22 +3,36 @@ from dataclasses import dataclass
 from typing import Literal
 
 import torch
+import tyro
+from jaxtyping import Float
+from torch import Tensor
 from typing_extensions import Annotated
 import json
 import numpy as np
 
 from nerfstudio.cameras.camera_paths import get_interpolated_camera_path
 from nerfstudio.cameras.cameras import Cameras
+from nerfstudio.cameras.rays import RayBundle
 from nerfstudio.utils.eval_utils import eval_setup
 from nerfstudio.scripts.render import BaseRender, _render_trajectory_video
-from nerfstudio.cameras.camera_utils import normalize, rotation_matrix
+from nerfstudio.cameras.camera_utils import normalize_with_norm
 from nerfstudio.data.dataparsers.base_dataparser import transform_poses_to_original_space
 
+from teton_nerf.utils.streaming_render import render_trajectory_streaming
+
 @dataclass
 class RenderDepthBasedTransformedPath(BaseRender):
     pose_source: Literal["train", "eval"] = "eval"
     interpolation_steps: int = 20
     transform_cameras: bool = True
+    output_format: Literal["images", "video"] = "video"
+    """How to save output data."""
+    frame_rate: int = 24
+    """Frame rate of the output video."""
+    streaming: bool = True
+    """Encode the frames in a background thread while the next ones render. Not used with render_nearest_camera."""
+    queue_size: int = 8
+    """Maximum number of rendered frames waiting to be encoded when streaming."""
 
     def main(self) -> None:
         config, pipeline, checkpoint_path, step = eval_setup(
@@ -55,6 +69,26 @@ class RenderDepthBasedTransformedPath(BaseRender):
         )
 
 
+        # The duration the command always had, every rendered camera is shown for interpolation_steps / frame_rate s
+        seconds = self.interpolation_steps * len(camera_path) / self.frame_rate
+        if self.streaming and not self.render_nearest_camera:
+            camera_path.rescale_output_resolution(1.0 / self.downscale_factor)
+            render_trajectory_streaming(
+                pipeline,
+                camera_path,
+                output_filename=self.output_path,
+                rendered_output_names=self.rendered_output_names,
+                fps=len(camera_path) / seconds,
+                output_format=self.output_format,
+                image_format=self.image_format,
+                jpeg_quality=self.jpeg_quality,
+                queue_size=self.queue_size,
+                depth_near_plane=self.depth_near_plane,
+                depth_far_plane=self.depth_far_plane,
+                colormap_options=self.colormap_options,
+            )
+            return
+
         # Render the trajectory video with transformed camera path
         _render_trajectory_video(
             pipeline,
@@ -62,9 +96,10 @@ class RenderDepthBasedTransformedPath(BaseRender):
             output_filename=self.output_path,
             rendered_output_names=self.rendered_output_names,
             rendered_resolution_scaling_factor=1.0 / self.downscale_factor,
-            seconds= self.interpolation_steps * len(camera_path) / self.frame_rate,
+            seconds=seconds,
             output_format=self.output_format,
             image_format=self.image_format,
+            jpeg_quality=self.jpeg_quality,
             depth_near_plane=self.depth_near_plane,
             depth_far_plane=self.depth_far_plane,
             colormap_options=self.colormap_options,
@@ -73,20 +108,24 @@ class RenderDepthBasedTransformedPath(BaseRender):
         )
 
 def apply_depth_based_transformations(cameras, pipeline, scale):
-	# Generate rays and sample density
-	central_ray_bundles = get_central_rays(cameras)
-	print(central_ray_bundles)
-	# Get the depth of the central rays
-	# TODO: Check if scaling by the scale from dataparser_transforms is adequate
-	depths = scale * get_depths_of_central_rays(central_ray_bundles, pipeline)
-
-	# Compute transformation for camera based on depths
-	new_camera_matrices = compute_transformations(cameras, depths)
-	fx = cameras.fx
-	fy = cameras.fy
-	cx = cameras.cx
-	cy = cameras.cy
-	return Cameras(new_camera_matrices, fx, fy, cx, cy)
+    """Moves every camera forward to the surface hit by its central ray and turns it around."""
+    # Generate the central ray of every camera and render their depths in one go
+    central_ray_bundle = get_central_rays(cameras)
+    # TODO: Check if scaling by the scale from dataparser_transforms is adequate
+    depths = scale * get_depths_of_central_rays(central_ray_bundle, pipeline).to(cameras.device)
+
+    # Compute transformation for camera based on depths
+    new_camera_matrices = compute_transformations(cameras, depths)
+    return Cameras(
+        camera_to_worlds=new_camera_matrices,
+        fx=cameras.fx,
+        fy=cameras.fy,
+        cx=cameras.cx,
+        cy=cameras.cy,
+        width=cameras.width,
+        height=cameras.height,
+        camera_type=cameras.camera_type,
+    )
 
 def camera_coordinates_to_world_coordinates(transformation_matrix, scale_factor):
     """
@@ -116,71 +155,69 @@ def camera_coordinates_to_world_coordinates(transformation_matrix, scale_factor)
 
     return inverse_transformation_matrix
 
-def compute_transformations(cameras, depths):
+def batched_rotation_matrix(a: Float[Tensor, "N 3"], b: Float[Tensor, "N 3"]) -> Float[Tensor, "N 3 3"]:
+    """Rotation matrices that rotate every a onto the corresponding b, batched version of rotation_matrix."""
+    a, _ = normalize_with_norm(a, dim=-1)
+    b, _ = normalize_with_norm(b, dim=-1)
+    # Rodrigues' formula is undefined for opposite vectors, rotation_matrix perturbs a in that case
+    c = torch.sum(a * b, dim=-1, keepdim=True)
+    perturbed, _ = normalize_with_norm(a + torch.tensor([1e-3, 2e-3, 3e-3], device=a.device), dim=-1)
+    a = torch.where(c < -1 + 1e-8, perturbed, a)
+    v = torch.linalg.cross(a, b)
+    c = torch.sum(a * b, dim=-1)
+    zeros = torch.zeros_like(c)
+    skew_sym_mat = torch.stack(
+        [zeros, -v[:, 2], v[:, 1], v[:, 2], zeros, -v[:, 0], -v[:, 1], v[:, 0], zeros], dim=-1
+    ).view(-1, 3, 3)
+    scale = (1 - c) / (torch.sum(v**2, dim=-1) + 1e-8)
+    return torch.eye(3, device=a.device) + skew_sym_mat + skew_sym_mat @ skew_sym_mat * scale[:, None, None]
+
+
+def compute_transformations(cameras: Cameras, depths: Float[Tensor, "N 1"]) -> Float[Tensor, "N 3 4"]:
     """Transform each camera based on the corresponding depth and reverse its direction."""
-    new_camera_matrices = []
-
-    for idx, depth in enumerate(depths):
-        camera_matrix = cameras.camera_to_worlds[idx]
-        R = camera_matrix[:3, :3]
-        t = camera_matrix[:3, 3]
-
-        # The look_at direction is the negative of the third column of R
-        look_at = -R[:, 2]
-
-        # Normalize and compute translation vector
-        look_at_normalized = normalize(look_at.unsqueeze(0)).squeeze(0)
-        translation_vector = look_at_normalized * depth
+    camera_to_worlds = cameras.camera_to_worlds
+    rotations = camera_to_worlds[:, :3, :3]
+    translations = camera_to_worlds[:, :3, 3]
 
-        # Compute new camera position
-        new_position = t + translation_vector
+    # The look_at direction is the negative of the third column of R
+    look_at, _ = normalize_with_norm(-rotations[:, :, 2], dim=-1)
 
-        # Compute new look_at vector (pointing in the opposite direction)
-        new_look_at = -look_at_normalized
+    # Move the cameras along their look_at direction by the depth of their central ray
+    new_positions = translations + look_at * depths
 
-        # Compute rotation to align the new look_at with the z-axis
-        z_axis = torch.tensor([0, 0, 1], device=camera_matrix.device)
-        R_new = rotation_matrix(new_look_at, z_axis)
+    # The new cameras look back, rotate the reversed look_at onto the z-axis
+    z_axis = torch.tensor([0.0, 0.0, 1.0], device=camera_to_worlds.device).expand_as(look_at)
+    new_rotations = batched_rotation_matrix(-look_at, z_axis)
 
-        # Create new camera matrix
-        new_camera_matrix = torch.eye(4, device=camera_matrix.device)
-        new_camera_matrix[:3, :3] = R_new
-        new_camera_matrix[:3, 3] = new_position
+    return torch.cat([new_rotations, new_positions[:, :, None]], dim=-1)
 
-        new_camera_matrices.append(new_camera_matrix)
 
-    return new_camera_matrices
+def get_central_rays(cameras: Cameras) -> RayBundle:
+    """Compute the central rays for all cameras in the Cameras object, as one ray bundle of shape [N]."""
+    # Coordinates are (y, x), one row per camera
+    coords = torch.cat([cameras.cy, cameras.cx], dim=-1)
+    camera_indices = torch.arange(len(cameras), device=cameras.device)[:, None]
+    return cameras.generate_rays(camera_indices=camera_indices, coords=coords)
 
 
-def get_central_rays(cameras):
-    """Compute the central rays for all cameras in the Cameras object."""
-    # Central pixel coordinates
-    central_x = cameras.cx
-    central_y = cameras.cy
-
-    # Create image coordinates for the central ray of each camera
-    batch_size = central_x.shape[0]  # Number of cameras
-    image_coords = torch.stack([central_y.squeeze(-1), central_x.squeeze(-1)], dim=-1)  # Ensure shape is [N, 2]
-
-    # Generate rays for all cameras
-    central_ray_bundles = []
-    for idx in range(batch_size):
-        ray_bundle = cameras.generate_rays(
-            camera_indices=idx,
-            coords=image_coords[idx].unsqueeze(0)  # Add batch dimension
-        )
-        central_ray_bundles.append(ray_bundle)
+@torch.inference_mode()
+def get_depths_of_central_rays(ray_bundle: RayBundle, pipeline) -> Float[Tensor, "N 1"]:
+    """Get the depths of the central rays for all cameras using the pipeline, rendered in chunks."""
+    model = pipeline.model
+    ray_bundle = ray_bundle.to(model.device)
+    num_rays_per_chunk = model.config.eval_num_rays_per_chunk
+    depths = []
+    for start in range(0, len(ray_bundle), num_rays_per_chunk):
+        outputs = model(ray_bundle[start : start + num_rays_per_chunk])
+        depths.append(outputs["depth"])
+    return torch.cat(depths)
 
-    return central_ray_bundles
 
-def get_depths_of_central_rays(ray_bundle, pipeline):
-    """Get the depths of the central rays for all cameras using the pipeline."""
-    depths = []
+def entrypoint():
+    """Entrypoint for use with pyproject scripts."""
+    tyro.extras.set_accent_color("bright_yellow")
+    tyro.cli(RenderDepthBasedTransformedPath).main()
 
-    for ray in ray_bundle:
-        # Retrieve depth from the model for each central ray
-        outputs = pipeline.model.get_outputs(ray)
-        central_ray_depth = outputs['depth']  # Assumes depth is returned here
-        depths.append(central_ray_depth)
 
-    return depths
\ No newline at end of file
+if __name__ == "__main__":
+    entrypoint()
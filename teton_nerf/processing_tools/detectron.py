@@ -16,6 +16,8 @@ import glob
 import click
 from pathlib import Path
 
+from teton_nerf.semantic_classes import SEMANTIC_CLASSES
+
 
 class SemanticSegmentor():
     
@@ -28,9 +30,7 @@ class SemanticSegmentor():
         self.predictor = DefaultPredictor(self.cfg)
         
         # Reduce the number of classes the model is using
-        self.expected_classes = ["none", "curtain", "door-stuff", "mirror-stuff", "pillow", "shelf", "stairs",
-                            "table", "window", "ceiling", "floor", "floor-wood", "wall", "rug",
-                          "chair", "couch", "bed", "dining table", "toilet", "tv"]
+        self.expected_classes = list(SEMANTIC_CLASSES)
         self.new_class_to_idx = {c: i for i, c in enumerate(self.expected_classes)}
         self.idx_to_old_thing = {i: c for i, c in enumerate(self.metadata.thing_classes)}
         self.idx_to_old_stuff = {i: c for i, c in enumerate(self.metadata.stuff_classes)}
@@ -0,0 +1,290 @@
+"""
+Local stand-in for the Google Drive v3 service, serving the files of a directory.
+
+The ids of folders and files are their paths relative to the root, the root itself has the id "root". Media
+requests answer range requests like the Drive API, so GDriveDownloader runs unchanged against it:
+
+    downloader = GDriveDownloader(service=LocalDriveService("tests/drive", bytes_per_second=50e6))
+    folder_name, files = downloader.list_files_in_folder("captures")
+    downloader.download_file(files[0]["id"], files[0]["name"], "data/captures")
+
+Unknown ids answer with a 404, and bytes_per_second throttles media requests to a realistic download speed.
+
+LocalDriveServer serves the same directory over HTTP in the URL layout of the Drive API, for the real
+googleapiclient client, and can drop connections in the middle of a response to test resumed downloads:
+
+    with LocalDriveServer("tests/drive", fail_every=3) as server:
+        downloader = GDriveDownloader(build_service=server.service)
+        downloader.download_folder("captures", "data/captures")
+"""
+
+import hashlib
+import json
+import mimetypes
+import os
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlparse
+
+FOLDER_MIME_TYPE = "application/vnd.google-apps.folder"
+
+
+class _Response(dict):
+    """Headers and status of a response, like httplib2.Response."""
+
+    def __init__(self, status, headers=None):
+        super().__init__(headers or {})
+        self.status = status
+        self.reason = "OK" if status < 400 else "Not Found"
+
+
+class _Request:
+    def __init__(self, fn):
+        self.fn = fn
+
+    def execute(self, num_retries=0):
+        return self.fn()
+
+
+class _MediaRequest:
+    """What downloads read from a get_media request."""
+
+    def __init__(self, http, uri):
+        self.http = http
+        self.uri = uri
+        self.headers = {}
+
+
+class _LocalHttp:
+    def __init__(self, drive):
+        self.drive = drive
+
+    def request(self, uri, method="GET", body=None, headers=None, **kwargs):
+        path = self.drive.path(uri[len("local://"):])
+        if path is None or not os.path.isfile(path):
+            return _Response(404), json.dumps({"error": {"code": 404, "message": f"File not found: {uri}"}}).encode()
+        size = os.path.getsize(path)
+        match = re.match(r"bytes=(\d+)-(\d*)", (headers or {}).get("range", ""))
+        start = int(match.group(1)) if match else 0
+        end = min(int(match.group(2)) if match and match.group(2) else size - 1, size - 1)
+        if match and start >= size:
+            return _Response(416, {"content-range": f"bytes */{size}"}), b""
+        with open(path, "rb") as f:
+            f.seek(start)
+            content = f.read(max(0, end - start + 1))
+        if self.drive.bytes_per_second:
+            time.sleep(len(content) / self.drive.bytes_per_second)
+        if match is None:
+            return _Response(200, {"content-length": str(size)}), content
+        return _Response(206, {"content-range": f"bytes {start}-{start + len(content) - 1}/{size}"}), content
+
+
+class _Files:
+    def __init__(self, drive):
+        self.drive = drive
+
+    def get(self, fileId, fields=None, **kwargs):
+        return _Request(lambda: self.drive.metadata(fileId))
+
+    def list(self, q="", spaces=None, fields=None, pageToken=None, pageSize=100, **kwargs):
+        return _Request(lambda: self.drive.list(q, pageToken, pageSize))
+
+    def get_media(self, fileId, **kwargs):
+        return _MediaRequest(self.drive.http, f"local://{fileId}")
+
+
+class LocalDriveService:
+    """Serves the files below root through the subset of the Drive v3 API that GDriveDownloader uses.
+
+    Args:
+        root: Directory served as the drive.
+        bytes_per_second: Download speed of media requests, unthrottled if not set.
+    """
+
+    def __init__(self, root, bytes_per_second=None):
+        self.root = os.path.abspath(root)
+        self.bytes_per_second = bytes_per_second
+        self.http = _LocalHttp(self)
+        self._md5 = {}
+        self._lock = threading.Lock()
+
+    def files(self):
+        return _Files(self)
+
+    def path(self, file_id):
+        """Path of the id, None if it points outside the root."""
+        path = self.root if file_id == "root" else os.path.abspath(os.path.join(self.root, file_id))
+        if path != self.root and not path.startswith(self.root + os.sep):
+            return None
+        return path
+
+    def _checksum(self, path):
+        key = (path, os.path.getmtime(path), os.path.getsize(path))
+        with self._lock:
+            if key not in self._md5:
+                digest = hashlib.md5()
+                with open(path, "rb") as f:
+                    for block in iter(lambda: f.read(1 << 20), b""):
+                        digest.update(block)
+                self._md5[key] = digest.hexdigest()
+            return self._md5[key]
+
+    def metadata(self, file_id):
+        path = self.path(file_id)
+        if path is None or not os.path.exists(path):
+            raise FileNotFoundError(f"File not found: {file_id}")
+        file_id = "root" if path == self.root else os.path.relpath(path, self.root)
+        name = os.path.basename(path)
+        if os.path.isdir(path):
+            return {"id": file_id, "name": name, "mimeType": FOLDER_MIME_TYPE}
+        mime_type = "application/zip" if name.endswith(".zip") else mimetypes.guess_type(name)[0]
+        return {
+            "id": file_id,
+            "name": name,
+            "mimeType": mime_type or "application/octet-stream",
+            "size": str(os.path.getsize(path)),
+            "md5Checksum": self._checksum(path),
+        }
+
+    def list(self, q, page_token=None, page_size=100):
+        match = re.match(r"\s*'(.+)' in parents", q)
+        if match is None:
+            raise ValueError(f"Unsupported query: {q}")
+        folder = self.path(match.group(1))
+        if folder is None or not os.path.isdir(folder):
+            raise FileNotFoundError(f"Folder not found: {match.group(1)}")
+        names = sorted(os.listdir(folder))
+        start = int(page_token or 0)
+        parent = "" if folder == self.root else os.path.relpath(folder, self.root)
+        files = [self.metadata(os.path.join(parent, name)) for name in names[start : start + page_size]]
+        response = {"files": files}
+        if start + page_size < len(names):
+            response["nextPageToken"] = str(start + page_size)
+        return response
+
+
+class _DriveRequestHandler(BaseHTTPRequestHandler):
+    server_version = "LocalDrive/1.0"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        drive = self.server.drive
+        url = urlparse(self.path)
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+        prefix = "/drive/v3/files"
+        try:
+            if url.path == prefix:
+                page_size = int(query.get("pageSize", 100))
+                self._send_json(200, drive.list(query.get("q", ""), query.get("pageToken"), page_size))
+            elif url.path.startswith(prefix + "/"):
+                file_id = unquote(url.path[len(prefix) + 1 :])
+                if query.get("alt") == "media":
+                    self._send_media(file_id)
+                else:
+                    self._send_json(200, drive.metadata(file_id))
+            else:
+                self._send_json(404, {"error": {"code": 404, "message": f"Unknown path {url.path}"}})
+        except (FileNotFoundError, ValueError) as e:
+            self._send_json(404, {"error": {"code": 404, "message": str(e)}})
+
+    def _send_media(self, file_id):
+        server = self.server
+        path = server.drive.path(file_id)
+        if path is None or not os.path.isfile(path):
+            raise FileNotFoundError(f"File not found: {file_id}")
+        size = os.path.getsize(path)
+        match = re.match(r"bytes=(\d+)-(\d*)", self.headers.get("Range", ""))
+        start = int(match.group(1)) if match else 0
+        end = min(int(match.group(2)) if match and match.group(2) else size - 1, size - 1)
+        if match and start >= size:
+            self.send_response(416)
+            self.send_header("Content-Range", f"bytes */{size}")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        length = end - start + 1
+        self.send_response(206 if match else 200)
+        if match:
+            self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(length))
+        self.end_headers()
+
+        with server.lock:
+            server.media_requests += 1
+            fail = server.fail_every is not None and server.media_requests % server.fail_every == 0
+        # A failing response stops halfway and drops the connection, like a network error would
+        remaining = length // 2 if fail else length
+        with open(path, "rb") as f:
+            f.seek(start)
+            while remaining > 0:
+                block = f.read(min(remaining, 1 << 16))
+                self.wfile.write(block)
+                remaining -= len(block)
+                if server.drive.bytes_per_second:
+                    time.sleep(len(block) / server.drive.bytes_per_second)
+        if fail:
+            self.close_connection = True
+            self.wfile.flush()
+            self.connection.shutdown(2)
+
+
+class LocalDriveServer:
+    """HTTP stand-in for the Drive v3 API, serving the files below root like LocalDriveService.
+
+    Args:
+        root: Directory served as the drive.
+        bytes_per_second: Download speed of every media response, unthrottled if not set.
+        fail_every: Every fail_every-th media response is cut off halfway, none if not set.
+        port: Port to listen on, any free port if 0.
+    """
+
+    def __init__(self, root, bytes_per_second=None, fail_every=None, port=0):
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", port), _DriveRequestHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.drive = LocalDriveService(root, bytes_per_second=bytes_per_second)
+        self.httpd.fail_every = fail_every
+        self.httpd.media_requests = 0
+        self.httpd.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def service(self):
+        """A googleapiclient Drive service talking to this server, without credentials."""
+        import httplib2
+        from googleapiclient.discovery import build
+
+        return build(
+            "drive",
+            "v3",
+            http=httplib2.Http(timeout=60),
+            client_options={"api_endpoint": f"{self.url}/drive/v3/"},
+            static_discovery=True,
+        )
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
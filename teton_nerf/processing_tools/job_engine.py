@@ -0,0 +1,530 @@
+"""
+In-process job engine for the processing tools.
+
+Processing, training, rendering and exporting run as function calls in the engine's own interpreter, so the stages
+share one nerfstudio import and trained or loaded pipelines stay in memory for the renders and exports that
+follow them. Every job returns a JobResult with its status and timings instead of raising.
+
+    engine = JobEngine()
+    engine.process_data("data/room.zip", "processed_data/room")
+    trained = engine.train("processed_data/room", "outputs/room", model="teton-nerf")
+    engine.render(trained.output, "renders/room.mp4")  # reuses the pipeline that was just trained
+    engine.export(trained.output, "voxel-pointcloud", "exports/room")
+
+EngineWorker runs a JobEngine in a persistent child process, pinned to one CUDA device, and EnginePool keeps one
+of them per job that runs at the same time, spread over the devices, for callers that run several jobs at once.
+"""
+
+import multiprocessing as mp
+import os
+import queue
+import shlex
+import threading
+import time
+import traceback
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass, field
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Sequence, Union
+
+TETON_EXPORTS = ("voxel-pointcloud", "semantic-pointcloud", "density-mesh", "voxel-bake")
+# Jobs that leave their pipeline in memory on the device
+PIPELINE_JOBS = ("train", "render", "export", "evaluate")
+
+
+@dataclass
+class JobResult:
+    """Status and timings of a single job."""
+
+    kind: str
+    """process, train, render or export."""
+    name: str
+    """Dataset or config the job ran on."""
+    status: str = "running"
+    """running, succeeded or failed."""
+    started_at: str = ""
+    """Wall-clock start time, ISO format."""
+    seconds: float = 0.0
+    """Duration of the whole job."""
+    timings: Dict[str, float] = field(default_factory=dict)
+    """Duration of the steps of the job, e.g. loading the pipeline and rendering."""
+    metrics: Dict[str, float] = field(default_factory=dict)
+    """Measurements the job reports, e.g. the frames per second of a render."""
+    output: Optional[str] = None
+    """Path the job wrote, the config of the trained model for train jobs."""
+    error: Optional[str] = None
+    """Traceback of the exception if the job failed."""
+    pid: int = 0
+    """Process the job ran in."""
+
+    @property
+    def ok(self) -> bool:
+        return self.status == "succeeded"
+
+    def to_dict(self) -> Dict[str, Any]:
+        return asdict(self)
+
+
+class JobEngine:
+    """Runs the processing stages in-process and keeps the most recently used pipelines in memory.
+
+    Jobs from several threads are safe, but pipelines are shared, so a render and an export of the same config
+    should not run at the same time.
+
+    Args:
+        max_warm_pipelines: Number of loaded pipelines kept in memory between jobs.
+        vis: Logger of training runs.
+    """
+
+    def __init__(self, max_warm_pipelines: int = 1, vis: str = "wandb"):
+        self.max_warm_pipelines = max_warm_pipelines
+        self.vis = vis
+        self.results: List[JobResult] = []
+        self._pipelines = OrderedDict()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def __getstate__(self):
+        # A copy sent to another process starts without pipelines and results
+        return {"max_warm_pipelines": self.max_warm_pipelines, "vis": self.vis}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def _run(self, kind: str, name: str, job: Callable[[], Optional[Union[str, Path]]]) -> JobResult:
+        result = JobResult(kind=kind, name=str(name), started_at=datetime.now().isoformat(timespec="seconds"))
+        result.pid = os.getpid()
+        with self._lock:
+            self.results.append(result)
+        self._local.result = result
+        start = time.perf_counter()
+        try:
+            output = job()
+            result.output = str(output) if output is not None else None
+            result.status = "succeeded"
+        except Exception:
+            result.error = traceback.format_exc()
+            result.status = "failed"
+        finally:
+            result.seconds = time.perf_counter() - start
+            self._local.result = None
+        print(f"{kind} {name}: {result.status} in {result.seconds:.1f}s")
+        return result
+
+    @contextmanager
+    def _timed(self, step: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            result = getattr(self._local, "result", None)
+            if result is not None:
+                result.timings[step] = result.timings.get(step, 0.0) + time.perf_counter() - start
+
+    def _keep_warm(self, config: Path, pipeline) -> None:
+        with self._lock:
+            self._pipelines[config.resolve()] = pipeline
+            self._pipelines.move_to_end(config.resolve())
+            while len(self._pipelines) > self.max_warm_pipelines:
+                self._pipelines.popitem(last=False)
+        self._free_device_memory()
+
+    @staticmethod
+    def _close_event_writers() -> None:
+        """Closes the writers a trainer set up. They are module globals, later runs of this process would log
+        through them as well, e.g. twice to wandb or into the event files of the first run."""
+        import sys
+
+        from nerfstudio.utils import writer
+
+        for event_writer in writer.EVENT_WRITERS:
+            tb_writer = getattr(event_writer, "tb_writer", None)
+            if tb_writer is not None:
+                tb_writer.close()
+        writer.EVENT_WRITERS.clear()
+        writer.EVENT_STORAGE.clear()
+        if "wandb" in sys.modules and sys.modules["wandb"].run is not None:
+            sys.modules["wandb"].finish()
+
+    @staticmethod
+    def _free_device_memory() -> None:
+        import torch
+
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+    def load_pipeline(self, config: Union[str, Path]):
+        """Pipeline of the config in eval mode, loaded from its latest checkpoint unless it is still in memory."""
+        from nerfstudio.utils.eval_utils import eval_setup
+
+        config = Path(config)
+        with self._lock:
+            pipeline = self._pipelines.get(config.resolve())
+            if pipeline is not None:
+                self._pipelines.move_to_end(config.resolve())
+        if pipeline is None:
+            with self._timed("load_pipeline"):
+                _, pipeline, _, _ = eval_setup(config, test_mode="test")
+            self._keep_warm(config, pipeline)
+        pipeline.eval()
+        return pipeline
+
+    def release(self, config: Optional[Union[str, Path]] = None) -> None:
+        """Drops the pipeline of the config from memory, all pipelines if no config is given."""
+        with self._lock:
+            if config is None:
+                self._pipelines.clear()
+            else:
+                self._pipelines.pop(Path(config).resolve(), None)
+        self._free_device_memory()
+
+    def process_data(self, path: Union[str, Path], output: Union[str, Path], options: str = "") -> JobResult:
+        """Processes a Polycam capture, a folder or zip, with ProcessPolycamConfidence."""
+
+        def job():
+            import tyro
+
+            from teton_nerf.process_data.process_polycam import Commands
+
+            args = ["polycam", "--data", str(path), "--output-dir", str(output), *shlex.split(options)]
+            with self._timed("process"):
+                tyro.cli(Commands, args=args).main()
+            return output
+
+        return self._run("process", Path(path).name, job)
+
+    def train(
+        self, path: Union[str, Path], output: Union[str, Path], options: str = "", model: str = "teton-nerf"
+    ) -> JobResult:
+        """Trains a model on the processed dataset, the output of the result is the config of the run.
+
+        The trained pipeline stays in memory, so renders and exports of the run do not load the checkpoint.
+        """
+
+        def job():
+            import tyro
+
+            from nerfstudio.configs.method_configs import AnnotatedBaseConfigUnion
+            from nerfstudio.scripts.train import _set_random_seed
+
+            args = [
+                model,
+                "--data",
+                str(path),
+                "--output-dir",
+                str(output),
+                "--viewer.quit-on-train-completion",
+                "True",
+                "--logging.local-writer.enable",
+                "False",
+                "--vis",
+                self.vis,
+                *shlex.split(options),
+            ]
+            config = tyro.cli(AnnotatedBaseConfigUnion, args=args)
+            if config.data:
+                config.pipeline.datamanager.data = config.data
+            config.set_timestamp()
+            config.save_config()
+            config_path = config.get_base_dir() / "config.yml"
+
+            try:
+                with self._timed("setup"):
+                    _set_random_seed(config.machine.seed)
+                    trainer = config.setup(local_rank=0, world_size=1)
+                    trainer.setup()
+                with self._timed("train"):
+                    trainer.train()
+            finally:
+                self._close_event_writers()
+            trainer.pipeline.eval()
+            self._keep_warm(config_path, trainer.pipeline)
+            return config_path
+
+        return self._run("train", Path(path).name, job)
+
+    def render(
+        self,
+        checkpoint: Union[str, Path],
+        output_path: Union[str, Path],
+        rendered_output_names: Sequence[str] = ("rgb",),
+        fps: float = 24,
+    ) -> JobResult:
+        """Renders the eval cameras of the config to a video, or to images if output_path has no .mp4 suffix."""
+
+        def job():
+            from teton_nerf.utils.streaming_render import render_trajectory_streaming
+
+            pipeline = self.load_pipeline(checkpoint)
+            cameras = pipeline.datamanager.eval_dataset.cameras
+            output = Path(output_path)
+            output.parent.mkdir(parents=True, exist_ok=True)
+            with self._timed("render"):
+                stats = render_trajectory_streaming(
+                    pipeline,
+                    cameras,
+                    output_filename=output,
+                    rendered_output_names=list(rendered_output_names),
+                    fps=fps,
+                    output_format="video" if output.suffix == ".mp4" else "images",
+                )
+            self._local.result.metrics.update(stats)
+            return output
+
+        return self._run("render", str(checkpoint), job)
+
+    def export(
+        self, checkpoint: Union[str, Path], type: str, output_dir: Union[str, Path], options: str = ""
+    ) -> JobResult:
+        """Exports with the Teton exporter for its export types, which reuse a pipeline kept in memory, or with the
+        nerfstudio exporter otherwise."""
+
+        def job():
+            import tyro
+
+            args = [type, "--load-config", str(checkpoint), "--output-dir", str(output_dir), *shlex.split(options)]
+            if type in TETON_EXPORTS:
+                from teton_nerf.teton_exporter import Commands
+
+                exporter = tyro.cli(Commands, args=args)
+                pipeline = self.load_pipeline(checkpoint)
+                with self._timed("export"):
+                    exporter.export(pipeline)
+            else:
+                from nerfstudio.scripts.exporter import Commands
+
+                if type == "pointcloud":
+                    args += ["--normal-method", "open3d"]
+                with self._timed("export"):
+                    tyro.cli(Commands, args=args).main()
+            return output_dir
+
+        return self._run("export", str(checkpoint), job)
+
+    def evaluate(self, checkpoint: Union[str, Path]) -> JobResult:
+        """Averages the image metrics of the eval images, e.g. psnr, ssim and lpips, into the metrics of the result."""
+
+        def job():
+            pipeline = self.load_pipeline(checkpoint)
+            with self._timed("evaluate"):
+                metrics = pipeline.get_average_eval_image_metrics()
+            self._local.result.metrics.update({name: float(value) for name, value in metrics.items()})
+            return checkpoint
+
+        return self._run("evaluate", str(checkpoint), job)
+
+    def warm_dataset(self, path: Union[str, Path], splits: Sequence[str] = ("train", "val", "test")) -> JobResult:
+        """Loads every split of the processed dataset once, which writes the monocular depth caches next to its
+        images. Runs that start afterwards read the caches instead of all computing them at once."""
+
+        def job():
+            from teton_nerf.teton_dataparser import TetonDataparserConfig
+            from teton_nerf.teton_dataset import TetonNerfDataset
+
+            dataparser = TetonDataparserConfig(data=Path(path)).setup()
+            for split in splits:
+                with self._timed(split):
+                    TetonNerfDataset(dataparser.get_dataparser_outputs(split=split), use_monocular_depth=True)
+            return path
+
+        return self._run("warm", Path(path).name, job)
+
+    def summary(self) -> None:
+        """Prints the status and timings of all jobs run so far."""
+        for result in self.results:
+            steps = ", ".join(f"{step} {seconds:.1f}" for step, seconds in result.timings.items())
+            print(f"{result.kind:>8} {result.name:<32} {result.status:<10} {result.seconds:8.1f}s  {steps}")
+
+
+def _cuda_devices() -> List[str]:
+    """CUDA devices this process may use, as CUDA_VISIBLE_DEVICES entries."""
+    visible = os.environ.get("CUDA_VISIBLE_DEVICES")
+    if visible is not None:
+        return [device.strip() for device in visible.split(",") if device.strip()]
+    try:
+        import torch
+
+        return [str(index) for index in range(torch.cuda.device_count())]
+    except ImportError:
+        return []
+
+
+def _serve(jobs, results, max_warm_pipelines: int, vis: str, device: Optional[str]) -> None:
+    # Before anything initializes CUDA, so cuda:0 of the worker is its device
+    if device is not None:
+        os.environ["CUDA_VISIBLE_DEVICES"] = device
+    engine = JobEngine(max_warm_pipelines=max_warm_pipelines, vis=vis)
+    for kind, args, kwargs in iter(jobs.get, None):
+        results.put(getattr(engine, kind)(*args, **kwargs))
+
+
+class EngineWorker:
+    """JobEngine in a persistent child process, which keeps its pipelines in memory between jobs.
+
+    Has the job methods of JobEngine, jobs of a worker run one at a time. The child is spawned rather than forked,
+    so it can use CUDA.
+
+    Args:
+        max_warm_pipelines: Number of loaded pipelines kept in memory between jobs.
+        vis: Logger of training runs.
+        device: CUDA_VISIBLE_DEVICES entry of the only device the worker uses, all devices if not set.
+    """
+
+    def __init__(self, max_warm_pipelines: int = 1, vis: str = "wandb", device: Optional[str] = None):
+        context = mp.get_context("spawn")
+        self.device = device
+        self._jobs = context.Queue()
+        self._results = context.Queue()
+        # Not a daemon, training spawns dataloader workers of its own
+        self.process = context.Process(
+            target=_serve, args=(self._jobs, self._results, max_warm_pipelines, vis, device)
+        )
+        self.process.start()
+        self._lock = threading.Lock()
+
+    def submit(self, kind: str, *args, **kwargs) -> JobResult:
+        """Runs JobEngine.<kind>(*args, **kwargs) in the worker and waits for its result."""
+        with self._lock:
+            self._jobs.put((kind, args, kwargs))
+            while True:
+                try:
+                    return self._results.get(timeout=1.0)
+                except queue.Empty:
+                    if not self.process.is_alive():
+                        name = str(args[0]) if args else kind
+                        error = f"Worker exited with code {self.process.exitcode}"
+                        return JobResult(kind=kind, name=name, status="failed", error=error, pid=self.process.pid)
+
+    def process_data(self, *args, **kwargs) -> JobResult:
+        return self.submit("process_data", *args, **kwargs)
+
+    def train(self, *args, **kwargs) -> JobResult:
+        return self.submit("train", *args, **kwargs)
+
+    def render(self, *args, **kwargs) -> JobResult:
+        return self.submit("render", *args, **kwargs)
+
+    def export(self, *args, **kwargs) -> JobResult:
+        return self.submit("export", *args, **kwargs)
+
+    def evaluate(self, *args, **kwargs) -> JobResult:
+        return self.submit("evaluate", *args, **kwargs)
+
+    def warm_dataset(self, *args, **kwargs) -> JobResult:
+        return self.submit("warm_dataset", *args, **kwargs)
+
+    def release(self, *args, **kwargs) -> None:
+        return self.submit("release", *args, **kwargs)
+
+    def close(self) -> None:
+        if self.process.is_alive():
+            self._jobs.put(None)
+        self.process.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class EnginePool:
+    """EngineWorkers for jobs that run at once, started as they are needed and kept for the following jobs.
+
+    Every worker is pinned to one CUDA device, and jobs go to the device with the fewest busy workers. Among its
+    idle workers, jobs go to the one that last ran a job with the same key, e.g. the dataset, so a render after
+    training finds the trained pipeline still in memory. Idle workers drop the pipelines they keep in memory while
+    another worker runs a job on their device.
+
+    Args:
+        max_warm_pipelines: Number of loaded pipelines every worker keeps in memory between jobs.
+        vis: Logger of training runs.
+        devices: CUDA_VISIBLE_DEVICES entries the workers are spread over, all visible devices if not set.
+    """
+
+    def __init__(self, max_warm_pipelines: int = 1, vis: str = "wandb", devices: Optional[Sequence[str]] = None):
+        self.max_warm_pipelines = max_warm_pipelines
+        self.vis = vis
+        self.devices = list(devices) if devices is not None else _cuda_devices()
+        self._idle: List[EngineWorker] = []
+        self._last_key: Dict[int, str] = {}
+        self._warm = set()
+        self._releasing = set()
+        self._workers: List[EngineWorker] = []
+        self._lock = threading.Lock()
+
+    def _busy_devices(self) -> Counter:
+        idle = {id(worker) for worker in self._idle} | self._releasing
+        return Counter(worker.device for worker in self._workers if id(worker) not in idle)
+
+    def _release_idle(self, device: Optional[str]) -> None:
+        """Drops the pipelines of the idle workers on the device, which a busy worker needs the memory of."""
+        with self._lock:
+            warm = [worker for worker in self._idle if worker.device == device and id(worker) in self._warm]
+            for worker in warm:
+                self._idle.remove(worker)
+                self._releasing.add(id(worker))
+        for worker in warm:
+            worker.release()
+            with self._lock:
+                self._warm.discard(id(worker))
+                self._releasing.discard(id(worker))
+                self._idle.append(worker)
+
+    def _acquire(self, key: str) -> EngineWorker:
+        with self._lock:
+            self._idle = [worker for worker in self._idle if worker.process.is_alive()]
+            self._workers = [worker for worker in self._workers if worker.process.is_alive()]
+            device = None
+            if self.devices:
+                busy = self._busy_devices()
+                least_busy = min(busy[device] for device in self.devices)
+                devices = [device for device in self.devices if busy[device] == least_busy]
+                # Among the least busy devices, the one whose idle worker may still hold the pipeline of the key
+                keyed = [worker.device for worker in self._idle if self._last_key.get(id(worker)) == key]
+                device = next((device for device in keyed if device in devices), devices[0])
+            candidates = [worker for worker in self._idle if worker.device == device]
+            for worker in candidates:
+                if self._last_key.get(id(worker)) == key:
+                    break
+            else:
+                worker = candidates[-1] if candidates else None
+            if worker is not None:
+                self._idle.remove(worker)
+            else:
+                # Under the lock, so jobs that start at the same time count it as busy on its device
+                worker = EngineWorker(self.max_warm_pipelines, self.vis, device)
+                self._workers.append(worker)
+        if device is not None:
+            self._release_idle(device)
+        return worker
+
+    def run(self, key: str, kind: str, *args, **kwargs) -> JobResult:
+        """Runs JobEngine.<kind>(*args, **kwargs) in an idle worker on the least busy device, preferably one that
+        ran the key before."""
+        worker = self._acquire(key)
+        try:
+            return worker.submit(kind, *args, **kwargs)
+        finally:
+            with self._lock:
+                self._last_key[id(worker)] = key
+                if kind in PIPELINE_JOBS:
+                    self._warm.add(id(worker))
+                self._idle.append(worker)
+                pressure = worker.device is not None and self._busy_devices()[worker.device] > 0
+            if pressure:
+                self._release_idle(worker.device)
+
+    def close(self) -> None:
+        for worker in self._workers:
+            worker.close()
+        self._workers.clear()
+        self._idle.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
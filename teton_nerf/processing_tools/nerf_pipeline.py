@@ -1,61 +1,175 @@
 import os
 import click
 from download_gdrive import GDriveDownloader
+from fake_drive import LocalDriveService
 from nerf_process import NeRFProcess
+from job_engine import EnginePool
+from run_registry import RunRegistry
+from scheduler import STAGE_COSTS, Resources, Scheduler
 import multiprocessing as mp
-from multiprocessing import Pool
 from detectron import SemanticSegmentor
 
+
+def dataset_name(filename):
+    """Name of the dataset of a Polycam archive or folder, the file name without the .zip suffix."""
+    filename = os.path.basename(filename)
+    return filename[: -len(".zip")] if filename.endswith(".zip") else filename
+
+
 class NeRFStudioPipeline:
-    def __init__(self, train, name, options, global_env="~/miniconda3/envs/nerfstudio/bin/python"):
-        self.downloader = GDriveDownloader()
-        self.nerf_process = NeRFProcess(global_env)
+    def __init__(self, train, name, options, capacity=None, retries=1, engines=None, downloader=None, registry=None, force=False, adopt_existing=False):
+        self.downloader = downloader if downloader is not None else GDriveDownloader()
+        self.nerf_process = NeRFProcess()
+        # Persistent workers, so renders and exports find the pipelines their dataset trained still in memory
+        self.engines = engines if engines is not None else EnginePool()
+        self.capacity = capacity if capacity is not None else Resources.detect()
+        self.retries = retries
         self.options = options
         self.train = train
         self.name = name
         self.Detectron = SemanticSegmentor()
+        # Stages whose inputs and config did not change since their last successful run are skipped
+        self.registry = registry if registry is not None else RunRegistry()
+        self.force = force
+        # Finished training runs already on disk count as up to date with the current options in a new registry
+        self.adopt_existing = adopt_existing
 
     def process_and_train(self, local_zip_path, checkpoint_output, model):
-        processed_output = "processed_data/" + os.path.basename(local_zip_path).strip(".zip")
-        
-        if not os.path.exists(processed_output):
-            self.nerf_process.process_data(local_zip_path, processed_output)
-        else:
-            print(f"Processed data already exists for {os.path.basename(local_zip_path)}")
-
+        name = dataset_name(local_zip_path)
+        processed_output = self.process(name, local_zip_path)
         if self.train:
             print(f"Training model {checkpoint_output}")
             try:
-                self.nerf_process.train(processed_output, checkpoint_output, options=self.options, model=model)
+                self.train_model(name, processed_output, checkpoint_output, model)
             except Exception as e:
                 print(f"Error: {e}")
 
-    def train_raw_data(self, model):
+    def run_job(self, key, kind, *args, **kwargs):
+        result = self.engines.run(key, kind, *args, **kwargs)
+        self.nerf_process.assert_process(result)
+        return result
+
+    def process(self, name, zip_path):
+        processed_output = "processed_data/" + name
+        job = lambda: self.run_job(name, "process_data", zip_path, processed_output)
+        return self.registry.run(name, "process", job, [zip_path], {"processor": "polycam"}, force=self.force)
+
+    def train_model(self, name, processed_output, checkpoint_output, model):
+        job = lambda: self.run_job(name, "train", processed_output, checkpoint_output, options=self.options, model=model)
+        config = {"model": model, "options": self.options, "output": checkpoint_output}
+        # The processing run, not the processed files, training writes the depth caches into them
+        inputs = [self.registry.stage_input(name, "process") or processed_output]
+        existing = None
+        if self.adopt_existing:
+            existing = lambda: self.nerf_process.find_trained_config(os.path.join(checkpoint_output, name, model))
+        return self.registry.run(name, "train", job, inputs, config, force=self.force, existing=existing)
+
+    def schedule_dataset(self, scheduler, name, zip_path, checkpoint_output, model, download=None, render=False, export_mode=None):
+        """Adds the download, process, train, render and export tasks of a dataset.
+
+        Tasks whose stage is up to date in the registry finish right away, returning the output of the last run.
+        """
+        deps = []
+        if download is not None:
+            deps = [scheduler.add(f"{name}/download", "download", download, STAGE_COSTS["download"])]
+
+        process = lambda: self.process(name, zip_path)
+        process_task = scheduler.add(f"{name}/process", "process", process, STAGE_COSTS["process"], deps)
+
+        if self.train:
+            print(f"Training model {checkpoint_output}")
+            train = lambda: self.train_model(name, scheduler.tasks[process_task].result, checkpoint_output, model)
+            train_task = scheduler.add(f"{name}/train", "train", train, STAGE_COSTS["train"], [process_task])
+            config = lambda: scheduler.tasks[train_task].result
+            self.schedule_outputs(scheduler, name, config, model, render, export_mode, [train_task])
+        elif render or export_mode is not None:
+            # Not training, render and export the model trained on the dataset before, if there is one
+            config = self.nerf_process.find_config(os.path.join(checkpoint_output, name, model))
+            if config:
+                self.schedule_outputs(scheduler, name, lambda: config, model, render, export_mode, [process_task])
+
+    def schedule_outputs(self, scheduler, name, config, model, render, export_mode, deps=()):
+        """Adds the render and export tasks of a dataset, config is a function returning the path of its config."""
+        output_name = f"renders/{name}_{model}"
+        output_dir = f"exports/{name}"
+        # The config and the checkpoints next to it
+        inputs = lambda: [config(), os.path.join(os.path.dirname(config()), "nerfstudio_models")]
+
+        if render:
+            render_job = lambda: self.run_job(name, "render", config(), output_name)
+            tracked = lambda: self.registry.run(
+                name, "render", render_job, inputs(), {"output": output_name}, force=self.force
+            )
+            scheduler.add(f"{name}/render", "render", tracked, STAGE_COSTS["render"], deps)
+
+        if export_mode is not None:
+            export_job = lambda: self.run_job(name, "export", config(), export_mode, output_dir)
+            export_config = {"type": export_mode, "output": output_dir}
+            tracked = lambda: self.registry.run(
+                name, "export", export_job, inputs(), export_config, force=self.force
+            )
+            scheduler.add(f"{name}/export", "export", tracked, STAGE_COSTS["export"], deps)
+
+    def run(self, scheduler):
+        """Runs the scheduled tasks and reports, per dataset, the stage that failed and its error."""
+        scheduler.run()
+        scheduler.summary()
+        report = {}
+        for task in scheduler.tasks.values():
+            dataset = task.name.rsplit("/", 1)[0]
+            if task.status == "failed" or dataset not in report:
+                report[dataset] = task
+        failed = {dataset: task for dataset, task in report.items() if task.status == "failed"}
+        for dataset, task in failed.items():
+            error = task.error.strip().splitlines()[-1] if task.error else "unknown error"
+            print(f"Dataset {dataset} failed at {task.stage} after {task.attempts} attempts: {error}")
+        print(f"{len(report) - len(failed)} of {len(report)} datasets done")
+        print("Timing history per stage:")
+        self.registry.history()
+        return {dataset: ("failed" if dataset in failed else "succeeded") for dataset in report}
+
+    def train_raw_data(self, model, render=False, export_mode=None):
         raw_data_path = "data/"
         dataset_names = [name for name in os.listdir(raw_data_path)]
-        with Pool(4) as pool:  # Limit the number of processes to 8
-            results = [pool.apply_async(self.process_and_train, args=(f"{raw_data_path}{name}", f"outputs/{name.strip('.zip')}", model)) for name in dataset_names]
-            for result in results:
-                result.get()
-            pool.close()
-            pool.join()
-
-    def download_and_train(self, folder_id, model):
+        scheduler = Scheduler(self.capacity, retries=self.retries)
+        for name in dataset_names:
+            self.schedule_dataset(
+                scheduler, dataset_name(name), f"{raw_data_path}{name}", f"outputs/{dataset_name(name)}", model,
+                render=render, export_mode=export_mode,
+            )
+        self.run(scheduler)
+
+    def download_and_train(self, folder_id, model, render=False, export_mode=None):
         folder_name, datasets = self.downloader.list_files_in_folder(folder_id)
         checkpoint_output = f"outputs/{folder_name}"
-        with Pool(4) as pool:  # Limit the number of processes to 8
-            for dataset in datasets:
-                if dataset["mimeType"] in ["application/zip", "application/zip-x-compressed"]:
-                    print(f"Processing dataset: {dataset['name']}")
-                    folder_path = f"data/{folder_name}"
-                    local_zip_path = os.path.join(folder_path, dataset["name"])
-                    if not os.path.exists(local_zip_path):
-                        local_zip_path = self.downloader.download_file(dataset["id"], dataset["name"], folder_path)
-                    else:
-                        print(f"Dataset {dataset['name']} already downloaded.")
-                    pool.apply_async(self.process_and_train, args=(local_zip_path, checkpoint_output, model))
-            pool.close()
-            pool.join()
+        scheduler = Scheduler(self.capacity, retries=self.retries)
+        for dataset in datasets:
+            if dataset["mimeType"] in ["application/zip", "application/zip-x-compressed"]:
+                print(f"Processing dataset: {dataset['name']}")
+                folder_path = f"data/{folder_name}"
+                local_zip_path = os.path.join(folder_path, dataset["name"])
+                # Drive metadata as the input, a changed archive has a new checksum
+                metadata = {key: dataset.get(key) for key in ("id", "size", "md5Checksum")}
+                job = lambda dataset=dataset, folder_path=folder_path: self.downloader.download_file(
+                    dataset["id"], dataset["name"], folder_path
+                )
+                # An archive downloaded before the registry counts if it matches the Drive checksum
+                existing = lambda path=local_zip_path, md5=metadata["md5Checksum"]: (
+                    path if os.path.exists(path) and self.registry.file_md5(path) == md5 else None
+                )
+                download = lambda name=dataset_name(dataset["name"]), job=job, metadata=metadata, existing=existing: (
+                    self.registry.run(name, "download", job, [metadata], {}, force=self.force, existing=existing)
+                )
+                self.schedule_dataset(
+                    scheduler, dataset_name(dataset["name"]), local_zip_path, checkpoint_output, model,
+                    download=download, render=render, export_mode=export_mode,
+                )
+        self.run(scheduler)
+        downloads = [task for task in scheduler.tasks.values() if task.stage == "download" and task.finished is not None]
+        if downloads:
+            # Throughput over the span in which the downloads ran, they overlap with each other and with processing
+            seconds = max(task.finished for task in downloads) - min(task.started for task in downloads)
+            self.downloader.report(seconds=seconds)
         print("All models trained successfully")
         return checkpoint_output
 
@@ -65,32 +179,14 @@ class NeRFStudioPipeline:
 
         print("Found datasets:")
         print(dataset_names)
-        
-        configs = []
-        for ckp in checkpoints:
+
+        scheduler = Scheduler(self.capacity, retries=self.retries)
+        for name, ckp in zip(dataset_names, checkpoints):
             config = self.nerf_process.find_config(os.path.join(ckp, model))
             if config:
-                configs.append(config)
-
-        with Pool(4) as pool:
-            for name, config in zip(dataset_names, configs):
-                output_name = f"renders/{name}_{model}"
-                output_dir = f"exports/{name}"
-                
-                if do_render and not os.path.exists(output_name):
-                    pool.apply_async(self.nerf_process.render, args=(config, output_name))
-                elif do_render:
-                    print(f"Dataset already rendered for {name}")
-                
-                if export_mode is not None and not os.path.exists(output_dir):
-                    print(f"Exporting to {output_dir}")
-                    pool.apply_async(self.nerf_process.export, args=(config, export_mode, output_dir))
-                elif export_mode is not None:
-                    print(f"Data already exported for {name}")
-
-            pool.close()
-            pool.join()
-            
+                self.schedule_outputs(scheduler, name, lambda config=config: config, model, do_render, export_mode)
+        self.run(scheduler)
+
 
 @click.command()
 @click.option("--model", default="semantic-depth-nerfacto", help="The type of model to train, see Nerfstudio docs for options")
@@ -102,23 +198,44 @@ class NeRFStudioPipeline:
 @click.option("--export", default=None, help="Export pointclouds from the trained models.")
 @click.option("--name", default="", help="A name to append to the naming of models in order to distinguish runs with different settings")
 @click.option("--option", multiple=True, help="A way to pass options to the config classes in Nerfstudio")
-def main(model, folder_id, checkpoints, data, no_train, render, export, name, option):
+@click.option("--cpus", type=float, default=None, help="CPU cores the jobs may use at once, all cores if not set")
+@click.option("--memory-gb", type=float, default=None, help="Memory the jobs may use at once, all memory if not set")
+@click.option("--gpus", type=float, default=None, help="Accelerator slots, all CUDA devices if not set")
+@click.option("--retries", default=1, help="Number of times a failed job is run again")
+@click.option("--max-downloads", default=4, help="Number of archives downloaded at once")
+@click.option("--fake-drive", default=None, help="Serve the folders of this directory instead of Google Drive, for testing")
+@click.option("--registry", default="runs.sqlite", help="Database of the stages run, stages that are up to date are skipped")
+@click.option("--force", is_flag=True, help="Run every stage, also the ones that are up to date")
+@click.option("--adopt-existing", is_flag=True, help="Count finished training runs on disk, made with the current options, as up to date in a new registry")
+def main(model, folder_id, checkpoints, data, no_train, render, export, name, option, cpus, memory_gb, gpus, retries, max_downloads, fake_drive, registry, force, adopt_existing):
     mp.set_start_method('spawn')
     train = not no_train
     print(f"Training set to {train}")
     options = " ".join(option)
-    pipeline = NeRFStudioPipeline(train, name, options)
-    if folder_id:
-        checkpoint_folder = pipeline.download_and_train(folder_id, model)
-    elif checkpoints:
-        checkpoint_folder = checkpoints
-    elif data:
-        pipeline.train_raw_data(model)
-    else:
-        raise ValueError("Either an id for dataset download or a checkpoints folder must be provided.")
-    
-    if render or export:
-        pipeline.render_and_export(checkpoint_folder, export, model, render)
+    detected = Resources.detect()
+    capacity = Resources(
+        cpus=cpus if cpus is not None else detected.cpus,
+        memory_gb=memory_gb if memory_gb is not None else detected.memory_gb,
+        gpus=gpus if gpus is not None else detected.gpus,
+        io=max_downloads,
+    )
+    downloader = GDriveDownloader(service=LocalDriveService(fake_drive)) if fake_drive else None
+    pipeline = NeRFStudioPipeline(
+        train, name, options, capacity=capacity, retries=retries, downloader=downloader,
+        registry=RunRegistry(registry), force=force, adopt_existing=adopt_existing,
+    )
+    try:
+        # Renders and exports of trained datasets are part of the same DAG, they start as soon as their model is done
+        if folder_id:
+            pipeline.download_and_train(folder_id, model, render=render, export_mode=export)
+        elif checkpoints:
+            pipeline.render_and_export(checkpoints, export, model, render)
+        elif data:
+            pipeline.train_raw_data(model, render=render, export_mode=export)
+        else:
+            raise ValueError("Either an id for dataset download or a checkpoints folder must be provided.")
+    finally:
+        pipeline.engines.close()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
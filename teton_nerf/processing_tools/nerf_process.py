@@ -1,41 +1,36 @@
 import os
-import subprocess
-from multiprocessing import Pool
+import re
+from concurrent.futures import ThreadPoolExecutor
 import click
 from download_gdrive import GDriveDownloader
+from job_engine import EnginePool, JobEngine
 
 
 class NeRFProcess:
-    def __init__(self, global_env):
-        self.global_env = global_env
+    """Runs the stages with a JobEngine, in this process, or in a persistent worker if an EngineWorker is given."""
+
+    def __init__(self, engine=None):
+        self.engine = engine if engine is not None else JobEngine()
 
     def process_data(self, path: str, output: str):
-        # process_path ="~/Desktop/Bachelorprojekt/nerfstudio/nerfstudio/scripts/process_data.py"
-        process_path = "~/Desktop/Bachelorprojekt/nerfstudio/teton_nerf/teton_nerf/process_data/process_polycam.py"
-        process = subprocess.run([f"{self.global_env} {process_path} polycam --data {path} --output_dir {output}"], shell=True)
-        self.assert_process(process)
-        return process
+        result = self.engine.process_data(path, output)
+        self.assert_process(result)
+        return result
 
     def train(self, path: str, output: str, options: str, model: str):
-        train_path = "~/Desktop/Bachelorprojekt/nerfstudio/nerfstudio/scripts/train.py"
-        process = subprocess.run([f"{self.global_env} {train_path} {model} --data {path} --output-dir {output} --viewer.quit-on-train-completion True --logging.local-writer.enable False --vis wandb{' ' if options else ''}{options}"], shell=True)
-        self.assert_process(process)
-        return process
+        result = self.engine.train(path, output, options=options, model=model)
+        self.assert_process(result)
+        return result
 
     def render(self, checkpoint: str, output_path: str):
-        render_path = "~/Desktop/Bachelorprojekt/nerfstudio/nerfstudio/scripts/render.py"
-        process = subprocess.run([f"{self.global_env} {render_path} dataset --load-config {checkpoint} --output-path {output_path} --split test"], shell=True)
-        self.assert_process(process)
-        return process
-    
+        result = self.engine.render(checkpoint, output_path)
+        self.assert_process(result)
+        return result
+
     def export(self, checkpoint: str, type: str, output_dir: str):
-        export_path = "~/Desktop/Bachelorprojekt/nerfstudio/nerfstudio/scripts/exporter.py"
-        if type == "pointcloud":
-            process = subprocess.run([f"{self.global_env} {export_path} {type} --load-config {checkpoint} --output-dir {output_dir} --normal-method open3d"])
-        else:
-            process = subprocess.run([f"{self.global_env} {export_path} {type} --load-config {checkpoint} --output-dir {output_dir}"])
-        self.assert_process(process)
-        return process
+        result = self.engine.export(checkpoint, type, output_dir)
+        self.assert_process(result)
+        return result
 
     def find_config(self, checkpoint_path: str):
         for root, dirs, files in os.walk(checkpoint_path):
@@ -43,59 +38,85 @@ class NeRFProcess:
                 if file.endswith(".yml"):
                     return os.path.join(root, file)
         return None  # Return None if no config file is found
+
+    def find_trained_config(self, checkpoint_path: str):
+        """Config of a run under checkpoint_path that saved the checkpoint of its last iteration, or None.
+
+        Training writes its config before it starts, so a config alone does not mean the run finished.
+        """
+        for root, dirs, files in os.walk(checkpoint_path):
+            if "config.yml" not in files:
+                continue
+            with open(os.path.join(root, "config.yml")) as f:
+                match = re.search(r"^max_num_iterations: (\d+)$", f.read(), re.MULTILINE)
+            models = os.path.join(root, "nerfstudio_models")
+            if match is None or not os.path.isdir(models):
+                continue
+            steps = [int(name[5:-5]) for name in os.listdir(models) if re.fullmatch(r"step-\d+\.ckpt", name)]
+            if steps and max(steps) >= int(match.group(1)) - 1:
+                return os.path.join(root, "config.yml")
+        return None
     
-    def assert_process(self, process):
-        if process.returncode != 0:
-            # The subprocess failed; print the error
-            print(f"Error: {process.stderr}")
+    def assert_process(self, result):
+        if not result.ok:
+            # The job failed; print the error
+            print(f"Error: {result.error}")
         else:
-            # The subprocess succeeded; print the output
-            print(f"Output: {process.stdout}")
+            # The job succeeded; print the output and timings
+            timings = ", ".join(f"{step} {seconds:.1f}s" for step, seconds in result.timings.items())
+            print(f"Output: {result.output} ({timings})")
+
+
+def process_train_and_render(engines, nerf_process, downloader, dataset, checkpoint_output, model):
+    """Downloads, processes, trains and renders one dataset. Its jobs go to the same worker, so the render finds
+    the trained pipeline still in memory. Returns the result of the last job that ran."""
+    name = os.path.splitext(dataset["name"])[0]
+    local_zip_path = downloader.download_file(dataset["id"], dataset["name"], "data")
+    processed_output = f"processed_data/{name}"
+    result = engines.run(name, "process_data", local_zip_path, processed_output)
+    nerf_process.assert_process(result)
+    if result.ok:
+        result = engines.run(name, "train", processed_output, checkpoint_output, model=model)
+        nerf_process.assert_process(result)
+    if result.ok:
+        result = engines.run(name, "render", result.output, f"renders/{name}.mp4")
+        nerf_process.assert_process(result)
+    return result
 
 
 @click.command()
 @click.option("--model", default="nerfacto", help="The type of model to train, see Nerfstudio docs for options")
 @click.option("--id", help="The id of the folder containing the dataset we want to train on.")
-def main(model, id):
-    global_env = "~/miniconda3/envs/nerfstudio/bin/python"
+@click.option("--jobs", default=1, help="Number of datasets processed, trained and rendered at once")
+def main(model, id, jobs):
     downloader = GDriveDownloader()
-    nerf_process = NeRFProcess(global_env)
+    nerf_process = NeRFProcess()
     folder_name, datasets = downloader.list_files_in_folder(id)
     checkpoint_output = f"outputs/{folder_name}"
+    datasets = [
+        dataset for dataset in datasets if dataset["mimeType"] in ("application/zip", "application/zip-x-compressed")
+    ]
     print(f"Training {len(datasets)} NeRFs")
 
-    with Pool() as pool:
-        for dataset in datasets:
-            if dataset["mimeType"] == "application/zip" or dataset["mimeType"] == "application/zip-x-compressed":
-                print(dataset["name"])
-                folder_path = "data"
-                local_zip_path = downloader.download_file(dataset["id"], dataset["name"], folder_path)
-                pool.apply_async(nerf_process.process_and_train, args=(local_zip_path, checkpoint_output, model))
-            else:
-                continue
-
-        pool.close()
-        pool.join()
-
-    print("All models trained successfully")
-
-    checkpoint_path = checkpoint_output
-    dataset_names = [dataset["name"].strip(".zip") for dataset in datasets if dataset["mimeType"] == "application/zip" or dataset["mimeType"] == "application/zip-x-compressed"]
-    checkpoints = [os.path.join(checkpoint_path, name) for name in dataset_names]
-
-    configs = []
-    for ckp in checkpoints:
-        configs.append(nerf_process.find_config(ckp + f"/{model}"))
-
-    with Pool() as pool:
-        for name, config in zip(dataset_names, configs):
-            output = f"renders/{name}.mp4"
-            pool.apply_async(nerf_process.render, args=(config, output))
-
-        pool.close()
-        pool.join()
-
-    print("All videos rendered successfully")
+    with EnginePool() as engines, ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = {
+            dataset["name"]: executor.submit(
+                process_train_and_render, engines, nerf_process, downloader, dataset, checkpoint_output, model
+            )
+            for dataset in datasets
+        }
+        results = {}
+        for name, future in futures.items():
+            try:
+                results[name] = future.result().ok
+            except Exception as e:
+                print(f"Error: {name}: {e}")
+                results[name] = False
+
+    failed = [name for name, ok in results.items() if not ok]
+    print(f"{len(results) - len(failed)} of {len(results)} datasets trained and rendered")
+    if failed:
+        print(f"Failed: {', '.join(failed)}")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,252 @@
+"""
+SQLite registry of the stages run per dataset, used to skip work that is up to date across runs.
+
+Every dataset and stage has one row with the hash of the stage's inputs and config, its status, duration and
+output, and every finished attempt is appended to the history. A stage is up to date if its last run succeeded
+with the same hashes and its output still exists, so half-written outputs, changed datasets and changed configs
+are run again.
+
+    python run_registry.py --db runs.sqlite            # status of every dataset and stage
+    python run_registry.py --db runs.sqlite --history  # timing history per stage
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime
+
+import click
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS stages (
+    dataset TEXT NOT NULL,
+    stage TEXT NOT NULL,
+    input_hash TEXT,
+    config_hash TEXT,
+    status TEXT NOT NULL,
+    started_at TEXT,
+    seconds REAL,
+    output TEXT,
+    error TEXT,
+    PRIMARY KEY (dataset, stage)
+);
+CREATE TABLE IF NOT EXISTS history (
+    dataset TEXT NOT NULL,
+    stage TEXT NOT NULL,
+    input_hash TEXT,
+    config_hash TEXT,
+    status TEXT NOT NULL,
+    started_at TEXT,
+    seconds REAL,
+    output TEXT
+);
+CREATE TABLE IF NOT EXISTS file_hashes (
+    path TEXT PRIMARY KEY,
+    size INTEGER,
+    mtime_ns INTEGER,
+    md5 TEXT
+);
+"""
+
+
+def hash_config(config):
+    """Hash of a json serializable config."""
+    return hashlib.md5(json.dumps(config, sort_keys=True, default=str).encode()).hexdigest()
+
+
+class RunRegistry:
+    """Stages run per dataset, stored in a SQLite database. Safe to use from several threads.
+
+    Args:
+        path: Database file, created if it does not exist.
+    """
+
+    def __init__(self, path="runs.sqlite"):
+        self.path = path
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self.lock = threading.Lock()
+        with self.lock, self.conn:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.executescript(SCHEMA)
+
+    def file_md5(self, path):
+        """Content hash of a file, cached in the database until the size or modification time of the file change."""
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        with self.lock:
+            row = self.conn.execute("SELECT size, mtime_ns, md5 FROM file_hashes WHERE path = ?", (path,)).fetchone()
+        if row is not None and row["size"] == stat.st_size and row["mtime_ns"] == stat.st_mtime_ns:
+            return row["md5"]
+        digest = hashlib.md5()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                digest.update(block)
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO file_hashes VALUES (?, ?, ?, ?)",
+                (path, stat.st_size, stat.st_mtime_ns, digest.hexdigest()),
+            )
+        return digest.hexdigest()
+
+    def hash_inputs(self, inputs):
+        """Hash of the inputs of a stage.
+
+        Existing files are hashed by content, directories by the names, sizes and modification times of the files
+        in them, anything else, e.g. Drive metadata, by its json.
+        """
+        digest = hashlib.md5()
+        for item in inputs:
+            if isinstance(item, str) and os.path.isfile(item):
+                digest.update(self.file_md5(item).encode())
+            elif isinstance(item, str) and os.path.isdir(item):
+                for root, dirs, files in os.walk(item):
+                    dirs.sort()
+                    for name in sorted(files):
+                        stat = os.stat(os.path.join(root, name))
+                        relative = os.path.relpath(os.path.join(root, name), item)
+                        digest.update(f"{relative}:{stat.st_size}:{stat.st_mtime_ns};".encode())
+            else:
+                digest.update(json.dumps(item, sort_keys=True, default=str).encode())
+        return digest.hexdigest()
+
+    def get(self, dataset, stage):
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT * FROM stages WHERE dataset = ? AND stage = ?", (dataset, stage)
+            ).fetchone()
+        return dict(row) if row is not None else None
+
+    def completed_output(self, dataset, stage, input_hash, config_hash):
+        """Output of the stage if its last run succeeded with the same hashes and the output still exists."""
+        row = self.get(dataset, stage)
+        if row is None or row["status"] != "succeeded":
+            return None
+        if row["input_hash"] != input_hash or row["config_hash"] != config_hash:
+            return None
+        if row["output"] is None or not os.path.exists(row["output"]):
+            return None
+        return row["output"]
+
+    def stage_input(self, dataset, stage):
+        """Input of a dependent stage that stands for the last successful run of stage, or None.
+
+        Its hashes and output only change when the stage runs on other inputs or config, unlike the files it
+        wrote, which later stages may add to, e.g. the depth caches training writes into the processed dataset.
+        """
+        row = self.get(dataset, stage)
+        if row is None or row["status"] != "succeeded":
+            return None
+        return {key: row[key] for key in ("stage", "input_hash", "config_hash", "output")}
+
+    def adopt(self, dataset, stage, input_hash, config_hash, output):
+        """Records an output made before the stage was tracked as its successful run, without adding history."""
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO stages VALUES (?, ?, ?, ?, 'succeeded', ?, NULL, ?, NULL)",
+                (dataset, stage, input_hash, config_hash, datetime.now().isoformat(timespec="seconds"), output),
+            )
+
+    def start(self, dataset, stage, input_hash, config_hash):
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO stages VALUES (?, ?, ?, ?, 'running', ?, NULL, NULL, NULL)",
+                (dataset, stage, input_hash, config_hash, datetime.now().isoformat(timespec="seconds")),
+            )
+
+    def finish(self, dataset, stage, status, seconds, output=None, error=None):
+        with self.lock, self.conn:
+            self.conn.execute(
+                "UPDATE stages SET status = ?, seconds = ?, output = ?, error = ? WHERE dataset = ? AND stage = ?",
+                (status, seconds, output, error, dataset, stage),
+            )
+            self.conn.execute(
+                "INSERT INTO history SELECT dataset, stage, input_hash, config_hash, status, started_at, seconds,"
+                " output FROM stages WHERE dataset = ? AND stage = ?",
+                (dataset, stage),
+            )
+
+    def run(self, dataset, stage, job, inputs, config, force=False, existing=None):
+        """Runs job() unless the stage is up to date, and returns its output path.
+
+        job returns the output path, or a JobResult whose output is the path. A job that raises or returns a
+        failed JobResult is recorded as failed and raises. existing returns the output of the stage already on
+        disk, or None. If the registry has no run of the stage yet, that output is adopted as its run with the
+        current hashes, so a new registry does not redo the work of earlier runs. Only pass existing for outputs
+        that are provably complete and made from the current inputs and config, e.g. a download whose checksum
+        matches, or ones the user vouches for.
+        """
+        input_hash = self.hash_inputs(inputs)
+        config_hash = hash_config(config)
+        if not force and existing is not None and self.get(dataset, stage) is None:
+            output = existing()
+            if output is not None:
+                print(f"{stage} of {dataset} was done before it was tracked: {output}")
+                self.adopt(dataset, stage, input_hash, config_hash, str(output))
+                return str(output)
+        if not force:
+            output = self.completed_output(dataset, stage, input_hash, config_hash)
+            if output is not None:
+                print(f"{stage} of {dataset} is up to date: {output}")
+                return output
+        self.start(dataset, stage, input_hash, config_hash)
+        start = time.perf_counter()
+        try:
+            result = job()
+            if getattr(result, "ok", True) is False:
+                raise RuntimeError(f"{stage} of {dataset} failed:\n{result.error}")
+        except Exception as e:
+            self.finish(dataset, stage, "failed", time.perf_counter() - start, error=str(e))
+            raise
+        output = getattr(result, "output", result)
+        self.finish(dataset, stage, "succeeded", time.perf_counter() - start, output=str(output))
+        return str(output)
+
+    def status(self):
+        """Prints the last run of every dataset and stage."""
+        with self.lock:
+            rows = self.conn.execute("SELECT * FROM stages ORDER BY dataset, started_at").fetchall()
+        print(f"{'dataset':<32} {'stage':<9} {'status':<10} {'started':<20} {'seconds':>8}  output")
+        for row in rows:
+            seconds = f"{row['seconds']:8.1f}" if row["seconds"] is not None else " " * 8
+            print(
+                f"{row['dataset']:<32} {row['stage']:<9} {row['status']:<10} {row['started_at']:<20} {seconds}"
+                f"  {row['output'] or ''}"
+            )
+
+    def history(self):
+        """Prints the number of runs and their mean, fastest, slowest and latest duration per stage."""
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT stage, COUNT(*) AS runs, SUM(status = 'failed') AS failed, AVG(seconds) AS mean,"
+                " MIN(seconds) AS fastest, MAX(seconds) AS slowest FROM history GROUP BY stage ORDER BY stage"
+            ).fetchall()
+            latest = dict(
+                self.conn.execute(
+                    "SELECT stage, seconds FROM history WHERE rowid IN (SELECT MAX(rowid) FROM history GROUP BY stage)"
+                ).fetchall()
+            )
+        print(f"{'stage':<9} {'runs':>5} {'failed':>6} {'mean':>8} {'fastest':>8} {'slowest':>8} {'latest':>8}")
+        for row in rows:
+            print(
+                f"{row['stage']:<9} {row['runs']:>5} {row['failed']:>6} {row['mean']:>7.1f}s {row['fastest']:>7.1f}s"
+                f" {row['slowest']:>7.1f}s {latest[row['stage']]:>7.1f}s"
+            )
+
+
+@click.command()
+@click.option("--db", default="runs.sqlite", help="The registry database.")
+@click.option("--history", is_flag=True, help="Print the timing history per stage, not the last run of every stage.")
+def main(db, history):
+    registry = RunRegistry(db)
+    if history:
+        registry.history()
+    else:
+        registry.status()
+
+
+if __name__ == "__main__":
+    main()
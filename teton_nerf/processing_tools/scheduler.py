@@ -0,0 +1,257 @@
+"""
+Resource aware scheduler of a DAG of jobs.
+
+Every task declares what it occupies while it runs, in CPU cores, memory and accelerator slots. Tasks start as
+soon as their dependencies succeeded and their cost fits in what the running tasks leave of the machine's
+capacity. Failed tasks are retried, tasks that depend on a task that failed for good are skipped.
+
+    scheduler = Scheduler(Resources.detect())
+    scheduler.add("room/process", "process", process, Resources(cpus=4, memory_gb=8))
+    scheduler.add("room/train", "train", train, Resources(cpus=4, memory_gb=16, gpus=1), deps=["room/process"])
+    scheduler.run()
+    scheduler.summary()
+"""
+
+import os
+import time
+import traceback
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+
+@dataclass(frozen=True)
+class Resources:
+    """Amounts of CPU cores, memory, accelerator slots and I/O slots, a task's cost or a machine's capacity.
+
+    I/O slots bound the tasks that mostly wait on the network or disk, e.g. downloads, which cost next to no CPU.
+    """
+
+    cpus: float = 0.0
+    memory_gb: float = 0.0
+    gpus: float = 0.0
+    io: float = 0.0
+
+    def _values(self) -> Tuple[float, ...]:
+        return (self.cpus, self.memory_gb, self.gpus, self.io)
+
+    def __add__(self, other: "Resources") -> "Resources":
+        return Resources(*(a + b for a, b in zip(self._values(), other._values())))
+
+    def __sub__(self, other: "Resources") -> "Resources":
+        return Resources(*(a - b for a, b in zip(self._values(), other._values())))
+
+    def fits(self, capacity: "Resources") -> bool:
+        return all(a <= b + 1e-9 for a, b in zip(self._values(), capacity._values()))
+
+    def clamp(self, capacity: "Resources") -> "Resources":
+        return Resources(*(min(a, b) for a, b in zip(self._values(), capacity._values())))
+
+    @classmethod
+    def detect(cls, io: float = 4) -> "Resources":
+        """Cores, physical memory and CUDA devices of this machine, and the given number of I/O slots."""
+        memory_gb = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") / 2**30
+        try:
+            import torch
+
+            gpus = torch.cuda.device_count()
+        except ImportError:
+            gpus = 0
+        return cls(cpus=float(os.cpu_count() or 1), memory_gb=memory_gb, gpus=float(gpus), io=float(io))
+
+
+# What a job of every processing stage occupies while it runs
+STAGE_COSTS = {
+    "download": Resources(cpus=0.25, memory_gb=0.5, io=1),
+    # Segments the images with detectron2 on the GPU when semantics are added, the default
+    "process": Resources(cpus=4, memory_gb=8, gpus=0.5),
+    "train": Resources(cpus=4, memory_gb=16, gpus=1),
+    "render": Resources(cpus=2, memory_gb=8, gpus=1),
+    "export": Resources(cpus=2, memory_gb=12, gpus=1),
+    "evaluate": Resources(cpus=2, memory_gb=8, gpus=1),
+}
+
+
+@dataclass
+class Task:
+    """A node of the DAG and the state of its execution."""
+
+    name: str
+    stage: str
+    """download, process, train, render, export, or any other label used to group tasks in the summary."""
+    fn: Callable[[], Any]
+    cost: Resources
+    deps: Tuple[str, ...] = ()
+    retries: int = 0
+    """Number of times the task is run again after failing."""
+    status: str = "pending"
+    """pending, running, succeeded, failed or skipped."""
+    attempts: int = 0
+    ready_at: Optional[float] = None
+    """Seconds after the start of the run at which the task could have started, its dependencies being done."""
+    queued: float = 0.0
+    """Seconds the task was ready but waited for resources."""
+    started: Optional[float] = None
+    """Seconds after the start of the run at which the last attempt started."""
+    finished: Optional[float] = None
+    seconds: float = 0.0
+    """Duration of all attempts."""
+    result: Any = None
+    error: Optional[str] = None
+    not_before: float = field(default=0.0, repr=False)
+
+
+class Scheduler:
+    """Runs tasks of a DAG concurrently within the capacity of the machine.
+
+    Tasks run on threads, so their fn should hand heavy work to other processes or release the GIL. A task whose
+    cost exceeds the capacity is clamped to it, so it still runs, alone if it has to. Among the tasks that are
+    ready, the ones with the longest chain of tasks after them start first. A task fails if fn raises or returns a
+    result whose ok attribute is False, e.g. a failed JobResult.
+
+    Args:
+        capacity: Resources of the machine available to the tasks.
+        retries: Default number of retries of a failed task.
+        retry_delay: Seconds before a failed task is run again.
+    """
+
+    def __init__(self, capacity: Resources, retries: int = 0, retry_delay: float = 5.0):
+        self.capacity = capacity
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.tasks: Dict[str, Task] = {}
+        self.makespan = 0.0
+
+    def add(
+        self,
+        name: str,
+        stage: str,
+        fn: Callable[[], Any],
+        cost: Resources,
+        deps: Sequence[str] = (),
+        retries: Optional[int] = None,
+    ) -> str:
+        """Adds a task. Dependencies have to be added first, which keeps the graph acyclic."""
+        if name in self.tasks:
+            raise ValueError(f"Task {name} already exists")
+        unknown = [dep for dep in deps if dep not in self.tasks]
+        if unknown:
+            raise ValueError(f"Task {name} depends on unknown tasks {unknown}")
+        retries = self.retries if retries is None else retries
+        self.tasks[name] = Task(name=name, stage=stage, fn=fn, cost=cost, deps=tuple(deps), retries=retries)
+        return name
+
+    def _chain_lengths(self) -> Dict[str, int]:
+        # Tasks are added after their dependencies, so reversed insertion order visits dependents first
+        lengths = {name: 1 for name in self.tasks}
+        for task in reversed(list(self.tasks.values())):
+            for dep in task.deps:
+                lengths[dep] = max(lengths[dep], lengths[task.name] + 1)
+        return lengths
+
+    def _skip_dependents(self) -> None:
+        for task in self.tasks.values():
+            if task.status == "pending" and any(self.tasks[dep].status in ("failed", "skipped") for dep in task.deps):
+                task.status = "skipped"
+                task.error = "A dependency failed"
+
+    def run(self) -> Dict[str, Task]:
+        """Runs all tasks and returns them with their status, results and timings."""
+        start = time.perf_counter()
+        chain_lengths = self._chain_lengths()
+        in_use = Resources()
+        running = {}
+        with ThreadPoolExecutor(max_workers=max(1, len(self.tasks))) as executor:
+            while True:
+                now = time.perf_counter() - start
+                self._skip_dependents()
+                ready = [
+                    task
+                    for task in self.tasks.values()
+                    if task.status == "pending" and all(self.tasks[dep].status == "succeeded" for dep in task.deps)
+                ]
+                for task in ready:
+                    if task.ready_at is None:
+                        task.ready_at = now
+                for task in sorted(ready, key=lambda task: -chain_lengths[task.name]):
+                    cost = task.cost.clamp(self.capacity)
+                    if task.not_before > now or not (in_use + cost).fits(self.capacity):
+                        continue
+                    in_use = in_use + cost
+                    task.queued += now - task.ready_at
+                    task.status = "running"
+                    task.attempts += 1
+                    task.started = now
+                    print(f"Starting {task.name} (attempt {task.attempts})")
+                    running[executor.submit(task.fn)] = task
+
+                if not running:
+                    waiting = [task.not_before for task in ready]
+                    if not waiting:
+                        break
+                    time.sleep(max(0.0, min(waiting) - now))
+                    continue
+
+                retry_times = [task.not_before for task in ready if task.not_before > now]
+                timeout = min(retry_times) - now if retry_times else None
+                done, _ = wait(list(running), timeout=timeout, return_when=FIRST_COMPLETED)
+                for future in done:
+                    task = running.pop(future)
+                    in_use = in_use - task.cost.clamp(self.capacity)
+                    task.finished = time.perf_counter() - start
+                    task.seconds += task.finished - task.started
+                    try:
+                        task.result = future.result()
+                        if getattr(task.result, "ok", True) is False:
+                            raise RuntimeError(getattr(task.result, "error", None) or "The job failed")
+                        task.status = "succeeded"
+                        task.error = None
+                    except Exception:
+                        task.error = traceback.format_exc()
+                        if task.attempts <= task.retries:
+                            print(f"{task.name} failed, retrying in {self.retry_delay:.0f}s")
+                            task.status = "pending"
+                            task.not_before = task.ready_at = task.finished + self.retry_delay
+                        else:
+                            print(f"{task.name} failed after {task.attempts} attempts:\n{task.error}")
+                            task.status = "failed"
+        self.makespan = time.perf_counter() - start
+        return self.tasks
+
+    def critical_path(self) -> List[Task]:
+        """Chain of tasks that determined the end of the run.
+
+        Starts from the task that finished last and follows the dependency that finished last, so every task in
+        the chain could not start before its predecessor was done.
+        """
+        finished = [task for task in self.tasks.values() if task.finished is not None]
+        if not finished:
+            return []
+        path = [max(finished, key=lambda task: task.finished)]
+        while path[-1].deps:
+            path.append(max((self.tasks[dep] for dep in path[-1].deps), key=lambda task: task.finished or 0.0))
+        return path[::-1]
+
+    def summary(self) -> None:
+        """Prints the status and timings of every task, the time per stage and the critical path."""
+        print(f"{'task':<40} {'stage':<9} {'status':<10} {'tries':>5} {'queued':>8} {'seconds':>8}")
+        for task in self.tasks.values():
+            print(
+                f"{task.name:<40} {task.stage:<9} {task.status:<10} {task.attempts:>5} {task.queued:>7.1f}s"
+                f" {task.seconds:>7.1f}s"
+            )
+
+        stages: Dict[str, float] = {}
+        for task in self.tasks.values():
+            stages[task.stage] = stages.get(task.stage, 0.0) + task.seconds
+        busy = sum(stages.values())
+        print(f"Wall clock {self.makespan:.1f}s, {busy:.1f}s of task time, {busy / max(self.makespan, 1e-9):.2f}x")
+        print("Task time per stage: " + ", ".join(f"{stage} {seconds:.1f}s" for stage, seconds in stages.items()))
+
+        path = self.critical_path()
+        if path:
+            print("Critical path:")
+            for task in path:
+                print(f"  {task.name:<40} {task.seconds:>7.1f}s, queued {task.queued:.1f}s for resources")
+            work = sum(task.seconds for task in path)
+            print(f"  {work:.1f}s of work, {self.makespan - work:.1f}s waiting of the {self.makespan:.1f}s run")
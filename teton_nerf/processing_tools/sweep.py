@@ -0,0 +1,225 @@
+"""
+Hyperparameter sweep of Teton NeRF over one processed dataset.
+
+The spec is a YAML or JSON file. Parameters are fields of TetonNerfModelConfig or TetonNerfPipelineConfig, a
+list of values each, or for random search also a distribution:
+
+    data: data/room.zip            # a Polycam capture, processed once, or a processed dataset
+    method: teton-nerf
+    search: grid                   # or random
+    num_samples: 8                 # runs of a random search
+    seed: 0
+    options: --max-num-iterations 5000
+    parameters:
+      use_regnerf_depth_loss: [true, false]
+      use_depth: [true, false]
+      depth_loss_mult: [0.001, 0.01]
+      regnerf_rgb_loss_mult: {log_uniform: [0.1, 10]}   # random search only, also uniform
+
+All runs train on the same processed dataset, whose depth caches are built once before the runs start. Runs are
+placed on the CPU cores and accelerator slots that are free, every run on one CUDA device of its own worker, the
+least busy one, and the sweep ends with a table of the eval metrics and wall-clock time of every run.
+
+    python sweep.py --spec sweeps/regnerf.yml --gpus 2
+"""
+
+import dataclasses
+import itertools
+import json
+import math
+import random
+import shlex
+from pathlib import Path
+
+import click
+import yaml
+
+from job_engine import EnginePool
+from run_registry import RunRegistry
+from scheduler import STAGE_COSTS, Resources, Scheduler
+
+
+def parameter_flag(name):
+    """Command line flag of a TetonNerfModelConfig or TetonNerfPipelineConfig field, e.g. use_depth ->
+    --pipeline.model.use-depth. Names may be qualified as model.<field> or pipeline.<field>."""
+    from teton_nerf.teton_nerf import TetonNerfModelConfig
+    from teton_nerf.teton_nerf_pipeline import TetonNerfPipelineConfig
+
+    scope, _, field = name.rpartition(".")
+    configs = {"pipeline.model": TetonNerfModelConfig, "pipeline": TetonNerfPipelineConfig}
+    if scope:
+        scope = scope if scope.startswith("pipeline") else f"pipeline.{scope}"
+        configs = {scope: configs[scope]} if scope in configs else {}
+    for prefix, config in configs.items():
+        fields = {f.name: f for f in dataclasses.fields(config)}
+        # Nested configs, e.g. the datamanager, would change the dataset the runs share
+        if field in fields and not dataclasses.is_dataclass(fields[field].default):
+            return f"--{prefix}.{field.replace('_', '-')}"
+    raise ValueError(f"{name} is not a field of TetonNerfModelConfig or TetonNerfPipelineConfig")
+
+
+def format_value(value):
+    if isinstance(value, bool):
+        return ["True" if value else "False"]
+    if isinstance(value, (list, tuple)):
+        return [str(item) for item in value]
+    return [str(value)]
+
+
+def sample(distribution, rng):
+    if isinstance(distribution, list):
+        return rng.choice(distribution)
+    (kind, (low, high)), = distribution.items()
+    if kind == "uniform":
+        return rng.uniform(low, high)
+    if kind == "log_uniform":
+        return math.exp(rng.uniform(math.log(low), math.log(high)))
+    raise ValueError(f"Unknown distribution {kind}, use a list of values, uniform or log_uniform")
+
+
+def expand(spec):
+    """Parameter values of every run of the spec."""
+    parameters = spec.get("parameters", {})
+    if spec.get("search", "grid") == "grid":
+        for name, values in parameters.items():
+            if not isinstance(values, list):
+                raise ValueError(f"Grid search needs a list of values for {name}")
+        return [dict(zip(parameters, values)) for values in itertools.product(*parameters.values())]
+    rng = random.Random(spec.get("seed", 0))
+    return [{name: sample(values, rng) for name, values in parameters.items()} for _ in range(spec["num_samples"])]
+
+
+class Sweep:
+    """Trains and evaluates the runs of a spec, sharing one processed dataset.
+
+    Args:
+        spec: Parsed sweep spec.
+        name: Name of the sweep, outputs are written to outputs/sweeps/<name>.
+        capacity: Resources the runs may use at once.
+        retries: Number of times a failed job is run again.
+        registry: Registry that skips processing the dataset if it is up to date.
+    """
+
+    def __init__(self, spec, name, capacity, retries=0, registry=None):
+        self.spec = spec
+        self.name = name
+        self.capacity = capacity
+        self.retries = retries
+        self.registry = registry if registry is not None else RunRegistry()
+        self.output_dir = Path("outputs/sweeps") / name
+        self.runs = expand(spec)
+        # Fails before anything runs if a parameter is not a config field
+        self.flags = {parameter: parameter_flag(parameter) for parameter in spec.get("parameters", {})}
+
+    def run_options(self, index, values):
+        options = shlex.split(self.spec.get("options", ""))
+        options += ["--experiment-name", f"{self.name}-{index:03d}"]
+        for parameter, value in values.items():
+            options += [self.flags[parameter], *format_value(value)]
+        return shlex.join(options)
+
+    def run(self, engines):
+        data = str(self.spec["data"])
+        dataset = Path(data).stem if data.endswith(".zip") else Path(data).name
+        scheduler = Scheduler(self.capacity, retries=self.retries)
+
+        deps = []
+        if data.endswith(".zip"):
+            processed = f"processed_data/{dataset}"
+            job = lambda: engines.run(dataset, "process_data", data, processed)
+            process = lambda: self.registry.run(dataset, "process", job, [data], {"processor": "polycam"})
+            deps = [scheduler.add(f"{dataset}/process", "process", process, STAGE_COSTS["process"])]
+            data = processed
+        warm = lambda: engines.run(dataset, "warm_dataset", data)
+        deps = [scheduler.add(f"{dataset}/warm", "process", warm, STAGE_COSTS["train"], deps)]
+
+        method = self.spec.get("method", "teton-nerf")
+        for index, values in enumerate(self.runs):
+            run = f"{self.name}-{index:03d}"
+            options = self.run_options(index, values)
+            train = lambda run=run, options=options: engines.run(
+                run, "train", data, str(self.output_dir), options=options, model=method
+            )
+            train_task = scheduler.add(f"{run}/train", "train", train, STAGE_COSTS["train"], deps)
+            # Goes to the worker that trained the run, which still holds the trained pipeline
+            evaluate = lambda run=run, train_task=train_task: engines.run(
+                run, "evaluate", scheduler.tasks[train_task].result.output
+            )
+            scheduler.add(f"{run}/evaluate", "evaluate", evaluate, STAGE_COSTS["evaluate"], [train_task])
+
+        scheduler.run()
+        scheduler.summary()
+        return self.report(scheduler)
+
+    def report(self, scheduler):
+        """Prints the runs sorted by PSNR with their eval metrics and wall-clock time, and writes them to JSON."""
+        results = []
+        for index, values in enumerate(self.runs):
+            run = f"{self.name}-{index:03d}"
+            train, evaluate = scheduler.tasks[f"{run}/train"], scheduler.tasks[f"{run}/evaluate"]
+            metrics = evaluate.result.metrics if evaluate.status == "succeeded" else {}
+            results.append(
+                {
+                    "run": run,
+                    "parameters": values,
+                    "status": evaluate.status if train.status == "succeeded" else train.status,
+                    "metrics": metrics,
+                    "train_seconds": train.seconds,
+                    "evaluate_seconds": evaluate.seconds,
+                    "config": train.result.output if train.status == "succeeded" else None,
+                }
+            )
+        results.sort(key=lambda result: -result["metrics"].get("psnr", -math.inf))
+
+        columns = list(self.spec.get("parameters", {}))
+        metric_names = [name for name in ("psnr", "ssim", "lpips") if any(name in r["metrics"] for r in results)]
+        header = ["run", *columns, "status", *metric_names, "train s", "eval s"]
+        rows = []
+        for result in results:
+            parameters = [
+                f"{value:.4g}" if isinstance(value, float) else str(value) for value in result["parameters"].values()
+            ]
+            metrics = [f"{result['metrics'][name]:.4f}" if name in result["metrics"] else "-" for name in metric_names]
+            seconds = [f"{result['train_seconds']:.0f}", f"{result['evaluate_seconds']:.0f}"]
+            rows.append([result["run"], *parameters, result["status"], *metrics, *seconds])
+        widths = [max(len(str(cell)) for cell in column) for column in zip(header, *rows)]
+        for row in [header, *rows]:
+            print("  ".join(str(cell).ljust(width) for cell, width in zip(row, widths)))
+
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        with open(self.output_dir / "results.json", "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"Results written to {self.output_dir / 'results.json'}")
+        return results
+
+
+@click.command()
+@click.option("--spec", required=True, help="YAML or JSON file with the data, search and parameters of the sweep")
+@click.option("--name", default=None, help="Name of the sweep, the name of the spec file if not set")
+@click.option("--cpus", type=float, default=None, help="CPU cores the runs may use at once, all cores if not set")
+@click.option("--memory-gb", type=float, default=None, help="Memory the runs may use at once, all memory if not set")
+@click.option("--gpus", type=float, default=None, help="Accelerator slots, all CUDA devices if not set")
+@click.option("--retries", default=0, help="Number of times a failed job is run again")
+@click.option("--registry", default="runs.sqlite", help="Database of the stages run, used to process the data once")
+@click.option("--dry-run", is_flag=True, help="Print the options of every run without running them")
+def main(spec, name, cpus, memory_gb, gpus, retries, registry, dry_run):
+    with open(spec) as f:
+        sweep_spec = yaml.safe_load(f)
+    detected = Resources.detect()
+    capacity = Resources(
+        cpus=cpus if cpus is not None else detected.cpus,
+        memory_gb=memory_gb if memory_gb is not None else detected.memory_gb,
+        gpus=gpus if gpus is not None else detected.gpus,
+    )
+    sweep = Sweep(sweep_spec, name or Path(spec).stem, capacity, retries=retries, registry=RunRegistry(registry))
+    print(f"Sweeping {len(sweep.runs)} runs on {capacity}")
+    if dry_run:
+        for index, values in enumerate(sweep.runs):
+            print(f"{sweep.name}-{index:03d}: {sweep.run_options(index, values)}")
+        return
+    with EnginePool(vis=sweep_spec.get("vis", "wandb")) as engines:
+        sweep.run(engines)
+
+
+if __name__ == "__main__":
+    main()
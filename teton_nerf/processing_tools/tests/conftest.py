@@ -0,0 +1,17 @@
+import os
+import sys
+
+import pytest
+
+# The processing tools import each other as top-level modules
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def drive(tmp_path):
+    """A drive with a folder of three archives of different sizes."""
+    root = tmp_path / "drive"
+    (root / "captures").mkdir(parents=True)
+    for index, size in enumerate((300_000, 150_001, 64 * 2**10)):
+        (root / "captures" / f"room{index}.zip").write_bytes(os.urandom(size))
+    return root
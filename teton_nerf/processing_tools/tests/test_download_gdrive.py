@@ -0,0 +1,146 @@
+"""
+Downloads from the local Drive stand-ins: resuming, verification, servers that ignore ranges and parallelism.
+"""
+
+import hashlib
+import threading
+import time
+
+import pytest
+
+from download_gdrive import GDriveDownloader
+from fake_drive import LocalDriveServer, LocalDriveService
+
+CHUNK_SIZE = 64 * 2**10
+
+
+def md5(path):
+    with open(path, "rb") as f:
+        return hashlib.md5(f.read()).hexdigest()
+
+
+class IgnoringRangeHttp:
+    """Answers every media request with the whole file and a 200, like a server without range support."""
+
+    def __init__(self, http):
+        self.http = http
+        self.requests = 0
+
+    def request(self, uri, method="GET", body=None, headers=None, **kwargs):
+        self.requests += 1
+        return self.http.request(uri, method, body=body, headers={}, **kwargs)
+
+
+class ConcurrencyHttp:
+    """Counts the media requests in flight, every request takes at least delay seconds."""
+
+    def __init__(self, http, delay=0.05):
+        self.http = http
+        self.delay = delay
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.lock = threading.Lock()
+
+    def request(self, uri, method="GET", body=None, headers=None, **kwargs):
+        with self.lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            time.sleep(self.delay)
+            return self.http.request(uri, method, body=body, headers=headers, **kwargs)
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+
+
+def test_download_resumes_from_part_file(drive, tmp_path):
+    source = drive / "captures" / "room0.zip"
+    output = tmp_path / "data"
+    output.mkdir()
+    (output / "room0.zip.part").write_bytes(source.read_bytes()[:100_000])
+
+    downloader = GDriveDownloader(service=LocalDriveService(drive), chunk_size=CHUNK_SIZE)
+    path = downloader.download_file("captures/room0.zip", "room0.zip", str(output))
+
+    assert md5(path) == md5(source)
+    assert not (output / "room0.zip.part").exists()
+    assert downloader.stats[-1]["resumed_from"] == 100_000
+    assert downloader.stats[-1]["bytes"] == source.stat().st_size - 100_000
+
+
+def test_download_rejects_wrong_checksum(drive, tmp_path):
+    source = drive / "captures" / "room0.zip"
+    output = tmp_path / "data"
+    output.mkdir()
+    # A part file that is not the beginning of the archive
+    (output / "room0.zip.part").write_bytes(bytes(100_000))
+
+    downloader = GDriveDownloader(service=LocalDriveService(drive), chunk_size=CHUNK_SIZE)
+    with pytest.raises(IOError, match="Checksum"):
+        downloader.download_file("captures/room0.zip", "room0.zip", str(output))
+    assert not (output / "room0.zip.part").exists()
+    assert not (output / "room0.zip").exists()
+
+    # The next attempt starts over and succeeds
+    path = downloader.download_file("captures/room0.zip", "room0.zip", str(output))
+    assert md5(path) == md5(source)
+
+
+def test_verify_rejects_wrong_size(tmp_path):
+    path = tmp_path / "room.zip.part"
+    path.write_bytes(b"abc")
+    downloader = GDriveDownloader(service=LocalDriveService(tmp_path))
+    with pytest.raises(IOError, match="expected 4"):
+        downloader.verify(str(path), 4, None)
+    assert not path.exists()
+
+
+def test_download_restarts_when_server_ignores_range(drive, tmp_path):
+    source = drive / "captures" / "room0.zip"
+    output = tmp_path / "data"
+    output.mkdir()
+    (output / "room0.zip.part").write_bytes(source.read_bytes()[:100_000])
+
+    service = LocalDriveService(drive)
+    service.http = IgnoringRangeHttp(service.http)
+    downloader = GDriveDownloader(service=service, chunk_size=CHUNK_SIZE)
+    path = downloader.download_file("captures/room0.zip", "room0.zip", str(output))
+
+    assert md5(path) == md5(source)
+    # The whole file arrived with the first response
+    assert service.http.requests == 1
+
+
+def test_download_files_runs_in_parallel(drive, tmp_path):
+    service = LocalDriveService(drive)
+    service.http = ConcurrencyHttp(service.http)
+    downloader = GDriveDownloader(service=service, chunk_size=CHUNK_SIZE)
+    _, files = downloader.list_files_in_folder("captures")
+
+    results = downloader.download_files(files, str(tmp_path / "data"), parallelism=3)
+
+    assert service.http.max_in_flight == 3
+    for file in files:
+        assert md5(results[file["id"]]) == md5(drive / file["id"])
+
+
+def test_download_files_reports_failures(drive, tmp_path):
+    downloader = GDriveDownloader(service=LocalDriveService(drive), chunk_size=CHUNK_SIZE)
+    files = [{"id": "captures/room1.zip", "name": "room1.zip"}, {"id": "captures/missing.zip", "name": "missing.zip"}]
+
+    results = downloader.download_files(files, str(tmp_path / "data"))
+
+    assert md5(results["captures/room1.zip"]) == md5(drive / "captures" / "room1.zip")
+    assert isinstance(results["captures/missing.zip"], Exception)
+
+
+def test_download_over_http_survives_dropped_connections(drive, tmp_path, monkeypatch):
+    # No backoff between the retries of the dropped responses
+    monkeypatch.setattr(time, "sleep", lambda seconds: None)
+    source = drive / "captures" / "room0.zip"
+    with LocalDriveServer(drive, fail_every=2) as server:
+        downloader = GDriveDownloader(build_service=server.service, chunk_size=CHUNK_SIZE)
+        path = downloader.download_file("captures/room0.zip", "room0.zip", str(tmp_path / "data"))
+        assert server.httpd.media_requests > 300_000 // CHUNK_SIZE + 1
+
+    assert md5(path) == md5(source)
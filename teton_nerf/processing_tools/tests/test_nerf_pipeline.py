@@ -0,0 +1,89 @@
+"""
+download_and_train of NeRFStudioPipeline against the local Drive stand-in, with engines that only record the jobs.
+"""
+
+import hashlib
+import os
+import threading
+
+import pytest
+
+pytest.importorskip("detectron2")
+
+import nerf_pipeline
+from download_gdrive import GDriveDownloader
+from fake_drive import LocalDriveService
+from job_engine import JobResult
+from nerf_pipeline import NeRFStudioPipeline
+from run_registry import RunRegistry
+from scheduler import Resources
+
+
+def md5(path):
+    with open(path, "rb") as f:
+        return hashlib.md5(f.read()).hexdigest()
+
+
+class RecordingEngines:
+    """Stands in for an EnginePool, writes the outputs the process and train jobs would write and records them."""
+
+    def __init__(self):
+        self.jobs = []
+        self.lock = threading.Lock()
+
+    def run(self, key, kind, *args, **kwargs):
+        with self.lock:
+            self.jobs.append((key, kind))
+        if kind == "process_data":
+            zip_path, output = args
+            assert os.path.exists(zip_path), "Processing started before the download finished"
+            os.makedirs(output, exist_ok=True)
+            open(os.path.join(output, "transforms.json"), "w").close()
+        elif kind == "train":
+            _, output = args
+            output = os.path.join(output, key, kwargs["model"], "run")
+            os.makedirs(output, exist_ok=True)
+            output = os.path.join(output, "config.yml")
+            open(output, "w").close()
+        return JobResult(kind=kind, name=key, status="succeeded", output=output)
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def pipeline(drive, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    # Segmentation is not part of these jobs, skip loading its weights
+    monkeypatch.setattr(nerf_pipeline, "SemanticSegmentor", lambda: None)
+    return NeRFStudioPipeline(
+        True,
+        "",
+        "",
+        capacity=Resources(cpus=8, memory_gb=64, gpus=1, io=2),
+        retries=0,
+        engines=RecordingEngines(),
+        downloader=GDriveDownloader(service=LocalDriveService(drive), chunk_size=64 * 2**10),
+        registry=RunRegistry(str(tmp_path / "runs.sqlite")),
+    )
+
+
+def test_download_and_train(pipeline, drive, tmp_path):
+    checkpoint_output = pipeline.download_and_train("captures", "teton-nerf")
+
+    assert checkpoint_output == "outputs/captures"
+    names = ["room0", "room1", "room2"]
+    for name in names:
+        assert md5(tmp_path / "data" / "captures" / f"{name}.zip") == md5(drive / "captures" / f"{name}.zip")
+    assert sorted(pipeline.engines.jobs) == sorted((name, kind) for name in names for kind in ("process_data", "train"))
+
+
+def test_download_and_train_skips_stages_that_are_up_to_date(pipeline, drive):
+    pipeline.download_and_train("captures", "teton-nerf")
+    pipeline.engines.jobs.clear()
+    (drive / "captures" / "room1.zip").write_bytes(os.urandom(1000))
+
+    pipeline.download_and_train("captures", "teton-nerf")
+
+    # Only the archive that changed on the drive is downloaded, processed and trained again
+    assert sorted(pipeline.engines.jobs) == [("room1", "process_data"), ("room1", "train")]
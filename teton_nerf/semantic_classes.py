@@ -0,0 +1,27 @@
+"""
+Semantic classes the segmentations are reduced to. Kept separate from the segmentor so that the
+dataparser and the exporters can use them without loading detectron2.
+"""
+
+SEMANTIC_CLASSES = [
+    "none",
+    "curtain",
+    "door-stuff",
+    "mirror-stuff",
+    "pillow",
+    "shelf",
+    "stairs",
+    "table",
+    "window",
+    "ceiling",
+    "floor",
+    "floor-wood",
+    "wall",
+    "rug",
+    "chair",
+    "couch",
+    "bed",
+    "dining table",
+    "toilet",
+    "tv",
+]
@@ -11,9 +11,12 @@ import numpy.typing as npt
 import torch
 
 from nerfstudio.cameras.rays import RayBundle
+from nerfstudio.data.dataparsers.base_dataparser import DataparserOutputs
 from nerfstudio.data.datamanagers.base_datamanager import VanillaDataManager, VanillaDataManagerConfig
+from nerfstudio.utils.rich_utils import CONSOLE
 
 from teton_nerf.teton_dataset import TetonNerfDataset
+from teton_nerf.teton_pixel_sampler import TetonPixelSampler, TetonPixelSamplerConfig
 
 
 @dataclass
@@ -24,6 +27,21 @@ class TetonNerfDatamanagerConfig(VanillaDataManagerConfig):
     _target: Type = field(default_factory=lambda: TetonNerfDatamanager)
     use_monocular_depth: bool = True
     """Whether to extend lidar depth with monocular depth"""
+    pixel_sampler: TetonPixelSamplerConfig = field(default_factory=TetonPixelSamplerConfig)
+    """Specifies the pixel sampler used to sample pixels from images."""
+    error_sampling: bool = False
+    """Whether to draw training rays in proportion to a running low resolution error map of every image"""
+    error_map_resolution: int = 64
+    """Number of error map cells along the longer image side"""
+    error_sampling_floor: float = 0.2
+    """Share of the error-driven rays that is still sampled uniformly, so no pixel is ignored"""
+    error_map_decay: float = 0.9
+    """Exponential moving average decay of the error maps. Lower values react faster to new errors"""
+    curriculum_downscale_factors: Tuple[int, ...] = ()
+    """Image pyramid levels of the coarse-to-fine training curriculum, coarsest first, e.g. 8 4 2 1.
+    Leave empty to train on the dataparser's downscale factor throughout"""
+    curriculum_steps: Tuple[int, ...] = ()
+    """Training step at which each curriculum level starts, e.g. 0 2000 5000 10000"""
 
 
 class TetonNerfDatamanager(VanillaDataManager):
@@ -48,8 +66,82 @@ class TetonNerfDatamanager(VanillaDataManager):
             config=config, device=device, test_mode=test_mode, world_size=world_size, local_rank=local_rank, **kwargs
         )
 
+    def setup_train(self):
+        super().setup_train()
+        if not self.config.error_sampling:
+            return
+
+        height = int(self.train_dataset.cameras.height[0])
+        width = int(self.train_dataset.cameras.width[0])
+        self.error_image_size = (height, width)
+        if getattr(self, "error_maps", None) is None:
+            scale = self.config.error_map_resolution / max(height, width)
+            map_size = (max(1, round(height * scale)), max(1, round(width * scale)))
+            # Start from a uniform error so every cell is visited before the maps become informative
+            self.error_maps = torch.ones((len(self.train_dataset), *map_size), device=self.device)
+
+        assert isinstance(self.train_pixel_sampler, TetonPixelSampler), "Error sampling needs the TetonPixelSampler"
+        self.train_pixel_sampler.error_maps = self.error_maps
+        self.train_pixel_sampler.error_sampling_floor = self.config.error_sampling_floor
+
+    @torch.no_grad()
+    def update_error_maps(self, ray_indices: torch.Tensor, errors: torch.Tensor) -> None:
+        """Folds the per-ray errors of a training step into the error maps.
+
+        Args:
+            ray_indices: (image, y, x) indices of the rays, as returned in the batch by next_train.
+            errors: Error of every ray.
+        """
+        _, map_height, map_width = self.error_maps.shape
+        height, width = self.error_image_size
+        c, y, x = ray_indices.to(self.device).long().unbind(-1)
+        cells = (c * map_height + y * map_height // height) * map_width + x * map_width // width
+
+        num_cells = self.error_maps.numel()
+        error_sums = torch.zeros(num_cells, device=self.device).index_add_(0, cells, errors.float().view(-1))
+        ones = torch.ones(len(cells), device=self.device)
+        counts = torch.zeros(num_cells, device=self.device).index_add_(0, cells, ones)
+        decay = self.config.error_map_decay
+        error_maps = self.error_maps.view(-1)
+        updated = decay * error_maps + (1 - decay) * error_sums / counts.clamp(min=1)
+        error_maps.copy_(torch.where(counts > 0, updated, error_maps))
+
+    def get_error_map(self, image_idx: int) -> torch.Tensor:
+        """Returns the error map of a training image upsampled to the image resolution, for inspection."""
+        return torch.nn.functional.interpolate(
+            self.error_maps[image_idx][None, None], size=self.error_image_size, mode="nearest"
+        )[0, 0]
+
+    def _get_train_dataparser_outputs(self, downscale_factor: int) -> DataparserOutputs:
+        """Train dataparser outputs at the given pyramid level, leaving the dataparser's own level untouched.
+
+        The dataparser rescales the cameras to the level, so the intrinsics match the downscaled images.
+        """
+        config_downscale_factor = self.dataparser.config.downscale_factor
+        downscale_factor_before = self.dataparser.downscale_factor
+        self.dataparser.config.downscale_factor = downscale_factor
+        self.dataparser.downscale_factor = None
+        try:
+            return self.dataparser.get_dataparser_outputs(split="train")
+        finally:
+            self.dataparser.config.downscale_factor = config_downscale_factor
+            self.dataparser.downscale_factor = downscale_factor_before
+
+    def update_curriculum(self, step: int) -> None:
+        """Swaps in the training images, cameras and depth caches of the curriculum level for this step."""
+        level = max(sum(step >= start for start in self.config.curriculum_steps) - 1, 0)
+        if level == self.curriculum_level:
+            return
+        self.curriculum_level = level
+        downscale_factor = self.config.curriculum_downscale_factors[level]
+        CONSOLE.print(f"[bold yellow]Curriculum: training on images downscaled by {downscale_factor} from step {step}")
+        self.train_dataset = self.create_train_dataset()
+        self.setup_train()
+
     def next_train(self, step: int) -> Tuple[RayBundle, Dict]:
         """Returns the next batch of data from the train dataloader."""
+        if self.config.curriculum_downscale_factors:
+            self.update_curriculum(step)
         self.train_count += 1
         image_batch = next(self.iter_train_image_dataloader)
         assert self.train_pixel_sampler is not None
@@ -59,12 +151,29 @@ class TetonNerfDatamanager(VanillaDataManager):
         ray_bundle = self.train_ray_generator(ray_indices)
         return ray_bundle, batch
     
+    def _get_pixel_sampler(self, dataset: TetonNerfDataset, num_rays_per_batch: int):
+        pixel_sampler = super()._get_pixel_sampler(dataset, num_rays_per_batch)
+        # Lets the sampler resolve the class names used in semantic_class_weights
+        if isinstance(pixel_sampler, TetonPixelSampler) and dataset.semantics is not None:
+            pixel_sampler.class_names = dataset.semantics.classes
+        return pixel_sampler
+
     def create_train_dataset(self) -> TetonNerfDataset:
-        self.train_dataparser_outputs = self.dataparser.get_dataparser_outputs(split="train")
+        if self.config.curriculum_downscale_factors:
+            assert len(self.config.curriculum_downscale_factors) == len(self.config.curriculum_steps), (
+                "Every curriculum level needs a starting step"
+            )
+            if not hasattr(self, "curriculum_level"):
+                self.curriculum_level = 0
+            downscale_factor = self.config.curriculum_downscale_factors[self.curriculum_level]
+            self.train_dataparser_outputs = self._get_train_dataparser_outputs(downscale_factor)
+        else:
+            self.train_dataparser_outputs = self.dataparser.get_dataparser_outputs(split="train")
         return TetonNerfDataset(
             dataparser_outputs=self.train_dataparser_outputs,
             scale_factor=self.config.camera_res_scale_factor,
-            use_monocular_depth=self.config.use_monocular_depth)
+            use_monocular_depth=self.config.use_monocular_depth,
+            load_confidence=self.config.pixel_sampler.depth_ray_fraction > 0)
 
     def create_eval_dataset(self) -> TetonNerfDataset:
         return TetonNerfDataset(
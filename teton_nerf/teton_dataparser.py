@@ -24,7 +24,7 @@ from nerfstudio.data.utils.dataparsers_utils import (
 from nerfstudio.utils.io import load_from_json
 from nerfstudio.utils.rich_utils import CONSOLE
 
-from teton_nerf.processing_tools.detectron import SemanticSegmentor
+from teton_nerf.semantic_classes import SEMANTIC_CLASSES
 
 MAX_AUTO_RESOLUTION = 1600
 
@@ -43,8 +43,7 @@ class TetonDataparser(Nerfstudio):
     
     def __init__(self, config: NerfstudioDataParserConfig):
         super().__init__(config)
-        segmentor = SemanticSegmentor()
-        self.semantic_classes = segmentor.expected_classes
+        self.semantic_classes = list(SEMANTIC_CLASSES)
     
     def _generate_dataparser_outputs(self, split="train"):
         assert self.config.data.exists(), f"Data directory {self.config.data} does not exist."
@@ -140,7 +139,8 @@ class TetonDataparser(Nerfstudio):
 
             if "depth_file_path" in frame:
                 depth_filepath = Path(frame["depth_file_path"])
-                depth_fname = self._get_fname(depth_filepath, data_dir, downsample_folder_prefix="depths_")
+                # ns-process-teton writes the downscaled depth maps to depth_2, depth_4, ...
+                depth_fname = self._get_fname(depth_filepath, data_dir, downsample_folder_prefix="depth_")
                 depth_filenames.append(depth_fname)
             
             if "confidence_file_path" in frame:
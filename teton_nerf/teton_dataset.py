@@ -22,9 +22,20 @@ from nerfstudio.utils.rich_utils import CONSOLE
 from teton_nerf.visualizations import compare_depth_and_image, visualize_depth_before_and_after_scaling
 
 class TetonNerfDataset(InputDataset):
-    exclude_batch_keys_from_device = InputDataset.exclude_batch_keys_from_device + ["mask", "semantics", "depth_image"]
+    exclude_batch_keys_from_device = InputDataset.exclude_batch_keys_from_device + [
+        "mask",
+        "semantics",
+        "depth_image",
+        "confidence",
+    ]
 
-    def __init__(self, dataparser_outputs: DataparserOutputs, scale_factor: float = 1.0, use_monocular_depth= True):
+    def __init__(
+        self,
+        dataparser_outputs: DataparserOutputs,
+        scale_factor: float = 1.0,
+        use_monocular_depth= True,
+        load_confidence: bool = False,
+    ):
         super().__init__(dataparser_outputs, scale_factor)
         # TODO: Include flag that can avoid this if not using semantics
         self.semantics = self.metadata["semantics"]
@@ -37,6 +48,9 @@ class TetonNerfDataset(InputDataset):
         self.split = dataparser_outputs.metadata["split"]
         self.depth_filenames = self.metadata["depth_filenames"]
         self.depth_unit_scale_factor = self.metadata["depth_unit_scale_factor"]
+        self.confidence_filenames = self.metadata.get("confidence_filenames")
+        # Only the confidence-aware pixel sampler reads the confidence maps of the batches
+        self.load_confidence = load_confidence
 
         if self.use_monocular_depth:
             assert len(dataparser_outputs.image_filenames) > 0 and (
@@ -44,7 +58,6 @@ class TetonNerfDataset(InputDataset):
             or dataparser_outputs.metadata["depth_filenames"] is not None
             ), "No depth images in dataset"
             
-            self.confidence_filenames = self.metadata.get("confidence_filenames")
             self._generate_depth_images(dataparser_outputs)
         
         self.depth_filenames = self.metadata["depth_filenames"]
@@ -176,6 +189,16 @@ class TetonNerfDataset(InputDataset):
             )
             
         metadata["depth_image"] = depth_image    
+
+        # Confidence maps are kept as uint8 and only used to pick which pixels to sample
+        if self.load_confidence and self.confidence_filenames is not None:
+            # The cameras of the dataset are rescaled by scale_factor, like the images the sampler indexes
+            height = int(self.cameras.height[image_idx])
+            width = int(self.cameras.width[image_idx])
+            pil_confidence = Image.open(self.confidence_filenames[image_idx])
+            if pil_confidence.size != (width, height):
+                pil_confidence = pil_confidence.resize((width, height), resample=Image.NEAREST)
+            metadata["confidence"] = torch.from_numpy(np.array(pil_confidence, dtype=np.uint8))[..., None]
             
         return metadata
     
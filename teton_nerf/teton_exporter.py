@@ -0,0 +1,417 @@
+"""
+Export scripts for Teton NeRF models that need more than the stock ns-export commands.
+"""
+
+from __future__ import annotations
+
+import copy
+import time
+from abc import ABC, abstractmethod
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Optional, Tuple, Union
+
+import torch
+import tyro
+from typing_extensions import Annotated, Literal
+
+from nerfstudio.data.scene_box import OrientedBox
+from nerfstudio.pipelines.base_pipeline import Pipeline
+from nerfstudio.utils.eval_utils import eval_setup
+from nerfstudio.utils.rich_utils import CONSOLE
+
+from teton_nerf.utils.get_pointcloud import generate_semantic_point_cloud, generate_voxel_point_cloud
+
+
+@dataclass
+class Exporter(ABC):
+    """Export from a YML config to a folder."""
+
+    load_config: Path
+    """Path to the config YAML file."""
+    output_dir: Path
+    """Path to the output directory."""
+
+    def main(self) -> None:
+        """Load the pipeline from the config and export it."""
+        _, pipeline, _, _ = eval_setup(self.load_config)
+        self.export(pipeline)
+
+    @abstractmethod
+    def export(self, pipeline: Pipeline) -> None:
+        """Export from a loaded pipeline, so that a pipeline kept in memory can be exported without reloading."""
+
+
+def scene_box_aabb(
+    pipeline: Pipeline,
+    bounding_box_min: Optional[Tuple[float, float, float]],
+    bounding_box_max: Optional[Tuple[float, float, float]],
+) -> torch.Tensor:
+    """Bounds of shape [2, 3] on the CPU, with the corners that are not set taken from the model's scene box."""
+    aabb = pipeline.model.scene_box.aabb.detach().float().cpu().clone()
+    if bounding_box_min is not None:
+        aabb[0] = torch.tensor(bounding_box_min, dtype=torch.float32)
+    if bounding_box_max is not None:
+        aabb[1] = torch.tensor(bounding_box_max, dtype=torch.float32)
+    return aabb
+
+
+@dataclass
+class ExportVoxelPointCloud(Exporter):
+    """Export NeRF as a voxel downsampled point cloud, streamed to a binary PLY file."""
+
+    num_points: int = 10000000
+    """Number of surface points to render. The exported cloud has one point per occupied voxel."""
+    voxel_size: float = 0.005
+    """Edge length of the voxels in the scene units of the model."""
+    min_samples_per_voxel: int = 1
+    """Drop voxels hit by fewer rendered points, a cheap way to remove floaters."""
+    remove_outliers: bool = True
+    """Remove outliers from the voxelized point cloud."""
+    std_ratio: float = 10.0
+    """Threshold based on STD of the average distances across the point cloud to remove outliers."""
+    use_bounding_box: bool = True
+    """Only query points within the bounding box"""
+    bounding_box_min: Optional[Tuple[float, float, float]] = (-1, -1, -1)
+    """Minimum of the bounding box, used if use_bounding_box is True."""
+    bounding_box_max: Optional[Tuple[float, float, float]] = (1, 1, 1)
+    """Maximum of the bounding box, used if use_bounding_box is True."""
+    obb_center: Optional[Tuple[float, float, float]] = None
+    """Center of the oriented bounding box."""
+    obb_rotation: Optional[Tuple[float, float, float]] = None
+    """Rotation of the oriented bounding box. Expressed as RPY Euler angles in radians"""
+    obb_scale: Optional[Tuple[float, float, float]] = None
+    """Scale of the oriented bounding box along each axis."""
+    num_rays_per_batch: int = 32768
+    """Number of rays to evaluate per batch. Decrease if you run out of memory."""
+    output_name: str = "point_cloud.ply"
+    """Name of the PLY file written to the output directory."""
+
+    def export(self, pipeline: Pipeline) -> None:
+        """Export voxel point cloud."""
+
+        if not self.output_dir.exists():
+            self.output_dir.mkdir(parents=True)
+
+        crop_obb = None
+        if self.obb_center is not None and self.obb_rotation is not None and self.obb_scale is not None:
+            crop_obb = OrientedBox.from_params(self.obb_center, self.obb_rotation, self.obb_scale)
+        output_path = self.output_dir / self.output_name
+        num_points = generate_voxel_point_cloud(
+            pipeline=pipeline,
+            output_path=output_path,
+            voxel_size=self.voxel_size,
+            num_points=self.num_points,
+            use_bounding_box=self.use_bounding_box,
+            bounding_box_min=self.bounding_box_min,
+            bounding_box_max=self.bounding_box_max,
+            crop_obb=crop_obb,
+            num_rays_per_batch=self.num_rays_per_batch,
+            min_samples_per_voxel=self.min_samples_per_voxel,
+            remove_outliers=self.remove_outliers,
+            std_ratio=self.std_ratio,
+        )
+        CONSOLE.print(f"[bold green]:white_check_mark: Saved {num_points} points to {output_path}")
+
+
+@dataclass
+class ExportSemanticPointCloud(Exporter):
+    """Export NeRF as a voxel downsampled point cloud labelled with the rendered semantic classes."""
+
+    classes: Tuple[str, ...] = ()
+    """Classes to export, e.g. wall floor tv. All classes except the null class if empty."""
+    per_class_files: bool = True
+    """Also write one PLY file per class to the semantics folder of the output directory."""
+    color_by_class: bool = False
+    """Color points with the class colors of panoptic_classes.json instead of the rendered RGB."""
+    num_points: int = 10000000
+    """Number of surface points to render. The exported cloud has one point per occupied voxel and class."""
+    voxel_size: float = 0.005
+    """Edge length of the voxels in the scene units of the model."""
+    min_samples_per_voxel: int = 1
+    """Drop voxels hit by fewer rendered points of a class."""
+    use_bounding_box: bool = True
+    """Only query points within the bounding box"""
+    bounding_box_min: Optional[Tuple[float, float, float]] = (-1, -1, -1)
+    """Minimum of the bounding box, used if use_bounding_box is True."""
+    bounding_box_max: Optional[Tuple[float, float, float]] = (1, 1, 1)
+    """Maximum of the bounding box, used if use_bounding_box is True."""
+    num_rays_per_batch: int = 32768
+    """Number of rays to evaluate per batch. Decrease if you run out of memory."""
+
+    def export(self, pipeline: Pipeline) -> None:
+        """Export semantic point cloud."""
+
+        if not self.output_dir.exists():
+            self.output_dir.mkdir(parents=True)
+
+        num_points = generate_semantic_point_cloud(
+            pipeline=pipeline,
+            output_dir=self.output_dir,
+            class_names=self.classes,
+            voxel_size=self.voxel_size,
+            num_points=self.num_points,
+            use_bounding_box=self.use_bounding_box,
+            bounding_box_min=self.bounding_box_min,
+            bounding_box_max=self.bounding_box_max,
+            num_rays_per_batch=self.num_rays_per_batch,
+            min_samples_per_voxel=self.min_samples_per_voxel,
+            per_class_files=self.per_class_files,
+            color_by_class=self.color_by_class,
+        )
+        CONSOLE.print(f"[bold green]:white_check_mark: Saved {sum(num_points.values())} points to {self.output_dir}")
+
+
+@dataclass
+class ExportDensityMesh(Exporter):
+    """Export a marching cubes mesh of the density field, colored by the RGB head."""
+
+    resolutions: Tuple[int, ...] = (256,)
+    """Grid resolutions to mesh, one mesh is written per resolution along with its runtime and peak memory."""
+    density_threshold: float = 10.0
+    """Density of the extracted isosurface."""
+    semantics: bool = False
+    """Label the vertices with the argmax of the semantic head."""
+    bounding_box_min: Optional[Tuple[float, float, float]] = None
+    """Minimum of the meshed volume, the minimum of the model's scene box if not set."""
+    bounding_box_max: Optional[Tuple[float, float, float]] = None
+    """Maximum of the meshed volume, the maximum of the model's scene box if not set."""
+    chunk_size: int = 1 << 20
+    """Maximum number of grid points evaluated at once. Decrease if you run out of memory."""
+    num_threads: Optional[int] = None
+    """Number of CPU threads used by torch, the torch default if not set."""
+
+    def export(self, pipeline: Pipeline) -> None:
+        """Export density mesh."""
+        from teton_nerf.utils.density_grid import extract_density_mesh, process_peak_memory_mb
+        from teton_nerf.utils.ply_writer import write_mesh_ply
+
+        if not self.output_dir.exists():
+            self.output_dir.mkdir(parents=True)
+
+        aabb = scene_box_aabb(pipeline, self.bounding_box_min, self.bounding_box_max)
+        for resolution in self.resolutions:
+            mesh, _ = extract_density_mesh(
+                pipeline.model.field,
+                aabb,
+                resolution,
+                density_threshold=self.density_threshold,
+                chunk_size=self.chunk_size,
+                semantics=self.semantics,
+                num_threads=self.num_threads,
+            )
+            output_path = self.output_dir / f"density_mesh_{resolution}.ply"
+            write_mesh_ply(output_path, **mesh)
+            CONSOLE.print(f"[bold green]:white_check_mark: Saved mesh to {output_path}")
+        if pipeline.device.type != "cuda":
+            CONSOLE.print(f"Peak process memory {process_peak_memory_mb():.0f} MB")
+
+
+@dataclass
+class ExportVoxelBake(Exporter):
+    """Bake the model into a sparse voxel grid that renders on the CPU, and compare it to the live model."""
+
+    resolution: int = 256
+    """Number of voxels along every axis of the bounding box."""
+    density_threshold: float = 1.0
+    """Voxels with a lower density are left empty."""
+    num_directions: int = 8
+    """Number of view directions the baked colors are averaged over."""
+    semantics: bool = False
+    """Bake the argmax of the semantic head as voxel labels."""
+    bounding_box_min: Optional[Tuple[float, float, float]] = None
+    """Minimum of the baked volume, the minimum of the model's scene box if not set."""
+    bounding_box_max: Optional[Tuple[float, float, float]] = None
+    """Maximum of the baked volume, the maximum of the model's scene box if not set."""
+    chunk_size: int = 1 << 20
+    """Maximum number of grid points evaluated at once. Decrease if you run out of memory."""
+    num_eval_views: int = 5
+    """Number of eval images rendered with the live model and the baked grid to compare them, 0 to skip."""
+    eval_downscale_factor: int = 4
+    """Downscale factor of the comparison renders."""
+    num_threads: Optional[int] = None
+    """Number of CPU threads of the baked renderer, the torch default if not set."""
+
+    def export(self, pipeline: Pipeline) -> None:
+        """Bake sparse voxels."""
+        from teton_nerf.utils.voxel_bake import bake_sparse_voxels
+
+        if not self.output_dir.exists():
+            self.output_dir.mkdir(parents=True)
+
+        aabb = scene_box_aabb(pipeline, self.bounding_box_min, self.bounding_box_max)
+        start_time = time.perf_counter()
+        grid = bake_sparse_voxels(
+            pipeline.model.field,
+            aabb,
+            resolution=self.resolution,
+            density_threshold=self.density_threshold,
+            num_directions=self.num_directions,
+            semantics=self.semantics,
+            chunk_size=self.chunk_size,
+        )
+        output_path = self.output_dir / f"voxels_{self.resolution}.npz"
+        grid.save(output_path)
+        CONSOLE.print(
+            f"[bold green]:white_check_mark: Baked in {time.perf_counter() - start_time:.1f}s, saved to {output_path}"
+        )
+        if self.num_eval_views > 0:
+            self.compare(pipeline, grid)
+
+    def compare(self, pipeline, grid) -> None:
+        """Renders eval views with the live model and the baked grid, and reports PSNR and frames per second."""
+        # The thread count is process-wide, a warm job engine runs later jobs in the same process
+        previous_threads = torch.get_num_threads()
+        if self.num_threads is not None:
+            torch.set_num_threads(self.num_threads)
+        try:
+            self._compare(pipeline, grid)
+        finally:
+            torch.set_num_threads(previous_threads)
+
+    def _compare(self, pipeline, grid) -> None:
+        dataset = pipeline.datamanager.eval_dataset
+        indices = torch.linspace(0, len(dataset) - 1, min(self.num_eval_views, len(dataset))).long().tolist()
+        # A copy, the eval cameras belong to the pipeline, which may stay loaded for renders after the export
+        cameras = copy.deepcopy(dataset.cameras)
+        cameras.rescale_output_resolution(1.0 / self.eval_downscale_factor)
+
+        psnrs = {"live": [], "baked": [], "baked_to_live": []}
+        seconds = {"live": 0.0, "baked": 0.0}
+        for idx in indices:
+            camera = cameras[idx : idx + 1]
+            start = time.perf_counter()
+            with torch.no_grad():
+                live = pipeline.model.get_outputs_for_camera(camera.to(pipeline.device))["rgb"].float().cpu()
+            seconds["live"] += time.perf_counter() - start
+            start = time.perf_counter()
+            baked = grid.render_camera(camera)["rgb"]
+            seconds["baked"] += time.perf_counter() - start
+
+            image = dataset.get_image_float32(idx).permute(2, 0, 1)[None, :3]
+            image = torch.nn.functional.interpolate(image, size=baked.shape[:2], mode="area")[0].permute(1, 2, 0)
+            comparisons = (("live", live, image), ("baked", baked, image), ("baked_to_live", baked, live))
+            for name, prediction, target in comparisons:
+                psnrs[name].append(float(-10 * torch.log10(torch.mean((prediction - target) ** 2))))
+
+        mean = {name: sum(values) / len(values) for name, values in psnrs.items()}
+        CONSOLE.print(
+            f"{len(indices)} eval views at 1/{self.eval_downscale_factor} resolution | "
+            f"PSNR live {mean['live']:.2f} dB, baked {mean['baked']:.2f} dB, "
+            f"gap {mean['live'] - mean['baked']:.2f} dB, baked to live {mean['baked_to_live']:.2f} dB"
+        )
+        CONSOLE.print(
+            f"Frames per second: baked on CPU ({torch.get_num_threads()} threads) "
+            f"{len(indices) / seconds['baked']:.2f}, "
+            f"live model on {pipeline.device} {len(indices) / seconds['live']:.2f}"
+        )
+
+
+@dataclass
+class ExportLidarFusion:
+    """Fuse the captured LiDAR depth of a processed dataset into a point cloud or TSDF mesh, no model needed."""
+
+    data: Path
+    """Path to the dataset processed with ns-process-teton."""
+    output_dir: Path
+    """Path to the output directory."""
+    method: Literal["pointcloud", "tsdf"] = "pointcloud"
+    """Fuse into a voxel downsampled point cloud or into a TSDF volume that is meshed with marching cubes."""
+    splits: Tuple[str, ...] = ("train", "val")
+    """Dataparser splits whose frames are fused."""
+    downscale_factor: Optional[int] = None
+    """Downscale factor of the images and depth maps to load, chosen by the dataparser if not set."""
+    use_monocular_depth: bool = False
+    """Use the LiDAR depth extended with monocular depth cached by training instead of the confident LiDAR depth."""
+    confidence_threshold: int = 255
+    """Minimum value in the confidence maps for a depth value to be used."""
+    max_depth: Optional[float] = 5.0
+    """Drop depth values beyond this distance in meters, the LiDAR is unreliable far away."""
+    voxel_size: float = 0.005
+    """Edge length of the point cloud voxels in scene units."""
+    remove_outliers: bool = False
+    """Remove outliers from the fused point cloud."""
+    std_ratio: float = 10.0
+    """Threshold based on STD of the average distances across the point cloud to remove outliers."""
+    resolution: int = 256
+    """Number of TSDF voxels along every axis."""
+    bounding_box_min: Tuple[float, float, float] = (-1, -1, -1)
+    """Minimum of the TSDF volume."""
+    bounding_box_max: Tuple[float, float, float] = (1, 1, 1)
+    """Maximum of the TSDF volume."""
+    num_workers: int = 8
+    """Number of threads loading frames."""
+    device: str = "cuda" if torch.cuda.is_available() else "cpu"
+    """Device the fusion runs on."""
+
+    def main(self) -> None:
+        """Fuse LiDAR depth."""
+        from teton_nerf.teton_dataparser import TetonDataparserConfig
+        from teton_nerf.utils.lidar_fusion import LidarFrameLoader, fuse_point_cloud, fuse_tsdf_mesh
+
+        if not self.output_dir.exists():
+            self.output_dir.mkdir(parents=True)
+
+        start_time = time.perf_counter()
+        dataparser = TetonDataparserConfig(data=self.data, downscale_factor=self.downscale_factor).setup()
+        loaders = tuple(
+            LidarFrameLoader(
+                dataparser.get_dataparser_outputs(split=split),
+                use_monocular_depth=self.use_monocular_depth,
+                confidence_threshold=self.confidence_threshold,
+                max_depth=self.max_depth,
+            )
+            for split in self.splits
+        )
+        if self.method == "pointcloud":
+            output_path = self.output_dir / "lidar_point_cloud.ply"
+            num_points = fuse_point_cloud(
+                loaders,
+                output_path,
+                voxel_size=self.voxel_size,
+                device=self.device,
+                num_workers=self.num_workers,
+                remove_outliers=self.remove_outliers,
+                std_ratio=self.std_ratio,
+            )
+            CONSOLE.print(f"[bold green]:white_check_mark: Saved {num_points} points to {output_path}")
+        else:
+            output_path = self.output_dir / "lidar_tsdf_mesh.ply"
+            fuse_tsdf_mesh(
+                loaders,
+                output_path,
+                resolution=self.resolution,
+                bounding_box_min=self.bounding_box_min,
+                bounding_box_max=self.bounding_box_max,
+                device=self.device,
+                num_workers=self.num_workers,
+            )
+            CONSOLE.print(f"[bold green]:white_check_mark: Saved mesh to {output_path}")
+        num_frames = sum(len(loader) for loader in loaders)
+        CONSOLE.print(f"Fused {num_frames} frames in {time.perf_counter() - start_time:.1f}s")
+
+
+Commands = tyro.conf.FlagConversionOff[
+    Union[
+        Annotated[ExportVoxelPointCloud, tyro.conf.subcommand(name="voxel-pointcloud")],
+        Annotated[ExportSemanticPointCloud, tyro.conf.subcommand(name="semantic-pointcloud")],
+        Annotated[ExportDensityMesh, tyro.conf.subcommand(name="density-mesh")],
+        Annotated[ExportVoxelBake, tyro.conf.subcommand(name="voxel-bake")],
+        Annotated[ExportLidarFusion, tyro.conf.subcommand(name="lidar")],
+    ]
+]
+
+
+def entrypoint():
+    """Entrypoint for use with pyproject scripts."""
+    tyro.extras.set_accent_color("bright_yellow")
+    tyro.cli(Commands).main()
+
+
+if __name__ == "__main__":
+    entrypoint()
+
+
+def get_parser_fn():
+    """Get the parser function for the sphinx docs."""
+    return tyro.extras.get_parser(Commands)  # type: ignore
@@ -1,8 +1,9 @@
 """Model that combines all the functionality from bachelorproject"""
 from __future__ import annotations
 
-from dataclasses import dataclass, field
-from typing import Dict, List, Literal, Tuple, Type
+from dataclasses import dataclass, field, fields
+from pathlib import Path
+from typing import Callable, Dict, List, Literal, Optional, Tuple, Type
 
 import numpy as np
 import torch
@@ -10,22 +11,33 @@ from PIL import Image
 from torch.nn import Parameter
 
 
+from nerfstudio.cameras.cameras import Cameras
 from nerfstudio.cameras.rays import RayBundle, RaySamples
+from nerfstudio.engine.callbacks import TrainingCallback, TrainingCallbackAttributes, TrainingCallbackLocation
 from nerfstudio.field_components.field_heads import FieldHeadNames
 from nerfstudio.field_components.spatial_distortions import SceneContraction
 
 from nerfstudio.fields.nerfacto_field import NerfactoField
 from nerfstudio.model_components.losses import (
+    orientation_loss,
+    pred_normal_loss,
     distortion_loss,
     scale_gradients_by_distance_squared,
 )
 from nerfstudio.utils import colormaps
-from nerfstudio.model_components.losses import DepthLossType, depth_loss, depth_ranking_loss
+from nerfstudio.model_components.losses import DepthLossType, depth_ranking_loss
 from nerfstudio.data.dataparsers.base_dataparser import Semantics
+from nerfstudio.data.scene_box import OrientedBox
+from nerfstudio.model_components import renderers
 from nerfstudio.model_components.renderers import SemanticRenderer
+from nerfstudio.model_components.ray_samplers import ProposalNetworkSampler
 from nerfstudio.models.nerfacto import NerfactoModel, NerfactoModelConfig
 from nerfstudio.utils import profiler
 
+from teton_nerf.utils.losses import batched_depth_loss
+from teton_nerf.utils.occupancy_grid import OccupancyGrid
+from teton_nerf.utils.render_cache import RenderCache, camera_cache_key, model_digest
+
 
 @dataclass
 class TetonNerfModelConfig(NerfactoModelConfig):
@@ -43,6 +55,9 @@ class TetonNerfModelConfig(NerfactoModelConfig):
     semantic_loss_weight: float = 1e-3
     """Multiplier for the semantic loss"""
     pass_semantic_gradients: bool = False
+    report_semantic_ray_counts: bool = False
+    """Whether to report the number of training rays per semantic class as metrics, e.g. to check the class balance
+    of the pixel sampler. Costs a synchronization per class every step"""
     
     # Depth stuff
     depth_loss_mult: float = 1e-3
@@ -55,6 +70,34 @@ class TetonNerfModelConfig(NerfactoModelConfig):
     use_depth: bool = True
     """Whether to use depth supervision"""
 
+    # Occupancy grid
+    use_occupancy_grid: bool = False
+    """Skip empty space in inference with an occupancy grid built from the density of the field."""
+    occupancy_grid_resolution: int = 128
+    """Number of occupancy grid cells along every axis of the contracted space."""
+    occupancy_grid_density_threshold: float = 0.01
+    """Density above which a cell counts as occupied."""
+    occupancy_grid_march_steps: int = 512
+    """Number of steps used to find the occupied span of every ray."""
+    occupancy_grid_num_proposal_samples_per_ray: Optional[Tuple[int, ...]] = None
+    """Proposal samples per ray in inference with the grid. The spans the grid leaves are short, so fewer samples
+    are needed than for the whole ray. Uses num_proposal_samples_per_ray if not set."""
+    occupancy_grid_refresh_steps: int = 2000
+    """Mark the grid stale every this many training steps, so renders during training rebuild it. Never if 0."""
+
+    # Render cache
+    use_render_cache: bool = False
+    """Cache the outputs of rendered cameras, so poses the viewer or render scripts revisit are not rendered again."""
+    render_cache_memory_mb: float = 1024
+    """Memory budget of the render cache, least recently used renders are evicted first."""
+    render_cache_spill_dir: Optional[Path] = None
+    """Directory renders evicted from memory are written to. They are dropped if not set."""
+    render_cache_disk_mb: float = 8192
+    """Budget of the spill directory."""
+    render_cache_outputs: Optional[Tuple[str, ...]] = None
+    """Outputs kept in the cache, all if not set. Restricting them, e.g. to rgb depth accumulation
+    semantics_colormap, saves memory but only suits the render scripts, the viewer expects every output."""
+
 
 class TetonNerfModel(NerfactoModel):
     """Nerfacto model
@@ -71,10 +114,28 @@ class TetonNerfModel(NerfactoModel):
         if self.semantics is not None:
             self.colormap = self.semantics.colors.clone().detach().to(self.device)
         
+        # Kept as a buffer so the sigma lives (and decays) on the model's device
         if self.config.should_decay_sigma:
-            self.depth_sigma = torch.tensor([self.config.starting_depth_sigma])
+            depth_sigma = torch.tensor([self.config.starting_depth_sigma])
         else:
-            self.depth_sigma = torch.tensor([self.config.depth_sigma])
+            depth_sigma = torch.tensor([self.config.depth_sigma])
+        self.register_buffer("depth_sigma", depth_sigma, persistent=False)
+
+        self.render_cache = None
+        if self.config.use_render_cache:
+            self.render_cache = RenderCache(
+                max_memory_mb=self.config.render_cache_memory_mb,
+                spill_dir=self.config.render_cache_spill_dir,
+                max_disk_mb=self.config.render_cache_disk_mb,
+            )
+        # Step of the weights, part of the render cache keys
+        self.render_cache_step = 0
+        # Step of the last camera render, renders while the step advances, i.e. during training, are not cached
+        self._render_cache_seen_step = 0
+        # Digest of the weights at render_cache_step and of the config that affects renders, computed on first use
+        self._render_cache_digest: Optional[Tuple[int, str]] = None
+        # Outputs of a full render, entries the viewer is served from have to hold all of them
+        self._render_output_names: Optional[List[str]] = None
     
     def populate_modules(self):
         """Set the fields and modules."""
@@ -118,6 +179,32 @@ class TetonNerfModel(NerfactoModel):
         self.renderer_semantics = SemanticRenderer()
         self.cross_entropy_loss = torch.nn.CrossEntropyLoss(reduction="mean")
 
+        self.occupancy_grid = None
+        if self.config.use_occupancy_grid:
+            self.occupancy_grid = OccupancyGrid(
+                self.scene_box.aabb,
+                resolution=self.config.occupancy_grid_resolution,
+                contracted=not self.config.disable_scene_contraction,
+            )
+
+        # Separate sampler for the short spans the grid leaves, so inference never changes the training sampler
+        self.occupancy_grid_sampler = self.proposal_sampler
+        if self.config.use_occupancy_grid and self.config.occupancy_grid_num_proposal_samples_per_ray is not None:
+            self.occupancy_grid_sampler = self.make_proposal_sampler(
+                self.config.occupancy_grid_num_proposal_samples_per_ray
+            )
+
+    def make_proposal_sampler(self, num_proposal_samples_per_ray: Tuple[int, ...]) -> ProposalNetworkSampler:
+        """Proposal sampler like the model's, with other numbers of proposal samples per ray."""
+        return ProposalNetworkSampler(
+            num_nerf_samples_per_ray=self.config.num_nerf_samples_per_ray,
+            num_proposal_samples_per_ray=num_proposal_samples_per_ray,
+            num_proposal_network_iterations=self.config.num_proposal_iterations,
+            single_jitter=self.config.use_single_jitter,
+            update_sched=self.proposal_sampler.update_sched,
+            initial_sampler=self.proposal_sampler.initial_sampler,
+        )
+
     def get_param_groups(self) -> Dict[str, List[Parameter]]:
         param_groups = {}
         param_groups["proposal_networks"] = list(self.proposal_networks.parameters())
@@ -125,24 +212,131 @@ class TetonNerfModel(NerfactoModel):
         self.camera_optimizer.get_param_groups(param_groups=param_groups)
         return param_groups
 
+    def get_training_callbacks(
+        self, training_callback_attributes: TrainingCallbackAttributes
+    ) -> List[TrainingCallback]:
+        callbacks = super().get_training_callbacks(training_callback_attributes)
+        if self.occupancy_grid is not None and self.config.occupancy_grid_refresh_steps > 0:
+            callbacks.append(
+                TrainingCallback(
+                    where_to_run=[TrainingCallbackLocation.AFTER_TRAIN_ITERATION],
+                    update_every_num_iters=self.config.occupancy_grid_refresh_steps,
+                    func=lambda step: self.occupancy_grid.mark_stale(),
+                )
+            )
+        if self.render_cache is not None:
+
+            def set_render_cache_step(step: int) -> None:
+                self.render_cache_step = step
+
+            # The weights change every step, renders of earlier steps are never hit again
+            callbacks.append(
+                TrainingCallback(
+                    where_to_run=[TrainingCallbackLocation.AFTER_TRAIN_ITERATION],
+                    update_every_num_iters=1,
+                    func=set_render_cache_step,
+                )
+            )
+        return callbacks
+
+    def update_to_step(self, step: int) -> None:
+        super().update_to_step(step)
+        # The grid is built lazily from the loaded density on the first inference
+        if self.occupancy_grid is not None:
+            self.occupancy_grid.mark_stale()
+        self.render_cache_step = step
+        self._render_cache_seen_step = step
+        # The checkpoint of the step is loaded after this, the digest is taken on the first render
+        self._render_cache_digest = None
+
+    def render_cache_key(self, camera: Cameras) -> str:
+        """Render cache key of a single camera with the current weights and config."""
+        if self._render_cache_digest is None or self._render_cache_digest[0] != self.render_cache_step:
+            config = {
+                config_field.name: getattr(self.config, config_field.name)
+                for config_field in fields(self.config)
+                if "render_cache" not in config_field.name
+            }
+            self._render_cache_digest = (self.render_cache_step, model_digest(self, repr(config)))
+        return camera_cache_key(camera, self.render_cache_step, self._render_cache_digest[1])
+
+    @torch.no_grad()
+    def get_outputs_for_camera(self, camera: Cameras, obb_box: Optional[OrientedBox] = None) -> Dict[str, torch.Tensor]:
+        """Renders the camera, or takes its outputs from the render cache if it was rendered before."""
+        # Crops and background overrides change the outputs without changing the camera, they bypass the cache
+        # The weights change every training step, renders made while they do are never hit again
+        step_advanced = self.render_cache_step != self._render_cache_seen_step
+        self._render_cache_seen_step = self.render_cache_step
+        if (
+            self.render_cache is None
+            or step_advanced
+            or obb_box is not None
+            or renderers.BACKGROUND_COLOR_OVERRIDE is not None
+        ):
+            return super().get_outputs_for_camera(camera, obb_box=obb_box)
+        key = self.render_cache_key(camera)
+        # Entries of the render scripts may hold some outputs only, they are misses for the viewer
+        outputs = self.render_cache.get(key, self._render_output_names) if self._render_output_names else None
+        if outputs is not None:
+            return {name: value.to(camera.device) for name, value in outputs.items()}
+        outputs = super().get_outputs_for_camera(camera)
+        self._render_output_names = list(outputs)
+        cached_names = self.config.render_cache_outputs or outputs.keys()
+        self.render_cache.put(key, {name: outputs[name] for name in cached_names if name in outputs})
+        return outputs
+
     def get_outputs(self, ray_bundle: RayBundle):
-        outputs = super().get_outputs(ray_bundle)  # Get nerfacto outputs
+        if self.occupancy_grid is not None and not self.training and ray_bundle.nears is not None:
+            return self._get_outputs_skipping_empty_space(ray_bundle, self._get_outputs)
+        return self._get_outputs(ray_bundle, self.proposal_sampler)
+
+    def _get_outputs(self, ray_bundle: RayBundle, proposal_sampler: ProposalNetworkSampler):
+        """Nerfacto outputs plus semantics, from a single pass of proposal_sampler and the field."""
         if self.training:
             self.camera_optimizer.apply_to_raybundle(ray_bundle)
         ray_samples: RaySamples
-        ray_samples, weights_list, ray_samples_list = self.proposal_sampler(ray_bundle, density_fns=self.density_fns)
+        ray_samples, weights_list, ray_samples_list = proposal_sampler(ray_bundle, density_fns=self.density_fns)
         field_outputs = self.field.forward(ray_samples, compute_normals=self.config.predict_normals)
         if self.config.use_gradient_scaling:
             field_outputs = scale_gradients_by_distance_squared(field_outputs, ray_samples)
-            
-        # If depth supervision is applicable, add depth-related outputs
-        if ray_bundle.metadata is not None and "directions_norm" in ray_bundle.metadata:
-            outputs["directions_norm"] = ray_bundle.metadata["directions_norm"]
 
         weights = ray_samples.get_weights(field_outputs[FieldHeadNames.DENSITY])
         weights_list.append(weights)
         ray_samples_list.append(ray_samples)
-        
+
+        with torch.no_grad():
+            depth = self.renderer_depth(weights=weights, ray_samples=ray_samples)
+        outputs = {
+            "rgb": self.renderer_rgb(rgb=field_outputs[FieldHeadNames.RGB], weights=weights),
+            "accumulation": self.renderer_accumulation(weights=weights),
+            "depth": depth,
+            "expected_depth": self.renderer_expected_depth(weights=weights, ray_samples=ray_samples),
+        }
+        if self.config.predict_normals:
+            normals = self.renderer_normals(normals=field_outputs[FieldHeadNames.NORMALS], weights=weights)
+            pred_normals = self.renderer_normals(field_outputs[FieldHeadNames.PRED_NORMALS], weights=weights)
+            outputs["normals"] = self.normals_shader(normals)
+            outputs["pred_normals"] = self.normals_shader(pred_normals)
+        # These use a lot of memory, so they are only kept for the losses
+        if self.training:
+            outputs["weights_list"] = weights_list
+            outputs["ray_samples_list"] = ray_samples_list
+        if self.training and self.config.predict_normals:
+            outputs["rendered_orientation_loss"] = orientation_loss(
+                weights.detach(), field_outputs[FieldHeadNames.NORMALS], ray_bundle.directions
+            )
+            outputs["rendered_pred_normal_loss"] = pred_normal_loss(
+                weights.detach(),
+                field_outputs[FieldHeadNames.NORMALS].detach(),
+                field_outputs[FieldHeadNames.PRED_NORMALS],
+            )
+        for i in range(self.config.num_proposal_iterations):
+            outputs[f"prop_depth_{i}"] = self.renderer_depth(weights=weights_list[i], ray_samples=ray_samples_list[i])
+
+        # If depth supervision is applicable, add depth-related outputs
+        if ray_bundle.metadata is not None and "directions_norm" in ray_bundle.metadata:
+            outputs["directions_norm"] = ray_bundle.metadata["directions_norm"]
+
         # Add semantics to output
         if self.config.use_semantics: 
             semantic_weights = weights
@@ -157,6 +351,84 @@ class TetonNerfModel(NerfactoModel):
 
         return outputs
 
+    @torch.inference_mode()
+    def get_point_cloud_outputs(self, ray_bundle: RayBundle, semantics: bool = False) -> Dict[str, torch.Tensor]:
+        """Lightweight forward pass that only renders what point cloud export needs (rgb, depth, accumulation),
+        and the argmax semantic labels if semantics is set.
+
+        Unlike get_outputs, the field is only evaluated once and no proposal depths or semantic logits are returned.
+        """
+        if self.collider is not None:
+            ray_bundle = self.collider(ray_bundle)
+        self.camera_optimizer.apply_to_raybundle(ray_bundle)
+        # The viewer point cloud is generated while training, when the grid is not kept up to date
+        if self.occupancy_grid is not None and not self.training and ray_bundle.nears is not None:
+            return self._get_outputs_skipping_empty_space(
+                ray_bundle, lambda rays, sampler: self._get_point_cloud_outputs(rays, sampler, semantics)
+            )
+        return self._get_point_cloud_outputs(ray_bundle, self.proposal_sampler, semantics)
+
+    def _get_point_cloud_outputs(
+        self, ray_bundle: RayBundle, proposal_sampler: ProposalNetworkSampler, semantics: bool
+    ) -> Dict[str, torch.Tensor]:
+        ray_samples, _, _ = proposal_sampler(ray_bundle, density_fns=self.density_fns)
+        field_outputs = self.field.forward(ray_samples)
+        weights = ray_samples.get_weights(field_outputs[FieldHeadNames.DENSITY])
+        outputs = {
+            "rgb": self.renderer_rgb(rgb=field_outputs[FieldHeadNames.RGB], weights=weights),
+            "depth": self.renderer_depth(weights=weights, ray_samples=ray_samples),
+            "accumulation": self.renderer_accumulation(weights=weights),
+        }
+        if semantics:
+            assert self.config.use_semantics, "The model was trained without semantics"
+            semantic_logits = self.renderer_semantics(field_outputs[FieldHeadNames.SEMANTICS], weights=weights)
+            outputs["semantic_labels"] = torch.argmax(semantic_logits, dim=-1)
+        return outputs
+
+    @torch.no_grad()
+    def _get_outputs_skipping_empty_space(
+        self,
+        ray_bundle: RayBundle,
+        get_outputs: Callable[[RayBundle, ProposalNetworkSampler], Dict[str, torch.Tensor]],
+    ) -> Dict[str, torch.Tensor]:
+        """Renders the rays with get_outputs and the grid's proposal sampler on the span the occupancy grid marks
+        as occupied.
+
+        Rays that pass no occupied cell are not rendered, their rgb is the background of a single sample at the
+        far end, their depths the far plane and all other outputs zero. The outputs have the same names whether
+        or not any ray hits, so chunks of a camera can be concatenated.
+        """
+        assert self.occupancy_grid is not None
+        if self.occupancy_grid.stale:
+            self.occupancy_grid.update(self.field.density_fn, self.config.occupancy_grid_density_threshold)
+        nears, fars, hits = self.occupancy_grid.march(ray_bundle, num_steps=self.config.occupancy_grid_march_steps)
+        original_fars = ray_bundle.fars
+        ray_bundle.nears, ray_bundle.fars = nears, fars
+
+        if bool(hits.all()):
+            return get_outputs(ray_bundle, self.occupancy_grid_sampler)
+        any_hits = bool(hits.any())
+        # Without hits a single ray is still rendered, only for the names and shapes of the outputs
+        hit_outputs = get_outputs(ray_bundle[hits] if any_hits else ray_bundle[:1], self.occupancy_grid_sampler)
+
+        empty_rays = ray_bundle[~hits]
+        ray_samples = empty_rays.get_ray_samples(bin_starts=nears[~hits, None], bin_ends=fars[~hits, None])
+        background = self.renderer_rgb(
+            rgb=self.field.forward(ray_samples)[FieldHeadNames.RGB], weights=torch.zeros_like(nears[~hits, None])
+        )
+        outputs = {}
+        for name, value in hit_outputs.items():
+            if not isinstance(value, torch.Tensor):
+                continue
+            outputs[name] = value.new_zeros((len(ray_bundle),) + value.shape[1:])
+            if any_hits:
+                outputs[name][hits] = value
+            if name == "rgb":
+                outputs[name][~hits] = background.to(value.dtype)
+            elif "depth" in name:
+                outputs[name][~hits] = original_fars[~hits].to(value.dtype)
+        return outputs
+
     def get_metrics_dict(self, outputs, batch):
         metrics_dict = {}
         gt_rgb = batch["image"].to(self.device)  # RGB or RGBA image
@@ -167,31 +439,36 @@ class TetonNerfModel(NerfactoModel):
         if self.training:
             metrics_dict["distortion"] = distortion_loss(outputs["weights_list"], outputs["ray_samples_list"])
 
+        if self.training and self.config.use_semantics and self.config.report_semantic_ray_counts:
+            ray_counts = torch.bincount(batch["semantics"].view(-1).long(), minlength=self.num_classes)
+            for class_name, count in zip(self.semantics.classes, ray_counts):
+                metrics_dict[f"semantic_rays/{class_name}"] = count
+
         # Add depth-related metrics if using depth supervision
         if self.training and self.config.use_depth:
             assert "depth_image" in batch
             depth_image = batch["depth_image"].unsqueeze(1).to(self.device)
             if self.config.depth_loss_type in (DepthLossType.DS_NERF, DepthLossType.URF):
-                sigma = self._get_sigma().to(self.device)
-                depth_loss_value = 0
-                for i in range(len(outputs["weights_list"])):
-                    depth_loss_value += depth_loss(
-                        weights=outputs["weights_list"][i],
-                        ray_samples=outputs["ray_samples_list"][i],
-                        termination_depth=depth_image,
-                        predicted_depth=outputs["depth"],
-                        sigma=sigma,
-                        directions_norm=outputs.get("directions_norm"),
-                        is_euclidean=self.config.is_euclidean_depth,
-                        depth_loss_type=self.config.depth_loss_type,
-                    )
-                metrics_dict["depth_loss"] = depth_loss_value / len(outputs["weights_list"])
+                metrics_dict["depth_loss"] = batched_depth_loss(
+                    weights_list=outputs["weights_list"],
+                    ray_samples_list=outputs["ray_samples_list"],
+                    termination_depth=depth_image,
+                    predicted_depth=outputs["depth"],
+                    sigma=self._get_sigma(),
+                    directions_norm=outputs.get("directions_norm"),
+                    is_euclidean=self.config.is_euclidean_depth,
+                    depth_loss_type=self.config.depth_loss_type,
+                )
             elif self.config.depth_loss_type == DepthLossType.SPARSENERF_RANKING:
                 metrics_dict["depth_ranking"] = depth_ranking_loss(
                     outputs["expected_depth"], depth_image
                 )
 
 
+        if self.training and self.render_cache is not None:
+            for name, value in self.render_cache.metrics().items():
+                metrics_dict[f"render_cache/{name}"] = value
+
         self.camera_optimizer.get_metrics_dict(metrics_dict)
         return metrics_dict
 
@@ -222,6 +499,28 @@ class TetonNerfModel(NerfactoModel):
 
         return loss_dict
 
+    @torch.no_grad()
+    def get_per_ray_errors(self, outputs: Dict[str, torch.Tensor], batch: Dict[str, torch.Tensor]) -> torch.Tensor:
+        """Combined RGB, depth and semantic error of every training ray, used for error-driven sampling.
+
+        Every term is kept roughly within [0, 1] so none of them dominates the sum.
+        """
+        gt_rgb = self.renderer_rgb.blend_background(batch["image"].to(self.device))
+        errors = torch.mean((outputs["rgb"] - gt_rgb) ** 2, dim=-1)
+
+        if self.config.use_depth:
+            ground_truth_depth = batch["depth_image"].to(self.device).view(-1)
+            depth_error = torch.abs(outputs["depth"].view(-1) - ground_truth_depth) / ground_truth_depth.clamp(min=1e-3)
+            errors = errors + torch.where(ground_truth_depth > 0, depth_error.clamp(max=1.0), 0.0)
+
+        if self.config.use_semantics:
+            semantics_gt = batch["semantics"].to(self.device).view(-1).long()
+            probabilities = torch.softmax(outputs["semantics"], dim=-1)
+            semantic_error = 1 - torch.gather(probabilities, -1, semantics_gt[:, None])[:, 0]
+            errors = errors + torch.where(semantics_gt != 0, semantic_error, 0.0)
+
+        return errors
+
     def get_image_metrics_and_images(
         self, outputs: Dict[str, torch.Tensor], batch: Dict[str, torch.Tensor]
     ) -> Tuple[Dict[str, float], Dict[str, torch.Tensor]]:
@@ -243,25 +542,66 @@ class TetonNerfModel(NerfactoModel):
         # if not self.config.is_euclidean_depth:
             # ground_truth_depth = ground_truth_depth * outputs["directions_norm"]
 
-        ground_truth_depth_colormap = colormaps.apply_depth_colormap(ground_truth_depth)
+        depth_mask = ground_truth_depth > 0
+        depth_mse = torch.nn.functional.mse_loss(outputs["depth"][depth_mask], ground_truth_depth[depth_mask])
+        # Single host sync for the depth range and the depth metric
+        near_plane, far_plane, depth_mse = torch.stack(
+            [torch.min(ground_truth_depth), torch.max(ground_truth_depth), depth_mse]
+        ).tolist()
+        metrics_dict["depth_mse"] = depth_mse
+
+        ground_truth_depth_colormap = colormaps.apply_depth_colormap(
+            ground_truth_depth, near_plane=near_plane, far_plane=far_plane
+        )
         predicted_depth_colormap = colormaps.apply_depth_colormap(
             outputs["depth"],
             accumulation=outputs["accumulation"],
-            near_plane=float(torch.min(ground_truth_depth).cpu()),
-            far_plane=float(torch.max(ground_truth_depth).cpu()),
+            near_plane=near_plane,
+            far_plane=far_plane,
         )
         images_dict["depth"] = torch.cat([ground_truth_depth_colormap, predicted_depth_colormap], dim=1)
-        depth_mask = ground_truth_depth > 0
-        metrics_dict["depth_mse"] = float(
-            torch.nn.functional.mse_loss(outputs["depth"][depth_mask], ground_truth_depth[depth_mask]).cpu()
-        )
             
         return metrics_dict, images_dict
 
+    def get_eval_metric_sums(
+        self, outputs: Dict[str, torch.Tensor], batch: Dict[str, torch.Tensor], image_ids: torch.Tensor, num_images: int
+    ) -> Dict[str, torch.Tensor]:
+        """Per-image sums of the eval metrics for a chunk of rays that may span several images.
+
+        Everything stays on the device so the batched evaluation in the pipeline only syncs once.
+
+        Args:
+            outputs: Model outputs for the flattened rays.
+            batch: Ground truth for the same rays.
+            image_ids: Index of the eval image each ray belongs to.
+            num_images: Total number of eval images being accumulated.
+        """
+        sums = {}
+
+        def scatter(values: torch.Tensor) -> torch.Tensor:
+            return torch.zeros(num_images, device=self.device).index_add_(0, image_ids, values.float())
+
+        gt_rgb = self.renderer_rgb.blend_background(batch["image"].to(self.device))
+        sums["rgb_se"] = scatter(torch.mean((outputs["rgb"] - gt_rgb) ** 2, dim=-1))
+        sums["rgb_count"] = scatter(torch.ones_like(image_ids))
+
+        ground_truth_depth = batch["depth_image"].to(self.device).view(-1)
+        depth_mask = ground_truth_depth > 0
+        depth_se = (outputs["depth"].view(-1) - ground_truth_depth) ** 2
+        sums["depth_se"] = scatter(depth_se * depth_mask)
+        sums["depth_count"] = scatter(depth_mask)
+
+        if self.config.use_semantics:
+            semantic_labels = torch.argmax(outputs["semantics"], dim=-1)
+            gt_semantics = batch["semantics"].to(self.device).view(-1).long()
+            valid_mask = gt_semantics != 0
+            sums["semantics_correct"] = scatter((semantic_labels == gt_semantics) & valid_mask)
+            sums["semantics_count"] = scatter(valid_mask)
+
+        return sums
+
     def _get_sigma(self):
         if not self.config.should_decay_sigma:
             return self.depth_sigma
-        self.depth_sigma = torch.maximum(
-            self.config.sigma_decay_rate * self.depth_sigma, torch.tensor([self.config.depth_sigma])
-        )
+        self.depth_sigma.mul_(self.config.sigma_decay_rate).clamp_(min=self.config.depth_sigma)
         return self.depth_sigma
\ No newline at end of file
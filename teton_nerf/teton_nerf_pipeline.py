@@ -2,9 +2,14 @@
 Pipeline for  semantic depth nerfacto. Very similar to vanilla pipeline
 """
 
+import contextlib
+import threading
+import traceback
 import torch
 import typing
 from dataclasses import dataclass, field
+from pathlib import Path
+from time import time
 from typing import Dict, Optional, List, Literal, Tuple, Type
 from torchtyping import TensorType
 import torch
@@ -17,12 +22,13 @@ from torch.nn.parallel import DistributedDataParallel as DDP
 from teton_nerf.teton_datamanager import TetonNerfDatamanagerConfig
 from teton_nerf.teton_nerf import TetonNerfModel, TetonNerfModelConfig
 from teton_nerf.utils.random_train_pose import random_train_pose
-from teton_nerf.utils.get_pointcloud import generate_point_cloud
+from teton_nerf.utils.get_pointcloud import sample_point_cloud_batches
 
 from nerfstudio.data.datamanagers.base_datamanager import (
     DataManager,
     DataManagerConfig,
 )
+from nerfstudio.engine.callbacks import TrainingCallback, TrainingCallbackAttributes, TrainingCallbackLocation
 
 from nerfstudio.viewer.viewer_elements import ViewerControl
 from nerfstudio.viewer.control_panel import ViewerCheckbox
@@ -36,6 +42,7 @@ from nerfstudio.pipelines.base_pipeline import (
     VanillaPipelineConfig,
 )
 from nerfstudio.utils import profiler
+from nerfstudio.utils.rich_utils import CONSOLE
 
 @dataclass
 class TetonNerfPipelineConfig(VanillaPipelineConfig):
@@ -79,6 +86,19 @@ class TetonNerfPipelineConfig(VanillaPipelineConfig):
     regnerf_semantics_loss_mult: float = 1.0
     """Multiplier on patch-based semantics loss"""
 
+    # Evaluation
+    batched_eval: bool = False
+    """Whether to evaluate all eval images with the batched metrics-only engine (psnr, depth_mse, semantic_accuracy)
+    instead of rendering and scoring one full image at a time. Does not compute ssim/lpips."""
+    eval_images_per_batch: int = 4
+    """Number of eval images whose rays are rendered together by the batched eval engine"""
+
+    # Viewer point cloud
+    point_cloud_num_points: int = 1000000
+    """Number of points of the point cloud shown in the viewer"""
+    point_cloud_refresh_steps: int = 2000
+    """Regenerate the shown point cloud in the background after this many training steps, 0 never refreshes it"""
+
 
 class TetonNerfPipeline(VanillaPipeline):
     """Template Pipeline
@@ -121,42 +141,215 @@ class TetonNerfPipeline(VanillaPipeline):
             )
             dist.barrier(device_ids=[local_rank])
             
-        # Stuff to visualize pointcloud in viewer
+        # Stuff to visualize pointcloud in viewer. The cloud is cached with the step it was generated at
+        self._point_cloud: Optional[Tuple[np.ndarray, np.ndarray]] = None
+        self._point_cloud_step: Optional[int] = None
+        self._point_cloud_handle = None
+        self._point_cloud_thread: Optional[threading.Thread] = None
+        self._train_step = 0
         self.show_pcd_button = ViewerCheckbox("Show Point Cloud", False, cb_hook=self.add_point_clouds)
         self.viewer_control = ViewerControl() # This will be found and _setup by viewer
         
     def add_point_clouds(self, checkbox: ViewerCheckbox):
-        # TODO: add point cloud to the viewer
-        # take the depth images and backproject them to 3D points
-        
-        pcd = generate_point_cloud(pipeline=self,
-                                   remove_outliers=False,
-                                   bounding_box_min=(-2, -2, -2),
-                                   bounding_box_max=(2, 2, 2))
-
-        colors = np.asarray(pcd.colors)
-        points = np.asarray(pcd.points)
-        poses = np.eye(4, dtype=np.float32)[None, ...].repeat(points.shape[0], axis=0)[:, :3, :]
-        poses[:, :3, 3] = points
-        poses = self.datamanager.train_dataparser_outputs.transform_poses_to_original_space(
-            torch.from_numpy(poses)
+        """Shows the cached point cloud, generating it in the background if there is none yet."""
+        if not checkbox.value:
+            if self._point_cloud_handle is not None:
+                self._point_cloud_handle.remove()
+                self._point_cloud_handle = None
+            return
+        if self._point_cloud is None:
+            self.refresh_point_cloud()
+        else:
+            self._show_point_cloud()
+
+    def refresh_point_cloud(self) -> None:
+        """Regenerates the viewer point cloud in a background thread, unless a refresh is already running."""
+        if self._point_cloud_thread is not None and self._point_cloud_thread.is_alive():
+            return
+        self._point_cloud_thread = threading.Thread(
+            target=self._generate_viewer_point_cloud, args=(self._train_step,), daemon=True
         )
-        points = poses[:, :3, 3].numpy()
-        points *= 1 # Try to scale to fit scene better
-        torch.cuda.empty_cache()
-        
-        if checkbox.value:
-            self.viewer_control.viser_server.add_point_cloud(
-                name="point_cloud",
-                points=points,
-                colors=colors,
-                point_size=0.01,
-                point_shape="rounded",
+        self._point_cloud_thread.start()
+
+    @contextlib.contextmanager
+    def _viewer_render_mode(self):
+        """Holds the train lock with the model in eval mode, the same as the viewer's own renders."""
+        train_lock = getattr(getattr(self.viewer_control, "viewer", None), "train_lock", None)
+        with train_lock if train_lock is not None else contextlib.nullcontext():
+            # Every render resets the proposal update counter of the sampler, which would skip updates of training
+            model_samplers = (self.model.proposal_sampler, self.model.occupancy_grid_sampler)
+            samplers = {id(sampler): sampler for sampler in model_samplers}
+            steps_since_update = {key: sampler._steps_since_update for key, sampler in samplers.items()}
+            training = self.model.training
+            self.model.eval()
+            try:
+                yield
+            finally:
+                self.model.train(training)
+                for key, sampler in samplers.items():
+                    sampler._steps_since_update = steps_since_update[key]
+
+    def _generate_viewer_point_cloud(self, step: int) -> None:
+        try:
+            batches = sample_point_cloud_batches(
+                self,
+                num_points=self.config.point_cloud_num_points,
+                bounding_box_min=(-2, -2, -2),
+                bounding_box_max=(2, 2, 2),
             )
-        else:
-            pass
+            points, colors = [], []
+            while True:
+                # One batch at a time, so training steps run in between
+                with self._viewer_render_mode():
+                    batch = next(batches, None)
+                if batch is None:
+                    break
+                points.append(batch["points"])
+                colors.append(batch["rgbs"])
+            points = self.points_to_original_space(torch.cat(points))
+            self._point_cloud = (points.cpu().numpy(), torch.cat(colors).cpu().numpy())
+            self._point_cloud_step = step
+            torch.cuda.empty_cache()
+            if self.show_pcd_button.value:
+                self._show_point_cloud()
+        except (Exception, SystemExit):
+            # Would vanish with the thread otherwise
+            CONSOLE.print(f"[bold red]Generating the viewer point cloud failed:\n{traceback.format_exc()}")
+
+    def _show_point_cloud(self) -> None:
+        assert self._point_cloud is not None
+        points, colors = self._point_cloud
+        # Adding a point cloud under an existing name replaces it in the viewer
+        self._point_cloud_handle = self.viewer_control.viser_server.add_point_cloud(
+            name="point_cloud",
+            points=points,
+            colors=colors,
+            point_size=0.01,
+            point_shape="rounded",
+        )
+
+    def points_to_original_space(self, points: TensorType["num_points", 3]) -> TensorType["num_points", 3]:
+        """Undoes the dataparser scale and transform, same as transform_poses_to_original_space does for poses."""
+        dataparser_outputs = self.datamanager.train_dataparser_outputs
+        transform = dataparser_outputs.dataparser_transform.to(points)
+        rotation, translation = transform[:, :3], transform[:, 3]
+        return (points / dataparser_outputs.dataparser_scale - translation) @ torch.linalg.inv(rotation).T
+
+    def _update_point_cloud(self, step: int) -> None:
+        self._train_step = step
+        refresh_steps = self.config.point_cloud_refresh_steps
+        if (
+            refresh_steps > 0
+            and self.show_pcd_button.value
+            and self._point_cloud_step is not None
+            and step - self._point_cloud_step >= refresh_steps
+        ):
+            self.refresh_point_cloud()
+
+    def get_training_callbacks(
+        self, training_callback_attributes: TrainingCallbackAttributes
+    ) -> List[TrainingCallback]:
+        callbacks = super().get_training_callbacks(training_callback_attributes)
+        callbacks.append(
+            TrainingCallback(
+                where_to_run=[TrainingCallbackLocation.AFTER_TRAIN_ITERATION],
+                update_every_num_iters=1,
+                func=self._update_point_cloud,
+            )
+        )
+        return callbacks
+
+    @profiler.time_function
+    def get_average_eval_image_metrics(
+        self, step: Optional[int] = None, output_path: Optional[Path] = None, get_std: bool = False
+    ):
+        if not self.config.batched_eval or output_path is not None:
+            return super().get_average_eval_image_metrics(step=step, output_path=output_path, get_std=get_std)
+        return self.get_batched_eval_metrics(get_std=get_std)
+
+    @torch.no_grad()
+    def get_batched_eval_metrics(self, get_std: bool = False) -> Dict[str, float]:
+        """Renders ray chunks spanning several eval images at once and accumulates the metrics on the device.
+
+        No images are built and the host is only synced once at the end of the pass.
+
+        Args:
+            get_std: Set True if you want to return std with the mean metric.
+        """
+        self.eval()
+        dataset = self.datamanager.eval_dataset
+        cameras = dataset.cameras.to(self.device)
+        heights = dataset.cameras.height.view(-1).tolist()
+        widths = dataset.cameras.width.view(-1).tolist()
+        num_images = len(dataset)
+        num_rays_per_chunk = self.model.config.eval_num_rays_per_chunk
+        sums: Dict[str, torch.Tensor] = {}
+        num_rays = 0
+
+        start_time = time()
+        image_idx = 0
+        while image_idx < num_images:
+            # Rays of several cameras can only be generated together if they share a resolution
+            height, width = heights[image_idx], widths[image_idx]
+            indices = [image_idx]
+            while (
+                len(indices) < self.config.eval_images_per_batch
+                and indices[-1] + 1 < num_images
+                and heights[indices[-1] + 1] == height
+                and widths[indices[-1] + 1] == width
+            ):
+                indices.append(indices[-1] + 1)
+            image_idx = indices[-1] + 1
+
+            camera_indices = torch.tensor(indices, device=self.device).unsqueeze(-1)
+            ray_bundle = cameras.generate_rays(camera_indices=camera_indices)  # (height, width, num_cameras)
+
+            # Ground truth is stacked in the same (height, width, num_cameras) order as the rays
+            data = [dataset[i] for i in indices]
+            batch = {
+                key: torch.stack([d[key].to(self.device) for d in data], dim=2).flatten(0, 2)
+                for key in ("image", "depth_image", "semantics")
+                if key in data[0]
+            }
+            image_ids = (
+                torch.tensor(indices, device=self.device).view(1, 1, -1).expand(height, width, -1).reshape(-1)
+            )
+
+            num_batch_rays = len(image_ids)
+            for start in range(0, num_batch_rays, num_rays_per_chunk):
+                end = min(start + num_rays_per_chunk, num_batch_rays)
+                outputs = self.model(ray_bundle.get_row_major_sliced_ray_bundle(start, end))
+                chunk_sums = self.model.get_eval_metric_sums(
+                    outputs,
+                    {key: value[start:end] for key, value in batch.items()},
+                    image_ids[start:end],
+                    num_images,
+                )
+                for key, value in chunk_sums.items():
+                    sums[key] = sums[key] + value if key in sums else value
+            num_rays += num_batch_rays
+
+        per_image = {"psnr": -10 * torch.log10(sums["rgb_se"] / sums["rgb_count"])}
+        per_image["depth_mse"] = sums["depth_se"] / sums["depth_count"]
+        if "semantics_correct" in sums:
+            per_image["semantic_accuracy"] = sums["semantics_correct"] / sums["semantics_count"]
+
+        keys = list(per_image.keys())
+        values = torch.stack([torch.nanmean(per_image[key]) for key in keys])
+        if get_std:
+            values = torch.cat([values, torch.stack([torch.std(per_image[key]) for key in keys])])
+        values = values.tolist()  # The only host sync of the pass
+        elapsed = time() - start_time
+
+        metrics_dict = {key: values[i] for i, key in enumerate(keys)}
+        if get_std:
+            metrics_dict.update({f"{key}_std": values[len(keys) + i] for i, key in enumerate(keys)})
+        metrics_dict["num_rays_per_sec"] = num_rays / elapsed
+        metrics_dict["fps"] = num_images / elapsed
+        CONSOLE.print(f"Evaluated {num_images} images in {elapsed:.2f}s")
+        self.train()
+        return metrics_dict
 
-    
     # TODO: Add stuff that visualizes the patches
     def apply_regnerf_loss(self, step: int, patches_density: TensorType["num_patches", "res", "res"]):
         pd = patches_density
@@ -167,7 +360,13 @@ class TetonNerfPipeline(VanillaPipeline):
     
     @profiler.time_function
     def get_train_loss_dict(self, step: int):
-        model_outputs, loss_dict, metrics_dict = super().get_train_loss_dict(step)
+        ray_bundle, batch = self.datamanager.next_train(step)
+        model_outputs = self._model(ray_bundle)  # train distributed data parallel model if world_size > 1
+        metrics_dict = self.model.get_metrics_dict(model_outputs, batch)
+        loss_dict = self.model.get_loss_dict(model_outputs, batch, metrics_dict)
+
+        if getattr(self.datamanager.config, "error_sampling", False):
+            self.datamanager.update_error_maps(batch["indices"], self.model.get_per_ray_errors(model_outputs, batch))
 
         # --------------------- 2D losses ---------------------
         activate_patch_sampling = self.config.use_regnerf_depth_loss or self.config.use_regnerf_rgb_loss or self.config.use_regnerf_semantics_loss
@@ -0,0 +1,189 @@
+"""
+Pixel sampler that concentrates rays on pixels that actually carry supervision
+"""
+
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple, Type, Union
+
+import torch
+from jaxtyping import Int
+from torch import Tensor
+
+from nerfstudio.data.pixel_samplers import PixelSampler, PixelSamplerConfig
+
+
+@dataclass
+class TetonPixelSamplerConfig(PixelSamplerConfig):
+    """Pixel sampler that can draw a share of the rays from confident-depth and labelled pixels"""
+
+    _target: Type = field(default_factory=lambda: TetonPixelSampler)
+    depth_ray_fraction: float = 0.0
+    """Share of rays drawn from pixels with confident LiDAR depth"""
+    semantic_ray_fraction: float = 0.0
+    """Share of rays drawn from pixels labelled with a class other than the null class"""
+    semantic_class_balance: float = 0.0
+    """How strongly the semantic rays are balanced across classes. 0 samples labelled pixels uniformly, so large
+    classes dominate, 1 gives every class present in the images the same share of the semantic rays"""
+    semantic_class_weights: Dict[str, float] = field(default_factory=dict)
+    """Extra per-class multipliers on the semantic sampling probabilities, e.g. {"tv": 4.0}"""
+    confidence_threshold: int = 255
+    """Minimum value in the confidence maps for a pixel to count as confident depth"""
+
+
+class TetonPixelSampler(PixelSampler):
+    """Samples pixels from per-image pools of valid pixels that are precomputed once per image batch.
+
+    The remaining rays, i.e. those not drawn from the depth or semantic pools, are sampled uniformly, or in
+    proportion to the datamanager's error maps when error-driven sampling is enabled.
+
+    Args:
+        config: the TetonPixelSamplerConfig used to instantiate class
+    """
+
+    config: TetonPixelSamplerConfig
+
+    def __init__(self, config: TetonPixelSamplerConfig, **kwargs) -> None:
+        super().__init__(config, **kwargs)
+        self.class_names: Optional[List[str]] = kwargs.get("class_names")
+        self._pools_key: Optional[Tuple] = None
+        self._pools: Dict[str, Tensor] = {}
+        self._class_offsets: Optional[Tensor] = None
+        self._class_counts: Optional[Tensor] = None
+        self._class_probs: Optional[Tensor] = None
+        # Set by the datamanager when error-driven sampling is enabled
+        self.error_maps: Optional[Tensor] = None
+        self.error_sampling_floor: float = 1.0
+
+    def _build_pools(self, batch: Dict) -> Dict[str, Tensor]:
+        """Flat (image, y, x) indices of the valid pixels of every image in the batch."""
+        mask = batch["mask"][..., 0].bool() if "mask" in batch and not self.config.ignore_mask else None
+        if mask is not None and bool(mask.all()):
+            mask = None
+
+        def flat_indices(valid: Tensor) -> Tensor:
+            if mask is not None:
+                valid = valid & mask.to(valid.device)
+            indices = torch.nonzero(valid.flatten()).squeeze(-1)
+            # Halve the memory of the index pools where possible
+            return indices.int() if valid.numel() < torch.iinfo(torch.int32).max else indices
+
+        pools = {}
+        if self.config.depth_ray_fraction > 0 and batch.get("confidence") is not None:
+            pools["depth"] = flat_indices(batch["confidence"][..., 0] >= self.config.confidence_threshold)
+        if self.config.semantic_ray_fraction > 0 and batch.get("semantics") is not None:
+            pools["semantics"] = self._build_class_index(batch["semantics"][..., 0], flat_indices)
+        if mask is not None:
+            pools["uniform"] = flat_indices(torch.ones_like(mask))
+        return pools
+
+    def _build_class_index(self, labels: Tensor, flat_indices) -> Tensor:
+        """Flat pixel indices grouped by class, along with the offset and count of every class in the index."""
+        num_classes = len(self.class_names) if self.class_names is not None else int(labels.max()) + 1
+        # The null class is never supervised, so it is left out of the index
+        per_class = [flat_indices(labels == class_idx) for class_idx in range(1, num_classes)]
+        counts = torch.tensor([0] + [len(indices) for indices in per_class])
+        self._class_counts = counts
+        self._class_offsets = torch.cumsum(counts, dim=0) - counts
+
+        weights = torch.ones(num_classes)
+        for class_name, weight in self.config.semantic_class_weights.items():
+            assert self.class_names is not None and class_name in self.class_names, f"Unknown class {class_name}"
+            weights[self.class_names.index(class_name)] = weight
+        probs = counts.double() ** (1 - self.config.semantic_class_balance) * weights * (counts > 0)
+        if probs.sum() == 0:
+            # No pixel of a supervised class, the empty pool leaves the semantic share of the rays to uniform sampling
+            return torch.zeros(0, dtype=torch.long)
+        self._class_probs = (probs / probs.sum()).float()
+        return torch.cat(per_class)
+
+    def sample_from_class_index(
+        self, pool: Tensor, num_samples: int, image_height: int, image_width: int
+    ) -> Int[Tensor, "batch_size 3"]:
+        """Draws a class for every ray from the class weighting, then a pixel of that class."""
+        assert self._class_probs is not None and self._class_counts is not None and self._class_offsets is not None
+        classes = torch.multinomial(self._class_probs, num_samples, replacement=True)
+        positions = self._class_offsets[classes] + (torch.rand(num_samples) * self._class_counts[classes]).long()
+        return self.sample_from_pool(pool[positions], num_samples, image_height, image_width, replacement=False)
+
+    def sample_from_error_maps(
+        self, error_maps: Tensor, num_samples: int, image_height: int, image_width: int
+    ) -> Int[Tensor, "batch_size 3"]:
+        """Draws error map cells in proportion to their error, then a uniform pixel inside every cell."""
+        _, map_height, map_width = error_maps.shape
+        cells = torch.multinomial(error_maps.flatten(), num_samples, replacement=True)
+        c = cells // (map_height * map_width)
+        cell_y = (cells // map_width) % map_height
+        cell_x = cells % map_width
+        y = ((cell_y + torch.rand_like(cell_y, dtype=torch.float)) * image_height / map_height).long()
+        x = ((cell_x + torch.rand_like(cell_x, dtype=torch.float)) * image_width / map_width).long()
+        return torch.stack([c, y.clamp(max=image_height - 1), x.clamp(max=image_width - 1)], dim=-1)
+
+    def _get_pools(self, batch: Dict) -> Dict[str, Tensor]:
+        key = (tuple(batch["image"].shape), tuple(batch["image_idx"].tolist()))
+        if key != self._pools_key:
+            self._pools = self._build_pools(batch)
+            self._pools_key = key
+        return self._pools
+
+    def sample_from_pool(
+        self, pool: Tensor, num_samples: int, image_height: int, image_width: int, replacement: bool = True
+    ) -> Int[Tensor, "batch_size 3"]:
+        """Draws pixels uniformly from a pool of flat pixel indices, or converts the whole pool if not replacement."""
+        flat = pool[torch.randint(len(pool), (num_samples,))].long() if replacement else pool.long()
+        c = flat // (image_height * image_width)
+        y = (flat // image_width) % image_height
+        x = flat % image_width
+        return torch.stack([c, y, x], dim=-1)
+
+    def sample_indices(self, batch: Dict, num_rays_per_batch: int) -> Int[Tensor, "batch_size 3"]:
+        """Samples (image, y, x) indices, drawing the configured shares from the supervised pixel pools."""
+        device = batch["image"].device
+        num_images, image_height, image_width, _ = batch["image"].shape
+        pools = self._get_pools(batch)
+
+        indices = []
+        num_remaining = num_rays_per_batch
+        fractions = {"depth": self.config.depth_ray_fraction, "semantics": self.config.semantic_ray_fraction}
+        for name, fraction in fractions.items():
+            if name in pools and len(pools[name]) > 0:
+                num_samples = min(int(num_rays_per_batch * fraction), num_remaining)
+                sample_fn = self.sample_from_class_index if name == "semantics" else self.sample_from_pool
+                indices.append(sample_fn(pools[name], num_samples, image_height, image_width))
+                num_remaining -= num_samples
+
+        if self.error_maps is not None:
+            num_samples = num_remaining - int(num_remaining * self.error_sampling_floor)
+            error_maps = self.error_maps[batch["image_idx"].to(self.error_maps.device)]
+            indices.append(self.sample_from_error_maps(error_maps, num_samples, image_height, image_width).cpu())
+            num_remaining -= num_samples
+
+        if "uniform" in pools:
+            indices.append(self.sample_from_pool(pools["uniform"], num_remaining, image_height, image_width))
+        else:
+            indices.append(self.sample_method(num_remaining, num_images, image_height, image_width, device="cpu"))
+        return torch.cat(indices, dim=0).to(device)
+
+    def collate_image_dataset_batch(self, batch: Dict, num_rays_per_batch: int, keep_full_image: bool = False):
+        if self.config.is_equirectangular or self.config.fisheye_crop_radius is not None:
+            return super().collate_image_dataset_batch(batch, num_rays_per_batch, keep_full_image)
+
+        indices = self.sample_indices(batch, num_rays_per_batch)
+        return self.collate_indices(batch, indices, keep_full_image)
+
+    def collate_indices(
+        self, batch: Dict, indices: Int[Tensor, "batch_size 3"], keep_full_image: bool = False
+    ) -> Dict[str, Union[Tensor, Dict]]:
+        """Gathers the batch values at the sampled indices, same as the base PixelSampler does."""
+        c, y, x = (i.flatten() for i in torch.split(indices, 1, dim=-1))
+        c, y, x = c.cpu(), y.cpu(), x.cpu()
+        collated_batch = {
+            key: value[c, y, x] for key, value in batch.items() if key != "image_idx" and value is not None
+        }
+
+        # Needed to correct the random indices to their actual camera idx locations.
+        indices[:, 0] = batch["image_idx"][c]
+        collated_batch["indices"] = indices  # with the abs camera indices
+        if keep_full_image:
+            collated_batch["full_image"] = batch["image"]
+
+        return collated_batch
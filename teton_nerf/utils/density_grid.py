@@ -0,0 +1,158 @@
+"""
+Density evaluation on regular grids and marching cubes meshes of the density field.
+"""
+
+from __future__ import annotations
+
+import resource
+import time
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+import torch
+from jaxtyping import Float
+from torch import Tensor
+
+from nerfstudio.cameras.rays import Frustums, RaySamples
+from nerfstudio.field_components.field_heads import FieldHeadNames
+from nerfstudio.fields.base_field import Field
+from nerfstudio.utils.rich_utils import CONSOLE
+
+
+@torch.inference_mode()
+def evaluate_density_grid(
+    field: Field,
+    aabb: Float[Tensor, "2 3"],
+    resolution: int,
+    chunk_size: int = 1 << 20,
+) -> Float[Tensor, "resolution resolution resolution"]:
+    """Evaluates the field density at the voxel centers of a regular grid inside the aabb.
+
+    The grid is evaluated in slabs along x of at most chunk_size points, the result is kept on the CPU.
+
+    Args:
+        field: Field to query.
+        aabb: Bounds of the grid.
+        resolution: Number of voxels along every axis.
+        chunk_size: Maximum number of points evaluated at once.
+    """
+    device = next(field.parameters()).device
+    aabb = aabb.to(device)
+    voxel_size = (aabb[1] - aabb[0]) / resolution
+    centers = [aabb[0, axis] + (torch.arange(resolution, device=device) + 0.5) * voxel_size[axis] for axis in range(3)]
+    y, z = torch.meshgrid(centers[1], centers[2], indexing="ij")
+    plane = torch.stack([y, z], dim=-1).view(-1, 2)
+
+    densities = torch.empty(resolution, resolution, resolution)
+    slab_size = max(1, chunk_size // (resolution * resolution))
+    for start in range(0, resolution, slab_size):
+        x = centers[0][start : start + slab_size]
+        positions = torch.cat([x.repeat_interleave(len(plane))[:, None], plane.repeat(len(x), 1)], dim=-1)
+        density = field.density_fn(positions)
+        densities[start : start + len(x)] = density.view(len(x), resolution, resolution).float().cpu()
+    return densities
+
+
+@torch.inference_mode()
+def query_vertex_outputs(
+    field: Field,
+    vertices: Float[Tensor, "num_vertices 3"],
+    directions: Float[Tensor, "num_vertices 3"],
+    chunk_size: int = 1 << 18,
+) -> Dict[FieldHeadNames, Tensor]:
+    """Evaluates the full field at the vertices, viewing them along the given directions."""
+    device = next(field.parameters()).device
+    outputs = {}
+    for start in range(0, len(vertices), chunk_size):
+        origins = vertices[start : start + chunk_size].to(device)
+        ray_samples = RaySamples(
+            frustums=Frustums(
+                origins=origins,
+                directions=directions[start : start + chunk_size].to(device),
+                starts=torch.zeros_like(origins[..., :1]),
+                ends=torch.zeros_like(origins[..., :1]),
+                pixel_area=torch.ones_like(origins[..., :1]),
+            ),
+            camera_indices=torch.zeros_like(origins[..., :1], dtype=torch.long),
+        )
+        for name, value in field.forward(ray_samples).items():
+            outputs.setdefault(name, []).append(value.cpu())
+    return {name: torch.cat(values) for name, values in outputs.items()}
+
+
+def process_peak_memory_mb() -> float:
+    """Peak resident memory of the whole process so far, which cannot be attributed to a single extraction."""
+    # ru_maxrss is in KB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10
+
+
+def extract_density_mesh(
+    field: Field,
+    aabb: Float[Tensor, "2 3"],
+    resolution: int,
+    density_threshold: float = 10.0,
+    chunk_size: int = 1 << 20,
+    semantics: bool = False,
+    num_threads: Optional[int] = None,
+) -> Tuple[Dict[str, np.ndarray], Dict[str, float]]:
+    """Marching cubes mesh of the density field, with vertex colors from the RGB head.
+
+    Args:
+        field: Field to mesh.
+        aabb: Bounds of the meshed volume.
+        resolution: Number of voxels along every axis.
+        density_threshold: Density of the extracted isosurface.
+        chunk_size: Maximum number of points evaluated at once.
+        semantics: Whether to label the vertices with the argmax of the semantic head.
+        num_threads: Number of CPU threads used by torch, the torch default if not set.
+
+    Returns:
+        The mesh as "vertices", "faces", "normals", "colors" and optionally "labels", and the runtime in seconds
+        of the extraction, along with its peak GPU memory in MB on the GPU.
+    """
+    from skimage import measure
+
+    device = next(field.parameters()).device
+    aabb = aabb.float().cpu()
+    previous_threads = torch.get_num_threads()
+    if num_threads is not None:
+        torch.set_num_threads(num_threads)
+    if device.type == "cuda":
+        torch.cuda.reset_peak_memory_stats(device)
+    start_time = time.perf_counter()
+    try:
+        densities = evaluate_density_grid(field, aabb, resolution, chunk_size=chunk_size)
+        if not densities.min() < density_threshold < densities.max():
+            raise ValueError(
+                f"The density threshold {density_threshold} is outside the density range "
+                f"[{float(densities.min()):.2f}, {float(densities.max()):.2f}] of the grid"
+            )
+        vertices, faces, normals, _ = measure.marching_cubes(densities.numpy(), level=density_threshold)
+        voxel_size = (aabb[1] - aabb[0]) / resolution
+        # Marching cubes works in voxel index units on the voxel centers
+        vertices = torch.from_numpy(vertices.copy()).float() * voxel_size + aabb[0] + voxel_size / 2
+        normals = torch.nn.functional.normalize(torch.from_numpy(normals.copy()).float(), dim=-1)
+        # The normals point towards higher density, so they look into the surface like a camera in front of it would
+        outputs = query_vertex_outputs(field, vertices, normals, chunk_size=min(chunk_size, 1 << 18))
+    finally:
+        torch.set_num_threads(previous_threads)
+
+    mesh = {
+        "vertices": vertices.numpy(),
+        "faces": faces.astype(np.int32),
+        "normals": (-normals).numpy(),
+        "colors": (outputs[FieldHeadNames.RGB].clamp(0, 1) * 255).round().byte().numpy(),
+    }
+    if semantics:
+        mesh["labels"] = torch.argmax(outputs[FieldHeadNames.SEMANTICS], dim=-1).byte().numpy()
+
+    stats = {"seconds": time.perf_counter() - start_time}
+    memory = ""
+    if device.type == "cuda":
+        stats["peak_memory_mb"] = torch.cuda.max_memory_allocated(device) / 2**20
+        memory = f", peak GPU memory {stats['peak_memory_mb']:.0f} MB"
+    CONSOLE.print(
+        f"Resolution {resolution}: {len(mesh['vertices'])} vertices, {len(mesh['faces'])} faces in "
+        f"{stats['seconds']:.1f}s{memory}"
+    )
+    return mesh, stats
@@ -1,26 +1,54 @@
 """Script that is meant to help us load frames and calculate pointclouds from them"""
 from __future__ import annotations
 import sys
-from typing import Tuple, cast, Optional, TYPE_CHECKING
+import time
+from pathlib import Path
+from typing import Dict, Iterator, Literal, Tuple, cast, Optional, TYPE_CHECKING, Union
 
 import numpy as np
 import torch
 from rich.progress import BarColumn, Progress, TaskProgressColumn, TextColumn, TimeRemainingColumn
+from torch import Tensor
 
+from nerfstudio.cameras.cameras import Cameras
 from nerfstudio.cameras.rays import RayBundle
 from nerfstudio.data.scene_box import OrientedBox
+from nerfstudio.model_components.ray_generators import RayGenerator
 from nerfstudio.pipelines.base_pipeline import Pipeline
 from nerfstudio.utils.rich_utils import CONSOLE
 
+from teton_nerf.utils.ply_writer import StreamingPlyWriter, point_cloud_properties
+from teton_nerf.utils.point_cloud_filter import statistical_outlier_mask
+from teton_nerf.utils.voxel_hash import VoxelHashAccumulator
+
 if TYPE_CHECKING:
     import open3d as o3d
 
-def generate_point_cloud(
+class TrainCameraRaySampler:
+    """Samples rays at random pixels of the training cameras without going through the training data path.
+
+    Args:
+        cameras: Cameras to sample rays from.
+        device: Device to generate the rays on.
+    """
+
+    def __init__(self, cameras: Cameras, device: Union[torch.device, str]):
+        self.cameras = cameras.to(device)
+        self.device = device
+        self.ray_generator = RayGenerator(self.cameras).to(device)
+        self.heights = self.cameras.height.view(-1).float()
+        self.widths = self.cameras.width.view(-1).float()
+
+    def sample(self, num_rays: int) -> RayBundle:
+        camera_indices = torch.randint(len(self.cameras), (num_rays,), device=self.device)
+        y = (torch.rand(num_rays, device=self.device) * self.heights[camera_indices]).long()
+        x = (torch.rand(num_rays, device=self.device) * self.widths[camera_indices]).long()
+        return self.ray_generator(torch.stack([camera_indices, y, x], dim=-1))
+
+
+def sample_point_cloud_batches(
     pipeline: Pipeline,
     num_points: int = 1000000,
-    remove_outliers: bool = True,
-    estimate_normals: bool = False,
-    reorient_normals: bool = False,
     rgb_output_name: str = "rgb",
     depth_output_name: str = "depth",
     normal_output_name: Optional[str] = None,
@@ -28,26 +56,13 @@ def generate_point_cloud(
     bounding_box_min: Optional[Tuple[float, float, float]] = None,
     bounding_box_max: Optional[Tuple[float, float, float]] = None,
     crop_obb: Optional[OrientedBox] = None,
-    std_ratio: float = 10.0,
-) -> o3d.geometry.PointCloud:
-    """Generate a point cloud from a nerf.
-
-    Args:
-        pipeline: Pipeline to evaluate with.
-        num_points: Number of points to generate. May result in less if outlier removal is used.
-        remove_outliers: Whether to remove outliers.
-        reorient_normals: Whether to re-orient the normals based on the view direction.
-        estimate_normals: Whether to estimate normals.
-        rgb_output_name: Name of the RGB output.
-        depth_output_name: Name of the depth output.
-        normal_output_name: Name of the normal output.
-        use_bounding_box: Whether to use a bounding box to sample points.
-        bounding_box_min: Minimum of the bounding box.
-        bounding_box_max: Maximum of the bounding box.
-        std_ratio: Threshold based on STD of the average distances across the point cloud to remove outliers.
+    num_rays_per_batch: int = 1 << 15,
+    semantics: bool = False,
+) -> Iterator[Dict[str, Tensor]]:
+    """Renders random training rays and yields the surface points of every batch, until num_points are produced.
 
-    Returns:
-        Point cloud.
+    Every batch holds the "points", "rgbs" and "view_directions" of the rays, "normals" if normal_output_name
+    is set and the argmax semantic "labels" if semantics is set. The batches stay on the pipeline's device.
     """
 
     progress = Progress(
@@ -57,21 +72,41 @@ def generate_point_cloud(
         TimeRemainingColumn(elapsed_when_finished=True, compact=True),
         console=CONSOLE,
     )
-    points = []
-    rgbs = []
-    normals = []
-    view_directions = []
     if use_bounding_box and (crop_obb is not None and bounding_box_max is not None):
         CONSOLE.print("Provided aabb and crop_obb at the same time, using only the obb", style="bold yellow")
+
+    model = pipeline.model
+    ray_sampler = TrainCameraRaySampler(pipeline.datamanager.train_dataset.cameras, pipeline.device)
+    # The depth and rgb only path covers everything except rendered normals and custom output names
+    use_point_cloud_outputs = (
+        hasattr(model, "get_point_cloud_outputs")
+        and normal_output_name is None
+        and rgb_output_name == "rgb"
+        and depth_output_name == "depth"
+    )
+    num_generated = 0
+    start_time = time.perf_counter()
     with progress as progress_bar:
         task = progress_bar.add_task("Generating Point Cloud", total=num_points)
         while not progress_bar.finished:
             normal = None
+            label = None
 
-            with torch.no_grad():
-                ray_bundle, _ = pipeline.datamanager.next_train(0)
-                assert isinstance(ray_bundle, RayBundle)
-                outputs = pipeline.model(ray_bundle)
+            with torch.inference_mode():
+                ray_bundle = ray_sampler.sample(num_rays_per_batch)
+                if use_point_cloud_outputs:
+                    outputs = model.get_point_cloud_outputs(ray_bundle, semantics=semantics)
+                else:
+                    outputs = model(ray_bundle)
+            if semantics:
+                if "semantic_labels" in outputs:
+                    label = outputs["semantic_labels"]
+                elif "semantics" in outputs:
+                    label = torch.argmax(outputs["semantics"], dim=-1)
+                else:
+                    CONSOLE.rule("Error", style="red")
+                    CONSOLE.print("The model does not render semantics", justify="center")
+                    sys.exit(1)
             if rgb_output_name not in outputs:
                 CONSOLE.rule("Error", style="red")
                 CONSOLE.print(f"Could not find {rgb_output_name} in the model outputs", justify="center")
@@ -84,7 +119,6 @@ def generate_point_cloud(
                 sys.exit(1)
             rgba = pipeline.model.get_rgba_image(outputs, rgb_output_name)
             depth = outputs[depth_output_name]
-            print(f"Median depth value used for scaling pointcloud {torch.median(depth)}")
             if normal_output_name is not None:
                 if normal_output_name not in outputs:
                     CONSOLE.rule("Error", style="red")
@@ -106,6 +140,8 @@ def generate_point_cloud(
             rgb = rgba[mask][..., :3]
             if normal is not None:
                 normal = normal[mask]
+            if label is not None:
+                label = label[mask]
 
             if use_bounding_box:
                 if crop_obb is None:
@@ -122,25 +158,104 @@ def generate_point_cloud(
                 view_direction = view_direction[mask]
                 if normal is not None:
                     normal = normal[mask]
+                if label is not None:
+                    label = label[mask]
 
-            points.append(point)
-            rgbs.append(rgb)
-            view_directions.append(view_direction)
+            batch = {"points": point, "rgbs": rgb, "view_directions": view_direction}
             if normal is not None:
-                normals.append(normal)
+                batch["normals"] = normal
+            if label is not None:
+                batch["labels"] = label
+            num_generated += point.shape[0]
             progress.advance(task, point.shape[0])
+            yield batch
+    elapsed = time.perf_counter() - start_time
+    CONSOLE.print(f"Generated {num_generated} points in {elapsed:.1f}s ({num_generated / elapsed:.0f} points/s)")
+
+
+def generate_point_cloud(
+    pipeline: Pipeline,
+    num_points: int = 1000000,
+    remove_outliers: bool = True,
+    estimate_normals: bool = False,
+    reorient_normals: bool = False,
+    rgb_output_name: str = "rgb",
+    depth_output_name: str = "depth",
+    normal_output_name: Optional[str] = None,
+    use_bounding_box: bool = True,
+    bounding_box_min: Optional[Tuple[float, float, float]] = None,
+    bounding_box_max: Optional[Tuple[float, float, float]] = None,
+    crop_obb: Optional[OrientedBox] = None,
+    std_ratio: float = 10.0,
+    num_rays_per_batch: int = 1 << 15,
+    outlier_method: Literal["torch", "open3d"] = "torch",
+    outlier_num_threads: Optional[int] = None,
+) -> o3d.geometry.PointCloud:
+    """Generate a point cloud from a nerf.
+
+    Args:
+        pipeline: Pipeline to evaluate with.
+        num_points: Number of points to generate. May result in less if outlier removal is used.
+        remove_outliers: Whether to remove outliers.
+        reorient_normals: Whether to re-orient the normals based on the view direction.
+        estimate_normals: Whether to estimate normals.
+        rgb_output_name: Name of the RGB output.
+        depth_output_name: Name of the depth output.
+        normal_output_name: Name of the normal output.
+        use_bounding_box: Whether to use a bounding box to sample points.
+        bounding_box_min: Minimum of the bounding box.
+        bounding_box_max: Maximum of the bounding box.
+        std_ratio: Threshold based on STD of the average distances across the point cloud to remove outliers.
+        num_rays_per_batch: Number of rays rendered per batch.
+        outlier_method: Remove outliers with the multi-threaded grid search in torch or with Open3D.
+        outlier_num_threads: Number of CPU threads of the torch outlier removal, the torch default if not set.
+
+    Returns:
+        Point cloud.
+    """
+    points = []
+    rgbs = []
+    normals = []
+    view_directions = []
+    for batch in sample_point_cloud_batches(
+        pipeline,
+        num_points=num_points,
+        rgb_output_name=rgb_output_name,
+        depth_output_name=depth_output_name,
+        normal_output_name=normal_output_name,
+        use_bounding_box=use_bounding_box,
+        bounding_box_min=bounding_box_min,
+        bounding_box_max=bounding_box_max,
+        crop_obb=crop_obb,
+        num_rays_per_batch=num_rays_per_batch,
+    ):
+        points.append(batch["points"])
+        rgbs.append(batch["rgbs"])
+        view_directions.append(batch["view_directions"])
+        if "normals" in batch:
+            normals.append(batch["normals"])
     points = torch.cat(points, dim=0)
     rgbs = torch.cat(rgbs, dim=0)
     view_directions = torch.cat(view_directions, dim=0).cpu()
 
+    ind = None
+    if remove_outliers and outlier_method == "torch":
+        CONSOLE.print("Cleaning Point Cloud")
+        keep = statistical_outlier_mask(points, nb_neighbors=20, std_ratio=std_ratio, num_threads=outlier_num_threads)
+        ind = torch.nonzero(keep).squeeze(-1).cpu()
+        points = points[ind]
+        rgbs = rgbs[ind]
+        view_directions = view_directions[ind]
+        print("\033[A\033[A")
+        CONSOLE.print("[bold green]:white_check_mark: Cleaning Point Cloud")
+
     import open3d as o3d
 
     pcd = o3d.geometry.PointCloud()
     pcd.points = o3d.utility.Vector3dVector(points.double().cpu().numpy())
     pcd.colors = o3d.utility.Vector3dVector(rgbs.double().cpu().numpy())
 
-    ind = None
-    if remove_outliers:
+    if remove_outliers and outlier_method == "open3d":
         CONSOLE.print("Cleaning Point Cloud")
         pcd, ind = pcd.remove_statistical_outlier(nb_neighbors=20, std_ratio=std_ratio)
         print("\033[A\033[A")
@@ -172,4 +287,202 @@ def generate_point_cloud(
         normals[mask] *= -1
         pcd.normals = o3d.utility.Vector3dVector(normals.double().cpu().numpy())
 
-    return pcd
\ No newline at end of file
+    return pcd
+
+
+def generate_voxel_point_cloud(
+    pipeline: Pipeline,
+    output_path: Path,
+    voxel_size: float = 0.005,
+    num_points: int = 10000000,
+    use_bounding_box: bool = True,
+    bounding_box_min: Optional[Tuple[float, float, float]] = None,
+    bounding_box_max: Optional[Tuple[float, float, float]] = None,
+    crop_obb: Optional[OrientedBox] = None,
+    num_rays_per_batch: int = 1 << 15,
+    min_samples_per_voxel: int = 1,
+    remove_outliers: bool = False,
+    std_ratio: float = 10.0,
+    chunk_size: int = 1 << 20,
+) -> int:
+    """Generate a point cloud from a nerf by averaging the rendered surface points per voxel on the device,
+    and stream it to a binary PLY file.
+
+    Memory is bounded by the number of occupied voxels instead of the number of rendered points.
+
+    Args:
+        pipeline: Pipeline to evaluate with.
+        output_path: PLY file to write.
+        voxel_size: Edge length of the voxels, in the scene units of the model.
+        num_points: Number of surface points to render before voxelization.
+        use_bounding_box: Whether to use a bounding box to sample points.
+        bounding_box_min: Minimum of the bounding box.
+        bounding_box_max: Maximum of the bounding box.
+        crop_obb: Oriented bounding box, used instead of the axis aligned one if set.
+        num_rays_per_batch: Number of rays rendered per batch.
+        min_samples_per_voxel: Voxels hit by fewer rendered points are dropped.
+        remove_outliers: Whether to remove outliers from the voxel centroids before writing.
+        std_ratio: Threshold based on STD of the average distances across the point cloud to remove outliers.
+        chunk_size: Number of voxels written to the file at a time.
+
+    Returns:
+        Number of points written.
+    """
+    accumulator = VoxelHashAccumulator(voxel_size, device=pipeline.device)
+    for batch in sample_point_cloud_batches(
+        pipeline,
+        num_points=num_points,
+        use_bounding_box=use_bounding_box,
+        bounding_box_min=bounding_box_min,
+        bounding_box_max=bounding_box_max,
+        crop_obb=crop_obb,
+        num_rays_per_batch=num_rays_per_batch,
+    ):
+        accumulator.add(batch["points"], rgbs=batch["rgbs"])
+
+    return save_voxel_point_cloud(
+        accumulator,
+        output_path,
+        min_samples_per_voxel=min_samples_per_voxel,
+        remove_outliers=remove_outliers,
+        std_ratio=std_ratio,
+        chunk_size=chunk_size,
+    )
+
+
+def save_voxel_point_cloud(
+    accumulator: VoxelHashAccumulator,
+    output_path: Path,
+    min_samples_per_voxel: int = 1,
+    remove_outliers: bool = False,
+    std_ratio: float = 10.0,
+    chunk_size: int = 1 << 20,
+) -> int:
+    """Streams the voxel averages of an accumulator with "rgbs" attributes to a binary PLY file.
+
+    Args:
+        accumulator: Accumulator holding the points.
+        output_path: PLY file to write.
+        min_samples_per_voxel: Voxels with fewer samples are dropped.
+        remove_outliers: Whether to remove outliers from the voxel centroids before writing.
+        std_ratio: Threshold based on STD of the average distances across the point cloud to remove outliers.
+        chunk_size: Number of voxels written to the file at a time.
+
+    Returns:
+        Number of points written.
+    """
+    inliers = None
+    if remove_outliers:
+        CONSOLE.print("Cleaning Point Cloud")
+        inliers = statistical_outlier_mask(accumulator.result()["points"], nb_neighbors=20, std_ratio=std_ratio)
+
+    CONSOLE.print(f"Writing {accumulator.num_voxels} voxels to {output_path}")
+    comments = (f"voxel_size {accumulator.voxel_size}",)
+    with StreamingPlyWriter(output_path, point_cloud_properties(), comments=comments) as writer:
+        for start, chunk in zip(range(0, accumulator.num_voxels, chunk_size), accumulator.iter_chunks(chunk_size)):
+            keep = chunk["counts"] >= min_samples_per_voxel
+            if inliers is not None:
+                keep &= inliers[start : start + chunk_size]
+            colors = (chunk["rgbs"][keep].clamp(0, 1) * 255).round().byte()
+            writer.write(points=chunk["points"][keep], colors=colors)
+    return writer.num_vertices
+
+
+def generate_semantic_point_cloud(
+    pipeline: Pipeline,
+    output_dir: Path,
+    class_names: Optional[Tuple[str, ...]] = None,
+    voxel_size: float = 0.005,
+    num_points: int = 10000000,
+    use_bounding_box: bool = True,
+    bounding_box_min: Optional[Tuple[float, float, float]] = None,
+    bounding_box_max: Optional[Tuple[float, float, float]] = None,
+    crop_obb: Optional[OrientedBox] = None,
+    num_rays_per_batch: int = 1 << 15,
+    min_samples_per_voxel: int = 1,
+    per_class_files: bool = True,
+    color_by_class: bool = False,
+    chunk_size: int = 1 << 20,
+) -> Dict[str, int]:
+    """Generate a point cloud labelled with the rendered semantic argmax of every point.
+
+    Points are averaged per voxel and class, so a voxel on the border of two classes gives one point per class.
+    Writes semantic_point_cloud.ply with a class id per point to output_dir, and one PLY per class to
+    output_dir / "semantics" if per_class_files is set. Class names and colors are those of the dataset's
+    panoptic_classes.json as loaded by the dataparser.
+
+    Args:
+        pipeline: Pipeline to evaluate with.
+        output_dir: Directory the PLY files are written to.
+        class_names: Classes to export, points of other classes are discarded before accumulation.
+            All classes except the unsupervised null class if not set.
+        voxel_size: Edge length of the voxels, in the scene units of the model.
+        num_points: Number of surface points to render before voxelization.
+        use_bounding_box: Whether to use a bounding box to sample points.
+        bounding_box_min: Minimum of the bounding box.
+        bounding_box_max: Maximum of the bounding box.
+        crop_obb: Oriented bounding box, used instead of the axis aligned one if set.
+        num_rays_per_batch: Number of rays rendered per batch.
+        min_samples_per_voxel: Voxels hit by fewer rendered points are dropped.
+        per_class_files: Whether to also write one file per class.
+        color_by_class: Color the points with their class color instead of the rendered RGB.
+        chunk_size: Number of voxels written to the files at a time.
+
+    Returns:
+        Number of points written per class.
+    """
+    semantics = pipeline.model.semantics
+    assert semantics is not None, "The dataset has no semantics"
+    all_classes = list(semantics.classes)
+    class_names = tuple(class_names) if class_names else tuple(all_classes[1:])
+    for class_name in class_names:
+        assert class_name in all_classes, f"Unknown class {class_name}, expected one of {all_classes}"
+    class_ids = torch.tensor([all_classes.index(class_name) for class_name in class_names], device=pipeline.device)
+    class_colors = (semantics.colors.clamp(0, 1) * 255).round().byte()
+
+    accumulators = {int(class_id): VoxelHashAccumulator(voxel_size, device=pipeline.device) for class_id in class_ids}
+    for batch in sample_point_cloud_batches(
+        pipeline,
+        num_points=num_points,
+        use_bounding_box=use_bounding_box,
+        bounding_box_min=bounding_box_min,
+        bounding_box_max=bounding_box_max,
+        crop_obb=crop_obb,
+        num_rays_per_batch=num_rays_per_batch,
+        semantics=True,
+    ):
+        labels = batch["labels"]
+        keep = torch.isin(labels, class_ids)
+        points, rgbs, labels = batch["points"][keep], batch["rgbs"][keep], labels[keep]
+        for class_id in torch.unique(labels).tolist():
+            in_class = labels == class_id
+            accumulators[class_id].add(points[in_class], rgbs=rgbs[in_class])
+
+    properties = point_cloud_properties(extra=[("class", np.uint8)])
+    comments = (f"voxel_size {voxel_size}",) + tuple(f"class {all_classes.index(c)} {c}" for c in class_names)
+    num_written = {}
+    with StreamingPlyWriter(output_dir / "semantic_point_cloud.ply", properties, comments=comments) as writer:
+        for class_id, accumulator in accumulators.items():
+            class_name = all_classes[class_id]
+            class_writer = None
+            if per_class_files:
+                class_path = output_dir / "semantics" / f"{class_name.replace(' ', '_')}.ply"
+                class_comments = (f"class {class_name}",)
+                class_writer = StreamingPlyWriter(class_path, point_cloud_properties(), comments=class_comments)
+            num_written[class_name] = 0
+            for chunk in accumulator.iter_chunks(chunk_size):
+                keep = chunk["counts"] >= min_samples_per_voxel
+                points = chunk["points"][keep]
+                if color_by_class:
+                    colors = class_colors[class_id].expand(len(points), 3)
+                else:
+                    colors = (chunk["rgbs"][keep].clamp(0, 1) * 255).round().byte()
+                labels = torch.full((len(points),), class_id, dtype=torch.uint8)
+                writer.write(points=points, colors=colors, labels=labels)
+                if class_writer is not None:
+                    class_writer.write(points=points, colors=colors)
+                num_written[class_name] += len(points)
+            if class_writer is not None:
+                class_writer.close()
+            CONSOLE.print(f"{class_name}: {num_written[class_name]} points")
+    return num_written
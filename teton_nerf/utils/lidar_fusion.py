@@ -0,0 +1,226 @@
+"""
+Fusion of the captured LiDAR depth maps into a point cloud or TSDF mesh, without a trained model.
+"""
+
+from __future__ import annotations
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, Iterator, Optional, Tuple, Union
+
+import numpy as np
+import torch
+from jaxtyping import Float
+from PIL import Image
+from rich.progress import BarColumn, Progress, TaskProgressColumn, TextColumn, TimeRemainingColumn
+from torch import Tensor
+
+from nerfstudio.data.dataparsers.base_dataparser import DataparserOutputs
+from nerfstudio.utils.rich_utils import CONSOLE
+
+from teton_nerf.utils.get_pointcloud import save_voxel_point_cloud
+from teton_nerf.utils.voxel_hash import VoxelHashAccumulator
+
+
+class LidarFrameLoader:
+    """Loads the depth, confidence and color of every frame of a split, at the resolution of the depth maps.
+
+    Depths are converted to the scene units of the dataparser outputs, the camera intrinsics are rescaled
+    to the depth resolution.
+
+    Args:
+        dataparser_outputs: Outputs of the TetonDataparser for one split.
+        use_monocular_depth: Use the LiDAR depth extended with monocular depth that the dataset caches in
+            {split}_depths.npy instead of the raw depth maps. The confidence maps are ignored then.
+        confidence_threshold: Minimum value in the confidence maps for a depth value to be used.
+        max_depth: Depth values beyond this distance in meters are dropped.
+    """
+
+    def __init__(
+        self,
+        dataparser_outputs: DataparserOutputs,
+        use_monocular_depth: bool = False,
+        confidence_threshold: int = 255,
+        max_depth: Optional[float] = None,
+    ):
+        self.image_filenames = dataparser_outputs.image_filenames
+        self.cameras = dataparser_outputs.cameras
+        self.dataparser_scale = dataparser_outputs.dataparser_scale
+        metadata = dataparser_outputs.metadata
+        self.depth_filenames = metadata.get("depth_filenames")
+        self.confidence_filenames = metadata.get("confidence_filenames")
+        self.depth_unit_scale_factor = metadata.get("depth_unit_scale_factor", 1e-3)
+        self.confidence_threshold = confidence_threshold
+        self.max_depth = max_depth
+
+        self.depths = None
+        if use_monocular_depth:
+            cache = self.image_filenames[0].parent / f"{metadata['split']}_depths.npy"
+            assert cache.exists(), f"No monocular depth cache at {cache}, train a model on the dataset first"
+            # Memory mapped, so every loader thread only reads the frame it needs
+            self.depths = np.load(cache, mmap_mode="r")
+            assert len(self.depths) == len(self.image_filenames), f"{cache} does not match the split"
+        else:
+            assert self.depth_filenames is not None, "The dataset has no depth maps"
+
+    def __len__(self) -> int:
+        return len(self.image_filenames)
+
+    def load(self, idx: int) -> Dict[str, Tensor]:
+        """Depth [H, W] in scene units (0 where invalid), uint8 colors [H, W, 3], camera to world [3, 4] and
+        intrinsics (fx, fy, cx, cy) at the depth resolution."""
+        if self.depths is not None:
+            depth = np.array(self.depths[idx], dtype=np.float32)
+        else:
+            depth = np.array(Image.open(self.depth_filenames[idx]), dtype=np.float32) * self.depth_unit_scale_factor
+            if self.confidence_filenames is not None:
+                confidence = Image.open(self.confidence_filenames[idx])
+                if confidence.size != depth.shape[::-1]:
+                    confidence = confidence.resize(depth.shape[::-1], resample=Image.NEAREST)
+                depth[np.array(confidence) < self.confidence_threshold] = 0
+        if self.max_depth is not None:
+            depth[depth > self.max_depth] = 0
+
+        height, width = depth.shape
+        image = Image.open(self.image_filenames[idx]).convert("RGB")
+        scale_x, scale_y = width / image.size[0], height / image.size[1]
+        if image.size != (width, height):
+            image = image.resize((width, height), resample=Image.BILINEAR)
+
+        camera = self.cameras[idx]
+        intrinsics = torch.tensor(
+            [
+                float(camera.fx) * scale_x,
+                float(camera.fy) * scale_y,
+                float(camera.cx) * scale_x,
+                float(camera.cy) * scale_y,
+            ]
+        )
+        return {
+            "depth": torch.from_numpy(depth) * self.dataparser_scale,
+            "colors": torch.from_numpy(np.array(image)),
+            "camera_to_world": camera.camera_to_worlds,
+            "intrinsics": intrinsics,
+        }
+
+    def iter_frames(self, num_workers: int = 8) -> Iterator[Dict[str, Tensor]]:
+        """Yields the frames in order, decoding up to 2 * num_workers frames ahead in a thread pool."""
+        with ThreadPoolExecutor(max_workers=num_workers) as executor:
+            pending = deque()
+            for idx in range(len(self)):
+                pending.append(executor.submit(self.load, idx))
+                if len(pending) >= 2 * num_workers:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+
+
+def backproject(
+    frame: Dict[str, Tensor], device: Union[torch.device, str]
+) -> Tuple[Float[Tensor, "num_points 3"], Float[Tensor, "num_points 3"]]:
+    """World space points and colors in [0, 1] of the valid depth pixels of a frame."""
+    depth = frame["depth"].to(device)
+    fx, fy, cx, cy = frame["intrinsics"].tolist()
+    v, u = torch.nonzero(depth > 0, as_tuple=True)
+    z = depth[v, u]
+    # Cameras look down -z with y up, as in nerfstudio
+    directions = torch.stack([(u + 0.5 - cx) / fx, -(v + 0.5 - cy) / fy, -torch.ones_like(z)], dim=-1)
+    camera_to_world = frame["camera_to_world"].to(device)
+    points = (directions * z[:, None]) @ camera_to_world[:, :3].T + camera_to_world[:, 3]
+    colors = frame["colors"].to(device)[v, u].float() / 255.0
+    return points, colors
+
+
+def _progress(description: str) -> Progress:
+    return Progress(
+        TextColumn(description),
+        BarColumn(),
+        TaskProgressColumn(show_speed=True),
+        TimeRemainingColumn(elapsed_when_finished=True, compact=True),
+        console=CONSOLE,
+    )
+
+
+def fuse_point_cloud(
+    loaders: Tuple[LidarFrameLoader, ...],
+    output_path: Path,
+    voxel_size: float = 0.01,
+    device: Union[torch.device, str] = "cuda",
+    num_workers: int = 8,
+    min_samples_per_voxel: int = 1,
+    remove_outliers: bool = False,
+    std_ratio: float = 10.0,
+) -> int:
+    """Averages the back-projected depth maps of all frames per voxel and streams the result to a PLY file.
+
+    Returns:
+        Number of points written.
+    """
+    accumulator = VoxelHashAccumulator(voxel_size, device=device)
+    with _progress(":cloud: Fusing LiDAR depth :cloud:") as progress:
+        task = progress.add_task("Fusing", total=sum(len(loader) for loader in loaders))
+        for loader in loaders:
+            for frame in loader.iter_frames(num_workers):
+                points, colors = backproject(frame, device)
+                accumulator.add(points, rgbs=colors)
+                progress.advance(task)
+    return save_voxel_point_cloud(
+        accumulator,
+        output_path,
+        min_samples_per_voxel=min_samples_per_voxel,
+        remove_outliers=remove_outliers,
+        std_ratio=std_ratio,
+    )
+
+
+def fuse_tsdf_mesh(
+    loaders: Tuple[LidarFrameLoader, ...],
+    output_path: Path,
+    resolution: int = 256,
+    bounding_box_min: Tuple[float, float, float] = (-1.0, -1.0, -1.0),
+    bounding_box_max: Tuple[float, float, float] = (1.0, 1.0, 1.0),
+    device: Union[torch.device, str] = "cuda",
+    num_workers: int = 8,
+) -> None:
+    """Integrates the depth maps of all frames into a TSDF volume and saves its marching cubes mesh.
+
+    Args:
+        loaders: Frame loaders of the splits to fuse.
+        output_path: Mesh file to write.
+        resolution: Number of voxels along every axis of the volume.
+        bounding_box_min: Minimum of the volume in scene units.
+        bounding_box_max: Maximum of the volume in scene units.
+        device: Device the volume is kept on.
+        num_workers: Number of threads decoding frames.
+    """
+    from nerfstudio.exporter.tsdf_utils import TSDF
+
+    aabb = torch.tensor([bounding_box_min, bounding_box_max], dtype=torch.float32)
+    tsdf = TSDF.from_aabb(aabb, volume_dims=torch.tensor([resolution] * 3)).to(device)
+    bottom = torch.tensor([[0.0, 0.0, 0.0, 1.0]], device=device)
+    with _progress(":cloud: Integrating LiDAR depth :cloud:") as progress:
+        task = progress.add_task("Integrating", total=sum(len(loader) for loader in loaders))
+        for loader in loaders:
+            for frame in loader.iter_frames(num_workers):
+                depth = frame["depth"].to(device)
+                height, width = depth.shape
+                fx, fy, cx, cy = frame["intrinsics"].tolist()
+                # The TSDF expects the distance along the ray rather than the z depth
+                v, u = torch.meshgrid(
+                    torch.arange(height, device=device), torch.arange(width, device=device), indexing="ij"
+                )
+                ray_scale = torch.sqrt(((u + 0.5 - cx) / fx) ** 2 + ((v + 0.5 - cy) / fy) ** 2 + 1)
+                intrinsics = torch.tensor([[fx, 0, cx], [0, fy, cy], [0, 0, 1]], device=device)
+                tsdf.integrate_tsdf(
+                    torch.cat([frame["camera_to_world"].to(device), bottom])[None],
+                    intrinsics[None],
+                    (depth * ray_scale)[None, None],
+                    color_images=frame["colors"].to(device).permute(2, 0, 1)[None].float() / 255.0,
+                )
+                progress.advance(task)
+
+    CONSOLE.print("Computing Mesh")
+    mesh = tsdf.get_mesh()
+    CONSOLE.print(f"Saving TSDF Mesh to {output_path}")
+    tsdf.export_mesh(mesh, filename=str(output_path))
@@ -0,0 +1,85 @@
+"""
+Batched versions of the nerfstudio depth losses used by the Teton model.
+"""
+
+from __future__ import annotations
+
+from typing import List, Optional
+
+import torch
+import torch.nn.functional as F
+from jaxtyping import Float
+from torch import Tensor
+
+from nerfstudio.cameras.rays import RaySamples
+from nerfstudio.model_components.losses import EPS, URF_SIGMA_SCALE_FACTOR, DepthLossType
+
+
+def batched_depth_loss(
+    weights_list: List[Float[Tensor, "*batch num_samples 1"]],
+    ray_samples_list: List[RaySamples],
+    termination_depth: Float[Tensor, "*batch 1"],
+    predicted_depth: Float[Tensor, "*batch 1"],
+    sigma: Float[Tensor, "1"],
+    directions_norm: Optional[Float[Tensor, "*batch 1"]],
+    is_euclidean: bool,
+    depth_loss_type: DepthLossType,
+) -> Float[Tensor, "0"]:
+    """Computes the DS-NeRF/URF depth loss for all proposal levels in a single call.
+
+    The sample dimension of every level is padded to the largest level, padded samples are masked out,
+    so the result equals the mean of calling nerfstudio's depth_loss once per level.
+
+    Args:
+        weights_list: Weights predicted for each sample, one entry per level.
+        ray_samples_list: Samples along rays corresponding to weights, one entry per level.
+        termination_depth: Ground truth depth of rays.
+        predicted_depth: Depth prediction from the network.
+        sigma: Uncertainty around depth value.
+        directions_norm: Norms of ray direction vectors in the camera frame.
+        is_euclidean: Whether ground truth depths corresponds to normalized direction vectors.
+        depth_loss_type: Type of depth loss to apply.
+
+    Returns:
+        Depth loss scalar averaged over levels.
+    """
+    if not is_euclidean:
+        termination_depth = termination_depth * directions_norm
+
+    num_samples = [weights.shape[-2] for weights in weights_list]
+    max_samples = max(num_samples)
+
+    def pad(tensor: Tensor) -> Tensor:
+        return F.pad(tensor, (0, 0, 0, max_samples - tensor.shape[-2]))
+
+    # (num_levels, num_rays, max_samples, 1)
+    weights = torch.stack([pad(w) for w in weights_list])
+    starts = torch.stack([pad(rs.frustums.starts) for rs in ray_samples_list])
+    ends = torch.stack([pad(rs.frustums.ends) for rs in ray_samples_list])
+    steps = (starts + ends) / 2
+    sample_counts = torch.tensor(num_samples, device=weights.device)
+    valid = torch.arange(max_samples, device=weights.device)[None, :] < sample_counts[:, None]
+    valid = valid[:, None, :, None]
+
+    depth_mask = termination_depth > 0
+    target = termination_depth[None, :, None]
+
+    if depth_loss_type == DepthLossType.DS_NERF:
+        # Padded samples have zero length and therefore contribute nothing
+        lengths = ends - starts
+        loss = -torch.log(weights + EPS) * torch.exp(-((steps - target) ** 2) / (2 * sigma)) * lengths
+        loss = loss.sum(-2) * depth_mask
+        return torch.mean(loss)
+
+    if depth_loss_type == DepthLossType.URF:
+        expected_depth_loss = (termination_depth - predicted_depth) ** 2
+        target_distribution = torch.distributions.normal.Normal(0.0, sigma / URF_SIGMA_SCALE_FACTOR)
+        near_mask = (steps <= target + sigma) & (steps >= target - sigma) & valid
+        near_loss = (weights - torch.exp(target_distribution.log_prob(steps - target))) ** 2
+        near_loss = (near_mask * near_loss).sum(-2)
+        empty_mask = (steps < target - sigma) & valid
+        empty_loss = (empty_mask * weights**2).sum(-2)
+        loss = (expected_depth_loss + near_loss + empty_loss) * depth_mask
+        return torch.mean(loss)
+
+    raise NotImplementedError("Provided depth loss type not implemented.")
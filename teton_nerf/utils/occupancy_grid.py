@@ -0,0 +1,163 @@
+"""
+Occupancy bitfield of the density field, used to skip empty space when rendering a trained model.
+"""
+
+from __future__ import annotations
+
+from typing import Callable, Tuple
+
+import torch
+from jaxtyping import Bool, Float
+from torch import Tensor
+
+from nerfstudio.cameras.rays import RayBundle
+
+
+def contract(points: Float[Tensor, "*bs 3"]) -> Float[Tensor, "*bs 3"]:
+    """SceneContraction with the L-inf norm, as used by the Teton field. Maps all of space into [-2, 2]^3."""
+    magnitude = torch.linalg.norm(points, ord=float("inf"), dim=-1, keepdim=True)
+    return torch.where(magnitude < 1, points, (2 - 1 / magnitude) * (points / magnitude))
+
+
+def uncontract(points: Float[Tensor, "*bs 3"]) -> Float[Tensor, "*bs 3"]:
+    """Inverse of contract, for points strictly inside [-2, 2]^3."""
+    magnitude = torch.linalg.norm(points, ord=float("inf"), dim=-1, keepdim=True)
+    return torch.where(magnitude < 1, points, points / (magnitude * (2 - magnitude).clamp(min=1e-6)))
+
+
+def _spacing(t: Tensor) -> Tensor:
+    # Same spacing as the UniformLinDispPiecewiseSampler of the proposal sampler: linear up to 1, then in disparity
+    return torch.where(t < 1, t / 2, 1 - 1 / (2 * t))
+
+
+def _spacing_inv(s: Tensor) -> Tensor:
+    return torch.where(s < 0.5, 2 * s, 1 / (2 - 2 * s))
+
+
+class OccupancyGrid(torch.nn.Module):
+    """Bitfield of the grid cells whose density exceeds a threshold.
+
+    The grid covers the contracted space [-2, 2]^3 of the field, so it also holds the unbounded part of the scene,
+    or the aabb if the field does not contract space. Then everything outside the aabb counts as occupied.
+    The bitfield is a non-persistent buffer, it is not saved with checkpoints and is rebuilt from the density
+    whenever it is stale.
+
+    Args:
+        aabb: Scene box of the field.
+        resolution: Number of cells along every axis.
+        contracted: Whether the field contracts space with the L-inf SceneContraction.
+    """
+
+    def __init__(self, aabb: Float[Tensor, "2 3"], resolution: int = 128, contracted: bool = True):
+        super().__init__()
+        self.resolution = resolution
+        self.contracted = contracted
+        bounds = torch.tensor([[-2.0] * 3, [2.0] * 3]) if contracted else aabb.clone().float()
+        self.register_buffer("bounds", bounds, persistent=False)
+        self.register_buffer("bitfield", torch.zeros(0, dtype=torch.uint8), persistent=False)
+        self.stale = True
+
+    def mark_stale(self) -> None:
+        """The density changed, rebuild the bitfield before it is used next."""
+        self.stale = True
+
+    def _grid_coordinates(self, points: Float[Tensor, "*bs 3"]) -> Float[Tensor, "*bs 3"]:
+        if self.contracted:
+            points = contract(points)
+        return (points - self.bounds[0]) / (self.bounds[1] - self.bounds[0]) * self.resolution
+
+    @torch.no_grad()
+    def update(
+        self,
+        density_fn: Callable[[Tensor], Tensor],
+        density_threshold: float = 0.01,
+        samples_per_cell: int = 4,
+        dilation: int = 1,
+        chunk_size: int = 1 << 20,
+    ) -> float:
+        """Rebuilds the bitfield from the density at random points in every cell.
+
+        A cell is occupied if the maximum density of its samples exceeds the threshold. The occupied cells are
+        dilated, so thin surfaces that the samples miss in one cell are still caught by a neighbour.
+
+        Returns:
+            The fraction of occupied cells.
+        """
+        device = self.bounds.device
+        num_cells = self.resolution**3
+        cell_size = (self.bounds[1] - self.bounds[0]) / self.resolution
+        max_density = torch.empty(num_cells, device=device)
+        cells_per_chunk = max(1, chunk_size // samples_per_cell)
+        for start in range(0, num_cells, cells_per_chunk):
+            indices = torch.arange(start, min(start + cells_per_chunk, num_cells), device=device)
+            cells = torch.stack(
+                [
+                    indices // self.resolution**2,
+                    indices // self.resolution % self.resolution,
+                    indices % self.resolution,
+                ],
+                dim=-1,
+            )
+            jitter = torch.rand(len(indices), samples_per_cell, 3, device=device)
+            points = self.bounds[0] + (cells[:, None] + jitter) * cell_size
+            if self.contracted:
+                points = uncontract(points)
+            density = density_fn(points.view(-1, 3)).view(len(indices), samples_per_cell)
+            max_density[start : start + len(indices)] = density.amax(dim=-1)
+
+        occupied = (max_density > density_threshold).float().view(1, 1, *([self.resolution] * 3))
+        if dilation > 0:
+            occupied = torch.nn.functional.max_pool3d(occupied, 2 * dilation + 1, stride=1, padding=dilation)
+        occupied = occupied.view(-1).bool()
+        bits = torch.nn.functional.pad(occupied.to(torch.uint8), (0, -num_cells % 8)).view(-1, 8)
+        # Assigned rather than written in place, updates may run inside inference mode
+        self.bitfield = (bits << torch.arange(8, device=device, dtype=torch.uint8)).sum(dim=-1).to(torch.uint8)
+        self.stale = False
+        return float(occupied.float().mean())
+
+    def occupied(self, points: Float[Tensor, "*bs 3"]) -> Bool[Tensor, "*bs"]:
+        """Whether the cells of the points are occupied. Points outside the grid count as occupied."""
+        assert not self.stale, "The occupancy grid is stale, call update first"
+        coordinates = self._grid_coordinates(points).floor().long()
+        inside = ((coordinates >= 0) & (coordinates < self.resolution)).all(dim=-1)
+        coordinates = coordinates.clamp(0, self.resolution - 1)
+        indices = (coordinates[..., 0] * self.resolution + coordinates[..., 1]) * self.resolution + coordinates[..., 2]
+        bits = (self.bitfield[indices >> 3] >> (indices & 7).to(torch.uint8)) & 1
+        return bits.bool() | ~inside
+
+    @torch.no_grad()
+    def march(
+        self, ray_bundle: RayBundle, num_steps: int = 512, max_points: int = 1 << 22
+    ) -> Tuple[Float[Tensor, "num_rays 1"], Float[Tensor, "num_rays 1"], Bool[Tensor, "num_rays"]]:
+        """Marches the rays between their nears and fars and finds the span that passes occupied cells.
+
+        Steps are uniform in the piecewise linear / disparity spacing of the proposal sampler, so they are about
+        evenly spread in the contracted space the grid lives in. The span is padded by one step on both sides.
+
+        Returns:
+            The tightened nears and fars, and whether the ray passes any occupied cell at all. Rays that pass
+            none keep their last step as span.
+        """
+        assert ray_bundle.nears is not None and ray_bundle.fars is not None, "Apply the collider first"
+        nears = torch.empty_like(ray_bundle.nears)
+        fars = torch.empty_like(ray_bundle.fars)
+        hits = torch.empty(len(ray_bundle), dtype=torch.bool, device=nears.device)
+        steps = torch.arange(num_steps + 1, device=nears.device) / num_steps
+        rays_per_chunk = max(1, max_points // num_steps)
+        for start in range(0, len(ray_bundle), rays_per_chunk):
+            chunk = slice(start, start + rays_per_chunk)
+            s_near, s_far = _spacing(ray_bundle.nears[chunk]), _spacing(ray_bundle.fars[chunk])
+            edges = s_near + steps * (s_far - s_near)
+            t = _spacing_inv((edges[:, :-1] + edges[:, 1:]) / 2)
+            points = ray_bundle.origins[chunk, None] + ray_bundle.directions[chunk, None] * t[..., None]
+            occupied = self.occupied(points)
+            hit = occupied.any(dim=-1)
+            first = torch.where(hit, occupied.int().argmax(dim=-1), num_steps - 1)
+            last = torch.where(hit, num_steps - 1 - occupied.flip(-1).int().argmax(dim=-1), num_steps - 1)
+            lo = (first - 1).clamp(min=0)
+            hi = (last + 2).clamp(max=num_steps)
+            nears[chunk] = _spacing_inv(torch.gather(edges, 1, lo[:, None]))
+            fars[chunk] = _spacing_inv(torch.gather(edges, 1, hi[:, None]))
+            hits[chunk] = hit
+        # The padding can not leave the original span, but the spacing round trip is not exact
+        return torch.maximum(nears, ray_bundle.nears), torch.minimum(fars, ray_bundle.fars), hits
@@ -0,0 +1,138 @@
+"""
+Binary PLY writer that streams vertices to disk in chunks.
+"""
+
+from __future__ import annotations
+
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple, Union
+
+import numpy as np
+import torch
+
+PLY_TYPES = {
+    np.dtype(np.float32): "float",
+    np.dtype(np.float64): "double",
+    np.dtype(np.uint8): "uchar",
+    np.dtype(np.int32): "int",
+    np.dtype(np.uint32): "uint",
+    np.dtype(np.int16): "short",
+    np.dtype(np.uint16): "ushort",
+}
+
+# Width the vertex count is padded to, so the header can be patched in place once the count is known
+COUNT_WIDTH = 20
+
+
+class StreamingPlyWriter:
+    """Writes a binary little endian PLY vertex list without keeping the vertices in memory.
+
+    The header is written with a space padded vertex count that is filled in when the writer is closed.
+
+    Args:
+        path: Output file.
+        properties: Name and numpy dtype of every vertex property, in file order.
+        comments: Comment lines added to the header.
+    """
+
+    def __init__(self, path: Union[Path, str], properties: List[Tuple[str, np.dtype]], comments: Tuple[str, ...] = ()):
+        self.path = Path(path)
+        self.dtype = np.dtype([(name, np.dtype(dtype).newbyteorder("<")) for name, dtype in properties])
+        self.num_vertices = 0
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._file = open(self.path, "wb")
+        header = ["ply", "format binary_little_endian 1.0"]
+        header += [f"comment {comment}" for comment in comments]
+        header.append("element vertex ")
+        self._file.write("\n".join(header).encode("ascii"))
+        self._count_offset = self._file.tell()
+        header = [" " * COUNT_WIDTH]
+        header += [f"property {PLY_TYPES[np.dtype(dtype)]} {name}" for name, dtype in properties]
+        header.append("end_header\n")
+        self._file.write("\n".join(header).encode("ascii"))
+
+    def write(self, **columns: Union[np.ndarray, torch.Tensor]) -> None:
+        """Appends vertices. Multi-channel columns fill consecutive properties, e.g. points=xyz fills x, y and z."""
+        arrays: Dict[str, np.ndarray] = {}
+        for name, column in columns.items():
+            if isinstance(column, torch.Tensor):
+                column = column.detach().cpu().numpy()
+            arrays[name] = column.reshape(len(column), -1)
+        num_vertices = len(next(iter(arrays.values())))
+        vertices = np.empty(num_vertices, dtype=self.dtype)
+        field_names = list(self.dtype.names or [])
+        position = 0
+        for name, array in arrays.items():
+            assert len(array) == num_vertices, f"Column {name} has {len(array)} rows, expected {num_vertices}"
+            for channel in range(array.shape[-1]):
+                vertices[field_names[position]] = array[:, channel]
+                position += 1
+        assert position == len(field_names), f"Got {position} vertex properties, expected {len(field_names)}"
+        vertices.tofile(self._file)
+        self.num_vertices += num_vertices
+
+    def close(self) -> None:
+        if self._file.closed:
+            return
+        self._file.seek(self._count_offset)
+        self._file.write(str(self.num_vertices).ljust(COUNT_WIDTH).encode("ascii"))
+        self._file.close()
+
+    def __enter__(self) -> "StreamingPlyWriter":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+
+def point_cloud_properties(
+    with_normals: bool = False, extra: Optional[List[Tuple[str, np.dtype]]] = None
+) -> List[Tuple[str, np.dtype]]:
+    """Vertex properties of a colored point cloud in the layout Open3D and most viewers read."""
+    properties = [("x", np.float32), ("y", np.float32), ("z", np.float32)]
+    if with_normals:
+        properties += [("nx", np.float32), ("ny", np.float32), ("nz", np.float32)]
+    properties += [("red", np.uint8), ("green", np.uint8), ("blue", np.uint8)]
+    return properties + (extra or [])
+
+
+def write_mesh_ply(
+    path: Union[Path, str],
+    vertices: np.ndarray,
+    faces: np.ndarray,
+    colors: Optional[np.ndarray] = None,
+    normals: Optional[np.ndarray] = None,
+    labels: Optional[np.ndarray] = None,
+) -> None:
+    """Writes a binary little endian triangle mesh with optional uint8 vertex colors, normals and class labels."""
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    properties = [("x", np.float32), ("y", np.float32), ("z", np.float32)]
+    columns = [vertices]
+    if normals is not None:
+        properties += [("nx", np.float32), ("ny", np.float32), ("nz", np.float32)]
+        columns.append(normals)
+    if colors is not None:
+        properties += [("red", np.uint8), ("green", np.uint8), ("blue", np.uint8)]
+        columns.append(colors)
+    if labels is not None:
+        properties.append(("class", np.uint8))
+        columns.append(labels.reshape(-1, 1))
+
+    vertex_dtype = [(name, np.dtype(dtype).newbyteorder("<")) for name, dtype in properties]
+    vertex_data = np.empty(len(vertices), dtype=vertex_dtype)
+    names = iter(vertex_data.dtype.names or [])
+    for column in columns:
+        for channel in column.reshape(len(vertices), -1).T:
+            vertex_data[next(names)] = channel
+    face_data = np.empty(len(faces), dtype=[("count", "u1"), ("indices", "<i4", (3,))])
+    face_data["count"] = 3
+    face_data["indices"] = faces
+
+    header = ["ply", "format binary_little_endian 1.0", f"element vertex {len(vertices)}"]
+    header += [f"property {PLY_TYPES[np.dtype(dtype)]} {name}" for name, dtype in properties]
+    header += [f"element face {len(faces)}", "property list uchar int vertex_indices", "end_header\n"]
+    with open(path, "wb") as file:
+        file.write("\n".join(header).encode("ascii"))
+        vertex_data.tofile(file)
+        face_data.tofile(file)
@@ -0,0 +1,155 @@
+"""
+Statistical outlier removal for large point clouds, using a uniform grid to find the nearest neighbours.
+"""
+
+from __future__ import annotations
+
+import math
+from typing import Optional
+
+import torch
+from jaxtyping import Bool, Float, Int
+from torch import Tensor
+
+from teton_nerf.utils.voxel_hash import KEY_BITS, voxel_keys
+
+# Key offsets of the 3x3x3 block of cells around a cell, in the packing of voxel_keys
+NEIGHBOUR_OFFSETS = torch.tensor(
+    [(dx << (2 * KEY_BITS)) + (dy << KEY_BITS) + dz for dx in (-1, 0, 1) for dy in (-1, 0, 1) for dz in (-1, 0, 1)]
+)
+
+
+def _estimate_cell_size(points: Float[Tensor, "num_points 3"], k: int, num_queries: int = 256) -> float:
+    """Median distance to the k-th neighbour of a random subset of the points."""
+    queries = points[torch.randint(len(points), (min(num_queries, len(points)),))]
+    nearest = torch.empty(len(queries), 0)
+    for start in range(0, len(points), 1 << 16):
+        nearest = torch.cat([nearest, torch.cdist(queries, points[start : start + (1 << 16)])], dim=-1)
+        nearest = nearest.topk(min(k, nearest.shape[-1]), dim=-1, largest=False).values
+    return float(nearest[:, -1].median())
+
+
+def _grid_knn_distances(
+    points: Float[Tensor, "num_points 3"],
+    query_indices: Int[Tensor, "num_queries"],
+    k: int,
+    cell_size: float,
+    max_candidates: int,
+) -> Float[Tensor, "num_queries k"]:
+    """Distances to the k nearest neighbours among the points in the 27 cells around every query.
+
+    Queries with fewer than k points in those cells get infinite distances for the missing neighbours.
+    """
+    offsets = NEIGHBOUR_OFFSETS.to(points.device)
+    origin = points.min(dim=0).values - cell_size
+    keys = voxel_keys(points - origin, cell_size)
+    sorted_keys, order = torch.sort(keys)
+    sorted_points = points[order]
+    # Spatially coherent queries keep the candidate counts within a chunk similar
+    query_order = torch.argsort(keys[query_indices])
+    query_indices = query_indices[query_order]
+
+    distances = torch.empty(len(query_indices), k)
+    start, chunk_size = 0, max(1, max_candidates // (27 * k))
+    while start < len(query_indices):
+        chunk = query_indices[start : start + chunk_size]
+        neighbour_keys = keys[chunk][:, None] + offsets[None, :]
+        begin = torch.searchsorted(sorted_keys, neighbour_keys)
+        counts = torch.searchsorted(sorted_keys, neighbour_keys, right=True) - begin
+        totals = counts.sum(dim=-1)
+        num_candidates = int(totals.max())
+        if len(chunk) > 1 and len(chunk) * num_candidates > max_candidates:
+            chunk_size = max(1, max_candidates // num_candidates)
+            continue
+
+        # Flatten the candidate ranges of the 27 cells into one padded row per query
+        cumulative = torch.cumsum(counts, dim=-1)
+        positions = torch.arange(num_candidates).expand(len(chunk), -1)
+        cell = torch.searchsorted(cumulative, positions.contiguous(), right=True).clamp(max=26)
+        candidates = torch.gather(begin, 1, cell) + positions - torch.gather(cumulative - counts, 1, cell)
+        valid = positions < totals[:, None]
+        candidate_points = sorted_points[torch.where(valid, candidates, 0)]
+        squared = ((candidate_points - points[chunk][:, None]) ** 2).sum(dim=-1)
+        squared = torch.where(valid, squared, math.inf)
+        if num_candidates < k:
+            squared = torch.cat([squared, torch.full((len(chunk), k - num_candidates), math.inf)], dim=-1)
+        distances[start : start + len(chunk)] = squared.topk(k, dim=-1, largest=False).values.sqrt()
+        start += len(chunk)
+        if 2 * len(chunk) * num_candidates <= max_candidates:
+            chunk_size *= 2
+
+    result = torch.empty_like(distances)
+    result[query_order] = distances
+    return result
+
+
+def knn_mean_distances(
+    points: Float[Tensor, "num_points 3"],
+    k: int,
+    cell_size: Optional[float] = None,
+    max_candidates: int = 1 << 24,
+) -> Float[Tensor, "num_points"]:
+    """Mean distance of every point to its k nearest neighbours, the point itself included as Open3D does.
+
+    The neighbours are searched in the 3x3x3 cells around every point, which is exact for all points whose
+    k-th neighbour lies within one cell size. The remaining points are searched again with doubled cells.
+
+    Args:
+        points: Points to compute the distances for.
+        k: Number of neighbours.
+        cell_size: Edge length of the grid cells. Estimated from the data if not set.
+        max_candidates: Bound on the number of candidate neighbours held in memory at once.
+    """
+    points = points.float()
+    k = min(k, len(points))
+    extent = float((points.max(dim=0).values - points.min(dim=0).values).max())
+    cell_size = cell_size or _estimate_cell_size(points, k)
+    # Keeps the cell coordinates within the range of the voxel keys
+    cell_size = max(cell_size, extent / (1 << (KEY_BITS - 2)), 1e-9)
+
+    mean_distances = torch.empty(len(points))
+    pending = torch.arange(len(points))
+    while len(pending) > 0:
+        distances = _grid_knn_distances(points, pending, k, cell_size, max_candidates)
+        # The search is exact for every point whose k-th neighbour is within one cell, and for all points
+        # once a single cell covers the whole cloud
+        resolved = (distances[:, -1] <= cell_size) | (cell_size > extent)
+        mean_distances[pending[resolved]] = distances[resolved].mean(dim=-1)
+        pending = pending[~resolved]
+        cell_size *= 2
+    return mean_distances
+
+
+def statistical_outlier_mask(
+    points: Float[Tensor, "num_points 3"],
+    nb_neighbors: int = 20,
+    std_ratio: float = 10.0,
+    num_threads: Optional[int] = None,
+) -> Bool[Tensor, "num_points"]:
+    """Points to keep, with the semantics of Open3D's remove_statistical_outlier.
+
+    A point is removed if its mean distance to its nb_neighbors nearest neighbours is larger than the mean
+    of those distances over the cloud plus std_ratio times their standard deviation.
+
+    Args:
+        points: Point cloud to filter.
+        nb_neighbors: Number of neighbours around the target point, itself included.
+        std_ratio: Threshold based on STD of the average distances across the point cloud to remove outliers.
+        num_threads: Number of CPU threads used by torch during the search, the torch default if not set.
+
+    Returns:
+        Mask of the points to keep, on the device of the input points.
+    """
+    if len(points) == 0:
+        return torch.ones(0, dtype=torch.bool, device=points.device)
+    previous_threads = torch.get_num_threads()
+    if num_threads is not None:
+        torch.set_num_threads(num_threads)
+    try:
+        with torch.inference_mode():
+            # The search runs on the CPU, the candidate gathers are too memory hungry for large clouds on the GPU
+            mean_distances = knn_mean_distances(points.detach().cpu(), nb_neighbors)
+    finally:
+        torch.set_num_threads(previous_threads)
+    mean, std = mean_distances.mean(), mean_distances.std()
+    return (mean_distances < mean + std_ratio * std).to(points.device)
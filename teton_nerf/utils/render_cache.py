@@ -0,0 +1,200 @@
+"""
+LRU cache of rendered camera outputs, keyed by the quantized camera and the checkpoint step.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, Optional, Sequence
+
+import torch
+from torch import Tensor
+
+from nerfstudio.cameras.cameras import Cameras
+
+
+def _quantize(values: Tensor, precision: float) -> bytes:
+    return torch.round(values.detach().double().cpu() / precision).long().numpy().tobytes()
+
+
+def model_digest(module: torch.nn.Module, config: str = "") -> str:
+    """Hash of the persistent parameters and buffers of the module and of a description of its config.
+
+    Tells apart models that reached the same step, e.g. a retrained model or the runs of a sweep.
+    """
+    digest = hashlib.sha1(config.encode())
+    for name, value in module.state_dict().items():
+        digest.update(name.encode())
+        digest.update(value.detach().flatten().contiguous().cpu().view(torch.uint8).numpy().tobytes())
+    return digest.hexdigest()
+
+
+def camera_cache_key(
+    camera: Cameras,
+    step: int,
+    model: str = "",
+    translation_precision: float = 1e-4,
+    intrinsics_precision: float = 1e-2,
+) -> str:
+    """Hash of a single camera's pose, intrinsics, resolution, type and distortion, the checkpoint step and the
+    model.
+
+    Poses are quantized, so an orbit reset that returns to nearly the same pose still hits the cache.
+
+    Args:
+        camera: Camera of shape [1] or [].
+        step: Step of the checkpoint the outputs are rendered with.
+        model: Digest of the model the outputs are rendered with, see model_digest.
+        translation_precision: Quantization of the pose matrix entries, in scene units for the translation.
+        intrinsics_precision: Quantization of the focal lengths and principal point in pixels.
+    """
+    camera = camera.flatten()
+    digest = hashlib.sha1()
+    digest.update(_quantize(camera.camera_to_worlds, translation_precision))
+    digest.update(_quantize(torch.cat([camera.fx, camera.fy, camera.cx, camera.cy], dim=-1), intrinsics_precision))
+    digest.update(torch.cat([camera.width, camera.height, camera.camera_type], dim=-1).long().cpu().numpy().tobytes())
+    if camera.distortion_params is not None:
+        digest.update(_quantize(camera.distortion_params, 1e-6))
+    digest.update(str(step).encode())
+    digest.update(model.encode())
+    return digest.hexdigest()
+
+
+class RenderCache:
+    """Rendered outputs kept on the CPU in least recently used order, within a memory budget.
+
+    Entries evicted from memory are written to the spill directory if one is set, which has its own budget
+    and is also evicted least recently used first. Entries already in the spill directory are picked up at
+    startup, oldest first, so a later process with the same directory, e.g. a second ns-render-teton of the same
+    checkpoint, finds the renders a previous one persisted. Safe to use from the viewer and training threads at
+    once.
+
+    Args:
+        max_memory_mb: Budget of the entries kept in memory.
+        spill_dir: Directory evicted entries are written to. Evicted entries are dropped if not set.
+        max_disk_mb: Budget of the spill directory.
+    """
+
+    def __init__(self, max_memory_mb: float = 1024, spill_dir: Optional[Path] = None, max_disk_mb: float = 8192):
+        self.max_memory_bytes = int(max_memory_mb * 2**20)
+        self.max_disk_bytes = int(max_disk_mb * 2**20)
+        self.spill_dir = spill_dir
+        if spill_dir is not None:
+            spill_dir.mkdir(parents=True, exist_ok=True)
+        self._memory: OrderedDict[str, Dict[str, Tensor]] = OrderedDict()
+        self._disk: OrderedDict[str, int] = OrderedDict()
+        self._memory_bytes = 0
+        self._disk_bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        if spill_dir is not None:
+            for path in sorted(spill_dir.glob("*.pt"), key=lambda path: path.stat().st_mtime):
+                self._disk[path.stem] = path.stat().st_size
+                self._disk_bytes += path.stat().st_size
+            self._trim_disk()
+
+    @staticmethod
+    def _size(outputs: Dict[str, Tensor]) -> int:
+        return sum(value.numel() * value.element_size() for value in outputs.values())
+
+    def _spill_path(self, key: str) -> Path:
+        assert self.spill_dir is not None
+        return self.spill_dir / f"{key}.pt"
+
+    def __contains__(self, key: str) -> bool:
+        with self._lock:
+            return key in self._memory or key in self._disk
+
+    def get(self, key: str, output_names: Optional[Sequence[str]] = None) -> Optional[Dict[str, Tensor]]:
+        """Cached outputs of the key, None if not cached or if any of output_names was not cached."""
+        with self._lock:
+            outputs = self._memory.get(key)
+            from_disk = False
+            if outputs is None and key in self._disk:
+                self._disk_bytes -= self._disk.pop(key)
+                path = self._spill_path(key)
+                outputs = torch.load(path, map_location="cpu")
+                path.unlink(missing_ok=True)
+                self._insert(key, outputs)
+                from_disk = True
+            if outputs is None or (output_names is not None and any(name not in outputs for name in output_names)):
+                self.misses += 1
+                return None
+            self._memory.move_to_end(key)
+            self.hits += 1
+            self.disk_hits += from_disk
+            return dict(outputs)
+
+    def put(self, key: str, outputs: Dict[str, Tensor]) -> None:
+        """Caches the tensor outputs on the CPU, merged with outputs already cached for the key."""
+        outputs = {name: value.detach().cpu() for name, value in outputs.items() if isinstance(value, Tensor)}
+        with self._lock:
+            if key in self._memory:
+                previous = self._memory.pop(key)
+                self._memory_bytes -= self._size(previous)
+                outputs = {**previous, **outputs}
+            self._insert(key, outputs)
+
+    def _insert(self, key: str, outputs: Dict[str, Tensor]) -> None:
+        self._memory[key] = outputs
+        self._memory_bytes += self._size(outputs)
+        while self._memory_bytes > self.max_memory_bytes and len(self._memory) > 1:
+            evicted_key, evicted = self._memory.popitem(last=False)
+            size = self._size(evicted)
+            self._memory_bytes -= size
+            self.evictions += 1
+            if self.spill_dir is not None and size <= self.max_disk_bytes:
+                self._spill(evicted_key, evicted)
+
+    def _spill(self, key: str, outputs: Dict[str, Tensor]) -> None:
+        path = self._spill_path(key)
+        torch.save(outputs, path)
+        if key in self._disk:
+            self._disk_bytes -= self._disk.pop(key)
+        self._disk[key] = path.stat().st_size
+        self._disk_bytes += self._disk[key]
+        self._trim_disk()
+
+    def _trim_disk(self) -> None:
+        while self._disk_bytes > self.max_disk_bytes:
+            dropped_key, dropped_size = self._disk.popitem(last=False)
+            self._disk_bytes -= dropped_size
+            self._spill_path(dropped_key).unlink(missing_ok=True)
+
+    def persist(self) -> None:
+        """Moves the entries in memory to the spill directory, for later processes. Does nothing without one."""
+        if self.spill_dir is None:
+            return
+        with self._lock:
+            while self._memory:
+                key, outputs = self._memory.popitem(last=False)
+                self._memory_bytes -= self._size(outputs)
+                self._spill(key, outputs)
+
+    def clear(self) -> None:
+        with self._lock:
+            for key in self._disk:
+                self._spill_path(key).unlink(missing_ok=True)
+            self._memory.clear()
+            self._disk.clear()
+            self._memory_bytes = self._disk_bytes = 0
+
+    def metrics(self) -> Dict[str, float]:
+        """Hit and miss counts, hit rate and the size of the cache."""
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "entries": len(self._memory) + len(self._disk),
+            "memory_mb": self._memory_bytes / 2**20,
+            "disk_mb": self._disk_bytes / 2**20,
+        }
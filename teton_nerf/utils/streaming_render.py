@@ -0,0 +1,318 @@
+"""
+Trajectory rendering where the model renders frames while a background thread encodes the finished ones.
+"""
+
+from __future__ import annotations
+
+import queue
+import threading
+import time
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional
+
+import mediapy as media
+import numpy as np
+import torch
+from rich.progress import BarColumn, Progress, TaskProgressColumn, TextColumn, TimeElapsedColumn, TimeRemainingColumn
+from torch import Tensor
+from typing_extensions import Literal
+
+from nerfstudio.cameras.cameras import Cameras
+from nerfstudio.pipelines.base_pipeline import Pipeline
+from nerfstudio.utils import colormaps
+from nerfstudio.utils.rich_utils import CONSOLE, ItersPerSecColumn
+
+
+def _colorize(
+    outputs: Dict[str, Tensor],
+    rendered_output_names: List[str],
+    depth_near_plane: Optional[float],
+    depth_far_plane: Optional[float],
+    colormap_options: colormaps.ColormapOptions,
+) -> np.ndarray:
+    """Side by side uint8 image of the rendered outputs of one frame, colorized as ns-render does."""
+    images = []
+    for name in rendered_output_names:
+        if "depth" in name:
+            image = colormaps.apply_depth_colormap(
+                outputs[name],
+                accumulation=outputs["accumulation"],
+                near_plane=depth_near_plane,
+                far_plane=depth_far_plane,
+                colormap_options=colormap_options,
+            )
+        else:
+            image = colormaps.apply_colormap(image=outputs[name], colormap_options=colormap_options)
+        images.append(image)
+    # Convert on the device, so only a quarter of the bytes go through the host copy
+    return (torch.cat(images, dim=1).clamp(0, 1) * 255).round().byte().cpu().numpy()
+
+
+@torch.inference_mode()
+def iter_rendered_frames(
+    pipeline: Pipeline,
+    cameras: Cameras,
+    rendered_output_names: List[str],
+    num_rays_per_chunk: Optional[int] = None,
+    depth_near_plane: Optional[float] = None,
+    depth_far_plane: Optional[float] = None,
+    colormap_options: colormaps.ColormapOptions = colormaps.ColormapOptions(),
+) -> Iterator[np.ndarray]:
+    """Renders the cameras in order and yields every frame as soon as its last ray is rendered.
+
+    The pixels of all frames are treated as one stream that is cut into chunks of num_rays_per_chunk rays,
+    so a chunk continues into the next frame instead of ending short at the last pixel of a frame. Rays are
+    generated per chunk, so besides the chunk only the outputs of the frames in flight are kept in memory.
+    Frames found in the render cache of the model are taken from it instead of being rendered.
+
+    Args:
+        pipeline: Pipeline to render with.
+        cameras: Cameras of the trajectory, one frame per camera.
+        rendered_output_names: Model outputs placed side by side in every frame.
+        num_rays_per_chunk: Number of rays rendered at once, the eval_num_rays_per_chunk of the model if not set.
+        depth_near_plane: Closest depth of the depth colormap. If None, use min value.
+        depth_far_plane: Furthest depth of the depth colormap. If None, use max value.
+        colormap_options: Options for colormap.
+    """
+    model = pipeline.model
+    device = model.device
+    cameras = cameras.flatten().to(device)
+    num_rays_per_chunk = num_rays_per_chunk or model.config.eval_num_rays_per_chunk
+    output_names = set(rendered_output_names)
+    if any("depth" in name for name in rendered_output_names):
+        output_names.add("accumulation")
+
+    # Frames in the render cache of the model are not rendered again, they are served in order in between
+    render_cache = getattr(model, "render_cache", None)
+    keys = []
+    if render_cache is not None:
+        keys = [model.render_cache_key(cameras[idx : idx + 1]) for idx in range(len(cameras))]
+    rendered = [idx for idx in range(len(cameras)) if render_cache is None or keys[idx] not in render_cache]
+    next_frame = 0
+
+    def cached_frames(until: int) -> Iterator[np.ndarray]:
+        nonlocal next_frame
+        while next_frame < until:
+            assert render_cache is not None
+            outputs = render_cache.get(keys[next_frame], output_names)
+            if outputs is None:
+                # Evicted since the lookup above, or cached without all of the outputs
+                camera = cameras[next_frame : next_frame + 1]
+                ray_bundle = camera.generate_rays(camera_indices=0, keep_shape=True)
+                outputs = model.get_outputs_for_camera_ray_bundle(ray_bundle)
+                render_cache.put(keys[next_frame], outputs)
+            outputs = {name: value.to(device) for name, value in outputs.items()}
+            yield _colorize(outputs, rendered_output_names, depth_near_plane, depth_far_plane, colormap_options)
+            next_frame += 1
+
+    rendered_cameras = torch.tensor(rendered, dtype=torch.long, device=device)
+    heights = cameras.height.view(-1).long()[rendered_cameras]
+    widths = cameras.width.view(-1).long()[rendered_cameras]
+    frame_ends = torch.cumsum(heights * widths, dim=0)
+    frame_starts = frame_ends - heights * widths
+    num_rays = int(frame_ends[-1]) if rendered else 0
+
+    # Outputs of the frames that are partially rendered, by position in rendered
+    buffers: Dict[int, Dict[str, Tensor]] = {}
+    for start in range(0, num_rays, num_rays_per_chunk):
+        ray_indices = torch.arange(start, min(start + num_rays_per_chunk, num_rays), device=device)
+        frame_indices = torch.searchsorted(frame_ends, ray_indices, right=True)
+        pixel_indices = ray_indices - frame_starts[frame_indices]
+        width = widths[frame_indices]
+        coords = torch.stack([pixel_indices // width, pixel_indices % width], dim=-1).float() + 0.5
+        ray_bundle = cameras.generate_rays(camera_indices=rendered_cameras[frame_indices, None], coords=coords)
+        outputs = model(ray_bundle)
+        missing = output_names - outputs.keys()
+        if missing:
+            raise ValueError(f"Could not find {sorted(missing)} in the model outputs, choose from {list(outputs)}")
+
+        first_frame, last_frame = int(frame_indices[0]), int(frame_indices[-1])
+        for frame in range(first_frame, last_frame + 1):
+            frame_start, frame_end = int(frame_starts[frame]), int(frame_ends[frame])
+            if frame not in buffers:
+                buffers[frame] = {
+                    name: torch.empty(frame_end - frame_start, outputs[name].shape[-1], device=device)
+                    for name in output_names
+                }
+            lo, hi = max(frame_start, start), min(frame_end, start + len(ray_indices))
+            for name in output_names:
+                buffers[frame][name][lo - frame_start : hi - frame_start] = outputs[name][lo - start : hi - start]
+            if hi == frame_end:
+                frame_outputs = buffers.pop(frame)
+                shape = (int(heights[frame]), int(widths[frame]), -1)
+                frame_outputs = {name: value.view(shape) for name, value in frame_outputs.items()}
+                camera_index = rendered[frame]
+                yield from cached_frames(camera_index)
+                if render_cache is not None:
+                    render_cache.put(keys[camera_index], frame_outputs)
+                yield _colorize(
+                    frame_outputs, rendered_output_names, depth_near_plane, depth_far_plane, colormap_options
+                )
+                next_frame = camera_index + 1
+    yield from cached_frames(len(cameras))
+
+
+class FrameEncoder(threading.Thread):
+    """Writes the frames put on its queue to a video or an image folder until it receives None.
+
+    The queue is bounded, so a renderer that outruns the encoder blocks instead of piling up frames.
+
+    Args:
+        output_filename: Video file, or the folder named after its stem for images.
+        fps: Frame rate of the video.
+        output_format: Write a video or one image per frame.
+        image_format: Format of the images.
+        jpeg_quality: Quality of the jpeg images.
+        queue_size: Maximum number of frames waiting to be encoded.
+    """
+
+    def __init__(
+        self,
+        output_filename: Path,
+        fps: float,
+        output_format: Literal["images", "video"] = "video",
+        image_format: Literal["jpeg", "png"] = "jpeg",
+        jpeg_quality: int = 100,
+        queue_size: int = 8,
+    ):
+        super().__init__(daemon=True)
+        self.output_filename = output_filename
+        self.fps = fps
+        self.output_format = output_format
+        self.image_format = image_format
+        self.jpeg_quality = jpeg_quality
+        self.frames: queue.Queue = queue.Queue(maxsize=queue_size)
+        self.num_frames = 0
+        self.error: Optional[BaseException] = None
+
+    @property
+    def output_image_dir(self) -> Path:
+        return self.output_filename.parent / self.output_filename.stem
+
+    def put(self, frame: Optional[np.ndarray]) -> None:
+        """Queues a frame, None finishes the encoding. Raises the error of the encoder if it failed."""
+        while True:
+            if self.error is not None:
+                raise RuntimeError("Encoding the rendered frames failed") from self.error
+            try:
+                self.frames.put(frame, timeout=0.5)
+                return
+            except queue.Full:
+                continue
+
+    def run(self) -> None:
+        writer = None
+        try:
+            while True:
+                frame = self.frames.get()
+                if frame is None:
+                    break
+                if self.output_format == "video":
+                    if writer is None:
+                        self.output_filename.parent.mkdir(parents=True, exist_ok=True)
+                        writer = media.VideoWriter(path=self.output_filename, shape=frame.shape[:2], fps=self.fps)
+                        writer.__enter__()
+                    writer.add_image(frame)
+                else:
+                    self.output_image_dir.mkdir(parents=True, exist_ok=True)
+                    if self.image_format == "png":
+                        media.write_image(self.output_image_dir / f"{self.num_frames:05d}.png", frame, fmt="png")
+                    else:
+                        media.write_image(
+                            self.output_image_dir / f"{self.num_frames:05d}.jpg",
+                            frame,
+                            fmt="jpeg",
+                            quality=self.jpeg_quality,
+                        )
+                self.num_frames += 1
+        except BaseException as error:  # pylint: disable=broad-except
+            self.error = error
+        finally:
+            if writer is not None:
+                writer.__exit__(None, None, None)
+
+
+def render_trajectory_streaming(
+    pipeline: Pipeline,
+    cameras: Cameras,
+    output_filename: Path,
+    rendered_output_names: List[str],
+    fps: float,
+    output_format: Literal["images", "video"] = "video",
+    image_format: Literal["jpeg", "png"] = "jpeg",
+    jpeg_quality: int = 100,
+    num_rays_per_chunk: Optional[int] = None,
+    queue_size: int = 8,
+    depth_near_plane: Optional[float] = None,
+    depth_far_plane: Optional[float] = None,
+    colormap_options: colormaps.ColormapOptions = colormaps.ColormapOptions(),
+) -> Dict[str, float]:
+    """Renders a trajectory to a video or images, encoding the frames in a background thread while the next ones
+    render. Takes the arguments of iter_rendered_frames and FrameEncoder.
+
+    Returns:
+        The number of frames, the total seconds and the frames per second of the whole render.
+    """
+    encoder = FrameEncoder(
+        output_filename,
+        fps=fps,
+        output_format=output_format,
+        image_format=image_format,
+        jpeg_quality=jpeg_quality,
+        queue_size=queue_size,
+    )
+    progress = Progress(
+        TextColumn(":movie_camera: Rendering :movie_camera:"),
+        BarColumn(),
+        TaskProgressColumn(),
+        ItersPerSecColumn(suffix="fps"),
+        TimeRemainingColumn(elapsed_when_finished=False, compact=False),
+        TimeElapsedColumn(),
+        console=CONSOLE,
+    )
+    start_time = time.perf_counter()
+    encoder.start()
+    try:
+        with progress:
+            task = progress.add_task("", total=len(cameras))
+            frames = iter_rendered_frames(
+                pipeline,
+                cameras,
+                rendered_output_names,
+                num_rays_per_chunk=num_rays_per_chunk,
+                depth_near_plane=depth_near_plane,
+                depth_far_plane=depth_far_plane,
+                colormap_options=colormap_options,
+            )
+            for frame in frames:
+                encoder.put(frame)
+                progress.advance(task)
+        render_seconds = time.perf_counter() - start_time
+    finally:
+        # Let the encoder flush the queued frames, also when rendering failed
+        if encoder.error is None:
+            encoder.put(None)
+        encoder.join()
+    if encoder.error is not None:
+        raise RuntimeError("Encoding the rendered frames failed") from encoder.error
+
+    seconds = time.perf_counter() - start_time
+    stats = {"frames": float(encoder.num_frames), "seconds": seconds, "fps": encoder.num_frames / seconds}
+    CONSOLE.print(
+        f"Rendered {encoder.num_frames} frames in {seconds:.1f}s, {stats['fps']:.2f} fps "
+        f"({encoder.num_frames / render_seconds:.2f} fps rendering, "
+        f"{seconds - render_seconds:.1f}s waiting for the encoder)"
+    )
+    render_cache = getattr(pipeline.model, "render_cache", None)
+    if render_cache is not None:
+        # Leaves the renders to the next run with the same spill directory
+        render_cache.persist()
+        cache_metrics = render_cache.metrics()
+        CONSOLE.print(
+            f"Render cache: {cache_metrics['hits']} hits ({cache_metrics['disk_hits']} from disk), "
+            f"{cache_metrics['misses']} misses, {cache_metrics['memory_mb']:.0f} MB in memory"
+        )
+        stats.update({f"render_cache_{name}": float(value) for name, value in cache_metrics.items()})
+    output = output_filename if output_format == "video" else encoder.output_image_dir
+    CONSOLE.print(f"[bold green]:tada: Render Complete, saved to {output}")
+    return stats
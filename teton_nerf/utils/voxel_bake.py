@@ -0,0 +1,236 @@
+"""
+Baking of the field into a sparse voxel grid of density, color and semantic labels, and a CPU renderer for it.
+"""
+
+from __future__ import annotations
+
+from pathlib import Path
+from typing import Dict, Optional, Union
+
+import numpy as np
+import torch
+from jaxtyping import Float
+from torch import Tensor
+
+from nerfstudio.cameras.cameras import Cameras
+from nerfstudio.field_components.field_heads import FieldHeadNames
+from nerfstudio.fields.base_field import Field
+from nerfstudio.utils.rich_utils import CONSOLE
+
+from teton_nerf.utils.density_grid import evaluate_density_grid, query_vertex_outputs
+
+
+def bake_sparse_voxels(
+    field: Field,
+    aabb: Float[Tensor, "2 3"],
+    resolution: int = 256,
+    density_threshold: float = 1.0,
+    num_directions: int = 8,
+    semantics: bool = False,
+    chunk_size: int = 1 << 20,
+) -> "SparseVoxelGrid":
+    """Samples the field at the voxel centers of a grid inside the aabb and keeps the voxels that are not empty.
+
+    Colors are view dependent in the field, the baked color is their mean over num_directions directions spread
+    over the sphere. The semantic label is the argmax of the mean semantic logits.
+
+    Args:
+        field: Field to bake.
+        aabb: Bounds of the grid.
+        resolution: Number of voxels along every axis.
+        density_threshold: Voxels with a lower density are dropped.
+        num_directions: Number of view directions the colors are averaged over.
+        semantics: Whether to bake the semantic labels.
+        chunk_size: Maximum number of points evaluated at once.
+    """
+    aabb = aabb.float().cpu()
+    densities = evaluate_density_grid(field, aabb, resolution, chunk_size=chunk_size).view(-1)
+    keys = torch.nonzero(densities > density_threshold)[:, 0]
+    voxel_size = (aabb[1] - aabb[0]) / resolution
+    coords = torch.stack([keys // resolution**2, keys // resolution % resolution, keys % resolution], dim=-1)
+    centers = aabb[0] + (coords + 0.5) * voxel_size
+
+    # Fibonacci sphere, evenly spread directions
+    index = torch.arange(num_directions) + 0.5
+    polar = torch.arccos(1 - 2 * index / num_directions)
+    azimuth = torch.pi * (1 + 5**0.5) * index
+    directions = torch.stack(
+        [torch.sin(polar) * torch.cos(azimuth), torch.sin(polar) * torch.sin(azimuth), torch.cos(polar)], dim=-1
+    )
+    colors = torch.zeros(len(keys), 3)
+    logits = None
+    for direction in directions:
+        outputs = query_vertex_outputs(
+            field, centers, direction.expand_as(centers), chunk_size=min(chunk_size, 1 << 18)
+        )
+        colors += outputs[FieldHeadNames.RGB].float() / num_directions
+        if semantics:
+            direction_logits = outputs[FieldHeadNames.SEMANTICS].float()
+            logits = direction_logits if logits is None else logits + direction_logits
+
+    CONSOLE.print(f"Baked {len(keys)} of {resolution**3} voxels ({len(keys) / resolution**3:.2%})")
+    return SparseVoxelGrid(
+        keys=keys,
+        densities=densities[keys],
+        colors=(colors.clamp(0, 1) * 255).round().byte(),
+        labels=torch.argmax(logits, dim=-1).byte() if logits is not None else None,
+        aabb=aabb,
+        resolution=resolution,
+    )
+
+
+class SparseVoxelGrid:
+    """Voxels of a regular grid that are not empty, stored as sorted linear keys x * R^2 + y * R + z.
+
+    Lookups are a binary search of the keys, so the grid needs no memory for the empty voxels.
+
+    Args:
+        keys: Sorted linear keys of the voxels.
+        densities: Density of every voxel.
+        colors: uint8 color of every voxel.
+        labels: uint8 semantic label of every voxel, if baked with semantics.
+        aabb: Bounds of the grid.
+        resolution: Number of voxels along every axis.
+    """
+
+    def __init__(
+        self,
+        keys: Tensor,
+        densities: Tensor,
+        colors: Tensor,
+        labels: Optional[Tensor],
+        aabb: Tensor,
+        resolution: int,
+    ):
+        self.keys = keys.long()
+        self.densities = densities.float()
+        self.colors = colors.float() / 255.0
+        self.labels = labels
+        self.aabb = aabb.float()
+        self.resolution = resolution
+        self.voxel_size = (self.aabb[1] - self.aabb[0]) / resolution
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def save(self, path: Union[Path, str]) -> None:
+        """Writes the grid to a compressed npz file, densities as float16."""
+        arrays = {
+            "keys": self.keys.numpy(),
+            "densities": self.densities.half().numpy(),
+            "colors": (self.colors * 255).round().byte().numpy(),
+            "aabb": self.aabb.numpy(),
+            "resolution": np.array(self.resolution),
+        }
+        if self.labels is not None:
+            arrays["labels"] = self.labels.numpy()
+        np.savez_compressed(path, **arrays)
+
+    @classmethod
+    def load(cls, path: Union[Path, str]) -> "SparseVoxelGrid":
+        data = np.load(path)
+        return cls(
+            keys=torch.from_numpy(data["keys"]),
+            densities=torch.from_numpy(data["densities"]),
+            colors=torch.from_numpy(data["colors"]),
+            labels=torch.from_numpy(data["labels"]) if "labels" in data else None,
+            aabb=torch.from_numpy(data["aabb"]),
+            resolution=int(data["resolution"]),
+        )
+
+    def lookup(self, points: Float[Tensor, "*bs 3"]) -> Tensor:
+        """Index of the voxel every point falls into, -1 for empty voxels and points outside the grid."""
+        if len(self.keys) == 0:
+            return torch.full(points.shape[:-1], -1, dtype=torch.long)
+        coords = ((points - self.aabb[0]) / self.voxel_size).floor().long()
+        inside = ((coords >= 0) & (coords < self.resolution)).all(dim=-1)
+        keys = (coords[..., 0] * self.resolution + coords[..., 1]) * self.resolution + coords[..., 2]
+        index = torch.searchsorted(self.keys, keys).clamp(max=len(self.keys) - 1)
+        found = inside & (self.keys[index] == keys)
+        return torch.where(found, index, -1)
+
+    @torch.inference_mode()
+    def render_rays(
+        self,
+        origins: Float[Tensor, "num_rays 3"],
+        directions: Float[Tensor, "num_rays 3"],
+        near: float = 0.05,
+        step_size: Optional[float] = None,
+        samples_per_block: int = 64,
+        min_transmittance: float = 1e-3,
+        background: Optional[Float[Tensor, "3"]] = None,
+    ) -> Dict[str, Tensor]:
+        """Alpha composites the voxels along the rays, marching in blocks of samples until the rays are opaque.
+
+        Rays only march between their entry and exit of the aabb, and stop once their transmittance falls below
+        min_transmittance. Returns rgb, depth, accumulation and, if baked, the label of the sample with the
+        highest weight.
+
+        Args:
+            origins: Ray origins.
+            directions: Unit ray directions.
+            near: Minimum distance along the rays.
+            step_size: Distance between samples, half a voxel if not set.
+            samples_per_block: Number of samples evaluated at once per ray.
+            min_transmittance: Transmittance at which rays stop.
+            background: Color blended in behind the voxels, black if not set.
+        """
+        step_size = step_size or float(self.voxel_size.min()) / 2
+        num_rays = len(origins)
+        # Slab intersection with the aabb
+        inverse = 1 / torch.where(directions.abs() < 1e-9, torch.full_like(directions, 1e-9), directions)
+        t_lo, t_hi = (self.aabb[0] - origins) * inverse, (self.aabb[1] - origins) * inverse
+        t_near = torch.minimum(t_lo, t_hi).amax(dim=-1).clamp(min=near)
+        t_far = torch.maximum(t_lo, t_hi).amin(dim=-1)
+
+        rgb = torch.zeros(num_rays, 3)
+        depth = torch.zeros(num_rays)
+        transmittance = torch.ones(num_rays)
+        best_weight = torch.zeros(num_rays)
+        labels = torch.zeros(num_rays, dtype=torch.uint8)
+        offsets = (torch.arange(samples_per_block) + 0.5) * step_size
+        block_start = 0.0
+        active = torch.nonzero(t_far > t_near)[:, 0]
+        while len(active) > 0:
+            t = t_near[active, None] + block_start + offsets
+            valid = t < t_far[active, None]
+            index = self.lookup(origins[active, None] + directions[active, None] * t[..., None])
+            index = torch.where(valid, index, -1)
+            density = torch.where(index >= 0, self.densities[index.clamp(min=0)], 0.0)
+            alpha = 1 - torch.exp(-density * step_size)
+            local_transmittance = torch.cumprod(1 - alpha, dim=-1)
+            weights = alpha * torch.cat(
+                [torch.ones_like(alpha[:, :1]), local_transmittance[:, :-1]], dim=-1
+            ) * transmittance[active, None]
+
+            rgb[active] += torch.sum(weights[..., None] * self.colors[index.clamp(min=0)], dim=1)
+            depth[active] += torch.sum(weights * t, dim=-1)
+            if self.labels is not None:
+                block_best, block_argmax = weights.max(dim=-1)
+                better = block_best > best_weight[active]
+                best_weight[active[better]] = block_best[better]
+                labels[active[better]] = self.labels[index[better, block_argmax[better]].clamp(min=0)]
+            transmittance[active] *= local_transmittance[:, -1]
+
+            block_start += samples_per_block * step_size
+            keep = (transmittance[active] > min_transmittance) & (t_near[active] + block_start < t_far[active])
+            active = active[keep]
+
+        accumulation = 1 - transmittance
+        if background is not None:
+            rgb += transmittance[:, None] * background
+        outputs = {
+            "rgb": rgb,
+            "depth": (depth / accumulation.clamp(min=1e-6))[:, None],
+            "accumulation": accumulation[:, None],
+        }
+        if self.labels is not None:
+            outputs["semantic_labels"] = labels
+        return outputs
+
+    def render_camera(self, camera: Cameras, **kwargs) -> Dict[str, Tensor]:
+        """Renders a single camera on the CPU, taking the arguments of render_rays. Outputs are [H, W, C]."""
+        ray_bundle = camera.to("cpu").generate_rays(camera_indices=0, keep_shape=True)
+        height, width = ray_bundle.shape
+        outputs = self.render_rays(ray_bundle.origins.view(-1, 3), ray_bundle.directions.view(-1, 3), **kwargs)
+        return {name: value.view(height, width, -1) for name, value in outputs.items()}
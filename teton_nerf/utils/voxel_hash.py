@@ -0,0 +1,115 @@
+"""
+Voxel-hashed accumulation of point samples on the device the points are produced on.
+"""
+
+from __future__ import annotations
+
+from typing import Dict, Iterator, List, Optional, Union
+
+import torch
+from jaxtyping import Float, Int
+from torch import Tensor
+
+# Every voxel coordinate is stored in 21 bits of a single int64 key
+KEY_BITS = 21
+KEY_OFFSET = 1 << (KEY_BITS - 1)
+KEY_MASK = (1 << KEY_BITS) - 1
+
+
+def voxel_keys(points: Float[Tensor, "num_points 3"], voxel_size: float) -> Int[Tensor, "num_points"]:
+    """Packs the integer voxel coordinates of every point into one int64 key."""
+    coords = torch.floor(points / voxel_size).long() + KEY_OFFSET
+    assert bool(((coords >= 0) & (coords <= KEY_MASK)).all()), "Points are too far from the origin for the voxel size"
+    return (coords[:, 0] << (2 * KEY_BITS)) | (coords[:, 1] << KEY_BITS) | coords[:, 2]
+
+
+def voxel_coords(keys: Int[Tensor, "num_voxels"]) -> Int[Tensor, "num_voxels 3"]:
+    """Inverse of voxel_keys, returns the integer voxel coordinates."""
+    coords = torch.stack([keys >> (2 * KEY_BITS), keys >> KEY_BITS, keys], dim=-1) & KEY_MASK
+    return coords - KEY_OFFSET
+
+
+class VoxelHashAccumulator:
+    """Keeps one running average of the points and their attributes per occupied voxel.
+
+    New samples are buffered and merged into the sorted voxel table in bulk, so the memory stays
+    proportional to the number of occupied voxels rather than to the number of samples.
+
+    Args:
+        voxel_size: Edge length of the voxels, in the units of the points.
+        device: Device the voxel table is kept on.
+        merge_size: Number of buffered samples that triggers a merge into the voxel table.
+    """
+
+    def __init__(self, voxel_size: float, device: Union[torch.device, str] = "cpu", merge_size: int = 1 << 22):
+        assert voxel_size > 0, "voxel_size must be positive"
+        self.voxel_size = voxel_size
+        self.device = device
+        self.merge_size = merge_size
+        self.attribute_names: Optional[List[str]] = None
+        self.attribute_dims: List[int] = []
+        self.keys = torch.empty(0, dtype=torch.long, device=device)
+        # Sums of the points and attributes followed by the sample count, one row per voxel
+        self.sums = torch.empty(0, 4, device=device)
+        self._pending_keys: List[Tensor] = []
+        self._pending_values: List[Tensor] = []
+        self._num_pending = 0
+
+    def add(self, points: Float[Tensor, "num_points 3"], **attributes: Tensor) -> None:
+        """Adds samples, attributes are averaged per voxel along with the point positions.
+
+        Args:
+            points: Sample positions.
+            attributes: Per-sample values, e.g. rgb=colors. Every call has to pass the same attributes.
+        """
+        names = sorted(attributes)
+        if self.attribute_names is None:
+            self.attribute_names = names
+            self.attribute_dims = [attributes[name].reshape(len(points), -1).shape[-1] for name in names]
+            self.sums = torch.empty(0, 3 + sum(self.attribute_dims) + 1, device=self.device)
+        assert names == self.attribute_names, f"Expected attributes {self.attribute_names}, got {names}"
+        if len(points) == 0:
+            return
+
+        points = points.to(self.device, torch.float32)
+        values = [points] + [attributes[name].to(self.device, torch.float32).reshape(len(points), -1) for name in names]
+        values.append(torch.ones_like(points[:, :1]))
+        self._pending_keys.append(voxel_keys(points, self.voxel_size))
+        self._pending_values.append(torch.cat(values, dim=-1))
+        self._num_pending += len(points)
+        if self._num_pending >= self.merge_size:
+            self.merge()
+
+    def merge(self) -> None:
+        """Merges the buffered samples into the voxel table."""
+        if self._num_pending == 0:
+            return
+        keys = torch.cat([self.keys] + self._pending_keys)
+        values = torch.cat([self.sums] + self._pending_values)
+        self._pending_keys, self._pending_values, self._num_pending = [], [], 0
+
+        self.keys, inverse = torch.unique(keys, sorted=True, return_inverse=True)
+        self.sums = torch.zeros(len(self.keys), values.shape[-1], device=self.device).index_add_(0, inverse, values)
+
+    @property
+    def num_voxels(self) -> int:
+        self.merge()
+        return len(self.keys)
+
+    def _averages(self, sums: Tensor) -> Dict[str, Tensor]:
+        averages = sums[:, :-1] / sums[:, -1:]
+        splits = torch.split(averages, [3] + self.attribute_dims, dim=-1)
+        result = {"points": splits[0], "counts": sums[:, -1].long()}
+        result.update(zip(self.attribute_names or [], splits[1:]))
+        return result
+
+    def iter_chunks(self, chunk_size: int = 1 << 20) -> Iterator[Dict[str, Tensor]]:
+        """Yields the per-voxel averages in chunks, along with the number of samples of every voxel."""
+        self.merge()
+        for start in range(0, len(self.keys), chunk_size):
+            yield self._averages(self.sums[start : start + chunk_size])
+
+    def result(self) -> Dict[str, Tensor]:
+        """Per-voxel averages of all voxels at once."""
+        self.merge()
+        return self._averages(self.sums)